@@ -0,0 +1,27 @@
+import os
+from contextlib import contextmanager
+from typing import IO, Iterator, Optional
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = 'w', encoding: Optional[str] = None) -> Iterator[IO]:
+    """Open a temp file next to `path` and move it over `path` once the block succeeds.
+
+    Readers see the old file or the new one, never a partial write. If the
+    block or the write fails, the temp file is removed and `path` is untouched.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # Per process, so two cluster processes writing the same file don't share one
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, mode, encoding=encoding) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
@@ -2,11 +2,38 @@ import discord
 from discord.ext import commands
 from discord import app_commands
 import asyncio
+import itertools
+import logging
 import random
-from typing import Optional, List
+import sqlite3
+from typing import Optional, List, Tuple
 from waifu_api import WaifuAPI
 from furry_api import FurryAPI
-from config import DISCORD_TOKEN, MAX_IMAGES_PER_REQUEST
+from prefetch import PrefetchPool
+from http_client import UpstreamHTTP
+from recent import RecentlySeen
+from tag_catalog import load_catalog, save_catalog, is_stale
+from command_sync import sync_commands
+from startup import StartupStages
+from tag_index import TagSearchIndex
+from e621_tags import E621TagIndex, open_index
+from image_store import ImageStore
+from media import DEFAULT_MEDIA_POLICY, MEDIA_POLICIES, MediaPolicy, select_variant
+from metrics import FANOUT_REQUESTS, PREFETCH_POOL_IMAGES, start_metrics_server, track_command
+from logging_setup import setup_logging, shutdown_logging
+from priority import MAINTENANCE, upstream_priority
+from deadline import with_deadline
+from config import (
+    DISCORD_TOKEN, MAX_IMAGES_PER_REQUEST, TAG_CATALOG_PATH, TAG_CATALOG_TTL, E621_TAGS_PATH,
+    IMAGE_STORE_PATH, IMAGE_STORE_MAX_IMAGES, MAX_FANOUT_TAGS, FANOUT_PARTIAL_AFTER, COMMAND_SYNC_STATE_PATH,
+    STARTUP_GATE_TIMEOUT,
+    WAIFU_PREFETCH_PAGE_SIZE, FURRY_PREFETCH_PAGE_SIZE,
+    PREFETCH_LOW_WATER, PREFETCH_MAX_KEYS, PREFETCH_WARMUP_KEYS, RECENT_PER_CHANNEL, RECENT_MAX_CHANNELS,
+    METRICS_HOST, METRICS_PORT, LOG_LEVEL, LOG_FILE, LOG_DEBUG_SAMPLE_RATE, LOG_QUEUE_SIZE,
+    SHARD_COUNT, SHARD_IDS, CLUSTER_ID, COMMAND_DEADLINE
+)
+
+logger = logging.getLogger(__name__)
 
 # Global cache for tags
 ALL_TAGS = []
@@ -14,128 +41,334 @@ SFW_TAGS = []
 NSFW_TAGS = []
 VERSATILE_TAGS = []
 
-async def load_available_tags():
-    """Load all available tags from the API and categorize them"""
+# Autocomplete indexes, rebuilt whenever the tag catalog changes
+POPULAR_TAGS = ['waifu', 'maid', 'uniform', 'selfies', 'oppai', 'ass']
+POPULAR_NSFW_TAGS = ['hentai', 'ecchi', 'ero', 'ass', 'oppai']
+TAG_INDEX_SFW = TagSearchIndex([])
+TAG_INDEX_ALL = TagSearchIndex([])
+TAG_INDEX_NSFW = TagSearchIndex([])
+
+FALLBACK_VERSATILE_TAGS = ['waifu', 'maid', 'uniform', 'selfies']
+FALLBACK_NSFW_TAGS = ['hentai', 'ecchi', 'ero']
+
+def _tag_names(data) -> List[str]:
+    # API может возвращать строки или объекты
+    names = []
+    for tag in data:
+        if isinstance(tag, dict) and 'name' in tag:
+            names.append(tag['name'])
+        elif isinstance(tag, str):
+            names.append(tag)
+    return names
+
+def apply_tags(versatile: List[str], nsfw: List[str]):
+    """Replace the global tag lists and rebuild the search indexes"""
     global ALL_TAGS, SFW_TAGS, NSFW_TAGS, VERSATILE_TAGS
-    
+    global TAG_INDEX_SFW, TAG_INDEX_ALL, TAG_INDEX_NSFW
+    
+    VERSATILE_TAGS = list(versatile)
+    NSFW_TAGS = list(nsfw)
+    # SFW tags are versatile tags that are not explicitly NSFW
+    SFW_TAGS = [tag for tag in VERSATILE_TAGS if tag not in NSFW_TAGS]
+    # All tags combined
+    ALL_TAGS = list(set(VERSATILE_TAGS + NSFW_TAGS))
+    
+    TAG_INDEX_SFW = TagSearchIndex(SFW_TAGS + VERSATILE_TAGS, POPULAR_TAGS)
+    TAG_INDEX_ALL = TagSearchIndex(SFW_TAGS + VERSATILE_TAGS + NSFW_TAGS, POPULAR_TAGS)
+    TAG_INDEX_NSFW = TagSearchIndex(NSFW_TAGS, POPULAR_NSFW_TAGS)
+
+def load_cached_tags() -> Optional[dict]:
+    """Load the tag catalog saved by the last successful fetch, without touching the API"""
+    catalog = load_catalog(TAG_CATALOG_PATH)
+    if catalog:
+        apply_tags(catalog['versatile'], catalog['nsfw'])
+        logger.info("Loaded cached tags", extra={'sfw': len(SFW_TAGS), 'nsfw': len(NSFW_TAGS), 'total': len(ALL_TAGS)})
+    return catalog
+
+def _use_fallback_tags():
+    # Keep tags from the cached catalog if we have them, otherwise use basic tags
+    if not ALL_TAGS:
+        apply_tags(FALLBACK_VERSATILE_TAGS, FALLBACK_NSFW_TAGS)
+
+async def load_available_tags(api: Optional[WaifuAPI] = None):
+    """Load all available tags from the API, categorize them and persist the catalog"""
     try:
-        async with WaifuAPI() as api:
-            result = await api.get_available_tags()
-            
-            if result and 'versatile' in result and 'nsfw' in result:
-                # Get versatile (SFW + some that work in both) tags
-                versatile_data = result['versatile']
-                nsfw_data = result['nsfw']
-                
-                # Extract tag names (API может возвращать строки или объекты)
-                VERSATILE_TAGS = []
-                for tag in versatile_data:
-                    if isinstance(tag, dict) and 'name' in tag:
-                        VERSATILE_TAGS.append(tag['name'])
-                    elif isinstance(tag, str):
-                        VERSATILE_TAGS.append(tag)
-                
-                NSFW_TAGS = []
-                for tag in nsfw_data:
-                    if isinstance(tag, dict) and 'name' in tag:
-                        NSFW_TAGS.append(tag['name'])
-                    elif isinstance(tag, str):
-                        NSFW_TAGS.append(tag)
-                
-                # SFW tags are versatile tags that are not explicitly NSFW
-                SFW_TAGS = [tag for tag in VERSATILE_TAGS if tag not in NSFW_TAGS]
-                
-                # All tags combined
-                ALL_TAGS = list(set(VERSATILE_TAGS + NSFW_TAGS))
-                
-                print(f"Loaded tags: SFW={len(SFW_TAGS)}, NSFW={len(NSFW_TAGS)}, Total={len(ALL_TAGS)}")
-                return True
+        # Housekeeping: only uses upstream budget that user commands leave over
+        with upstream_priority(MAINTENANCE):
+            if api is None:
+                async with WaifuAPI() as standalone_api:
+                    result = await standalone_api.get_available_tags()
             else:
-                print("Failed to get tags from API, using basic tags")
-                # Fallback to basic tags
-                VERSATILE_TAGS = ['waifu', 'maid', 'uniform', 'selfies']
-                SFW_TAGS = VERSATILE_TAGS.copy()
-                NSFW_TAGS = ['hentai', 'ecchi', 'ero']
-                ALL_TAGS = list(set(VERSATILE_TAGS + NSFW_TAGS))
-                return False
-                
+                result = await api.get_available_tags()
+        
+        if result and 'versatile' in result and 'nsfw' in result:
+            apply_tags(_tag_names(result['versatile']), _tag_names(result['nsfw']))
+            logger.info("Loaded tags", extra={'sfw': len(SFW_TAGS), 'nsfw': len(NSFW_TAGS), 'total': len(ALL_TAGS)})
+            
+            try:
+                save_catalog(TAG_CATALOG_PATH, VERSATILE_TAGS, NSFW_TAGS)
+            except OSError as e:
+                logger.warning("Could not save tag catalog", extra={'error': str(e)})
+            return True
+        else:
+            logger.warning("Failed to get tags from API, using cached or basic tags")
+            _use_fallback_tags()
+            return False
+            
     except Exception as e:
-        print(f"Error loading tags: {e}")
-        # Fallback to basic tags
-        VERSATILE_TAGS = ['waifu', 'maid', 'uniform', 'selfies']
-        SFW_TAGS = VERSATILE_TAGS.copy()
-        NSFW_TAGS = ['hentai', 'ecchi', 'ero']
-        ALL_TAGS = list(set(VERSATILE_TAGS + NSFW_TAGS))
+        logger.exception("Error loading tags")
+        _use_fallback_tags()
         return False
 
-class WaifuBot(commands.Bot):
-    def __init__(self):
+class WaifuBot(commands.AutoShardedBot):
+    def __init__(self, shard_count: Optional[int] = None, shard_ids: Optional[List[int]] = None, cluster_id: int = 0):
         intents = discord.Intents.default()
         # Убираем привилегированные интенты, которые не нужны для slash команд
         intents.message_content = False
         intents.members = False
         intents.presences = False
-        super().__init__(command_prefix='!', intents=intents)
+        # shard_ids limits this process to its cluster's slice of the shards
+        super().__init__(command_prefix='!', intents=intents, shard_count=shard_count, shard_ids=shard_ids)
+        self.cluster_id = cluster_id
+        self.upstream_http = UpstreamHTTP()
         self.waifu_api = None
         self.furry_api = None
+        self.prefetch = None
+        self.e621_tags: Optional[E621TagIndex] = None
+        self.image_store: Optional[ImageStore] = None
+        self.recent = RecentlySeen(RECENT_PER_CHANNEL, RECENT_MAX_CHANNELS)
+        self.startup = StartupStages()
+        self._metrics_runner = None
+    
+    async def setup_services(self, waifu_base_url: Optional[str] = None, furry_base_urls: Optional[dict] = None):
+        """Create the shared HTTP session, API clients and prefetch pool"""
+        # One pooled session is shared by every upstream client
+        session = await self.upstream_http.start()
+        
+        # Local copy of fetched image metadata, served while an upstream is failing
+        self.image_store = ImageStore(IMAGE_STORE_PATH, max_images=IMAGE_STORE_MAX_IMAGES)
+        try:
+            await self.image_store.open()
+            logger.info("Opened image store", extra={'path': IMAGE_STORE_PATH, **await self.image_store.stats()})
+        except (sqlite3.Error, OSError) as e:
+            logger.warning("Image store unavailable, running without it", extra={'path': IMAGE_STORE_PATH, 'error': str(e)})
+            await self.image_store.close()
+            self.image_store = None
+        
+        self.waifu_api = WaifuAPI(session=session, base_url=waifu_base_url, store=self.image_store)
+        self.furry_api = FurryAPI(session=session, store=self.image_store, **(furry_base_urls or {}))
+        
+        self.prefetch = PrefetchPool(low_water=PREFETCH_LOW_WATER, max_keys=PREFETCH_MAX_KEYS)
+        self.prefetch.register_source('waifu', self._fetch_waifu_page, WAIFU_PREFETCH_PAGE_SIZE)
+        self.prefetch.register_source('furry', self._fetch_furry_page, FURRY_PREFETCH_PAGE_SIZE)
+        PREFETCH_POOL_IMAGES.set_function(lambda: self.prefetch.stats()['images'])
+        
+        # Memory-mapped, so opening is instant; without it /furry tags are not checked
+        self.e621_tags = open_index(E621_TAGS_PATH)
+        if self.e621_tags is not None:
+            logger.info("Loaded e621 tag index", extra={'path': E621_TAGS_PATH, 'tags': len(self.e621_tags)})
     
     async def setup_hook(self):
-        """Called when the bot is starting up"""
-        self.waifu_api = WaifuAPI()
-        await self.waifu_api.__aenter__()
+        """Called when the bot is starting up.
         
-        self.furry_api = FurryAPI()
-        await self.furry_api.__aenter__()
+        Only local setup happens here; everything that waits on the network runs as
+        concurrent startup stages while the gateway connects.
+        """
+        await self.setup_services()
         
-        # Load available tags from API
-        print("Loading available tags...")
-        await load_available_tags()
+        if METRICS_PORT:
+            try:
+                # One port per cluster so each process can be scraped
+                self._metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT + self.cluster_id)
+            except OSError as e:
+                logger.warning("Could not start metrics endpoint", extra={'error': str(e)})
+        
+        # Serve cached tags right away; refresh from the API in the background
+        catalog = load_cached_tags()
+        if not catalog:
+            _use_fallback_tags()
+        if is_stale(catalog, TAG_CATALOG_TTL):
+            logger.info("Tag catalog is missing or stale, refreshing in background")
+            # Without any cached catalog, tag validation briefly waits for this one
+            self.startup.start('tags', load_available_tags(self.waifu_api), gating=not catalog)
         
         # Настройка команд для работы везде (включая групповые DM)
         for command in self.tree.get_commands():
             # Разрешаем команды в DM и групповых чатах
             command.extras = {"dm_permission": True}
         
-        # Sync slash commands globally
+        upstreams = [self.waifu_api.base_url, self.furry_api.base_url_sfw, self.furry_api.base_url_nsfw]
+        self.startup.start('http_warmup', self.upstream_http.warmup(upstreams))
+        # Commands for a warming pool join its refill instead of fetching again
+        self.startup.start('prefetch_warmup', self.prefetch.warmup(PREFETCH_WARMUP_KEYS))
+        
+        # Commands are global: only the first cluster syncs them
+        if self.cluster_id != 0:
+            logger.info("Skipping command sync on this cluster", extra={'cluster': self.cluster_id})
+        else:
+            self.startup.start('command_sync', self._sync_commands())
+    
+    async def _sync_commands(self) -> bool:
+        # Sync slash commands globally, only when they changed since the last sync
+        # (a failed sync is retried on the next start; /sync forces one)
         try:
-            synced = await self.tree.sync()
-            print(f"Synced {len(synced)} command(s)")
-            for cmd in synced:
-                print(f"   • /{cmd.name}")
+            await sync_commands(self.tree, COMMAND_SYNC_STATE_PATH)
+            return True
         except Exception as e:
-            print(f"Error syncing commands: {e}")
-            # Попробуем принудительную синхронизацию
-            try:
-                self.tree.clear_commands(guild=None)
-                synced = await self.tree.sync()
-                print(f"Force synced {len(synced)} command(s)")
-            except Exception as e2:
-                print(f"Critical sync error: {e2}")
+            logger.error("Error syncing commands", extra={'error': str(e)})
+            return False
+    
+    async def _fetch_waifu_page(self, nsfw: bool, tag: Optional[str], page_size: int):
+        return await self.waifu_api.get_multiple_waifus(page_size, nsfw, [tag] if tag else None)
+    
+    async def _fetch_furry_page(self, nsfw: bool, tags: Optional[str], page_size: int):
+        if tags:
+            return await self.furry_api.get_furry_by_tags(tags.split(), nsfw=nsfw, count=page_size)
+        return await self.furry_api.get_random_furry(nsfw=nsfw, count=page_size)
+    
+    async def get_fresh_images(
+        self,
+        interaction: discord.Interaction,
+        source: str,
+        nsfw: bool,
+        tag: Optional[str],
+        count: int,
+        media_policy: Optional[MediaPolicy] = None,
+        remember: bool = True
+    ):
+        """Serve images from the prefetch pool, skipping ones this channel saw recently.
+        
+        With `media_policy`, images with no variant fitting it are never served; they stay in
+        the pool for other commands. Without `remember` the images are not recorded as seen,
+        for callers that may not show them all.
+        """
+        channel_id = interaction.channel_id
+        
+        def exclude(image) -> bool:
+            return self.recent.seen(channel_id, image.url)
+        
+        reject = None
+        if media_policy is not None:
+            def reject(image) -> bool:
+                return select_variant(image, media_policy) is None
+        
+        result = await self.prefetch.get_images(source, nsfw, tag, count, exclude=exclude, reject=reject)
+        if remember and result and result.get('images'):
+            self.recent.add(channel_id, [image.url for image in result['images']])
+        return result
+    
+    async def get_mixed_images(
+        self,
+        interaction: discord.Interaction,
+        requests: List[Tuple[str, Optional[str]]],
+        nsfw: bool,
+        count: int,
+        partial_after: float = FANOUT_PARTIAL_AFTER
+    ):
+        """Fetch several (source, tag) requests concurrently and interleave their images.
+        
+        Sub-requests go through the prefetch pool and rate limiters like any other. After
+        `partial_after` seconds whatever has arrived is returned; slower sub-requests are
+        cancelled and their images go back to the pool.
+        """
+        if count < len(requests):
+            # One image each from a random subset of the tags
+            requests = random.sample(requests, count)
+        per_request = -(-count // len(requests))
+        tasks = [
+            asyncio.create_task(self.get_fresh_images(interaction, source, nsfw, tag, per_request, remember=False))
+            for source, tag in requests
+        ]
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=partial_after)
+            # Nothing to show yet: wait on until the first sub-request with images
+            while pending and not any(_task_images(task) for task in done):
+                finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                done |= finished
+        finally:
+            leftover = [task for task in tasks if not task.done()]
+            for task in leftover:
+                task.cancel()
+            # Let cancelled parts hand their images back to the pool before replying
+            await asyncio.gather(*leftover, return_exceptions=True)
+        FANOUT_REQUESTS.inc(result='partial' if pending else 'complete')
+        for task in done:
+            if task.exception() is not None:
+                logger.warning("Mixed request part failed", extra={'error': repr(task.exception())})
+        
+        # Round-robin over the tags so a mixed request really is mixed
+        images, seen = [], set()
+        for group in itertools.zip_longest(*(_task_images(task) for task in tasks if task in done)):
+            for image in group:
+                if image is not None and image.url not in seen:
+                    seen.add(image.url)
+                    images.append(image)
+        images = images[:count]
+        if pending:
+            logger.info("Mixed request returned partial results", extra={
+                'tags': [tag for _, tag in requests], 'missing': len(pending), 'images': len(images)
+            })
+        
+        # Every part took a full share; what the trim left out goes back to its pool unseen
+        served = {image.url for image in images}
+        for (source, tag), task in zip(requests, tasks):
+            if task in done:
+                self.prefetch.give_back(source, nsfw, tag, [image for image in _task_images(task) if image.url not in served])
+        if not images:
+            return None
+        self.recent.add(interaction.channel_id, [image.url for image in images])
+        return {'images': images}
     
     async def on_ready(self):
-        print(f'{self.user} connected to Discord!')
-        print(f'Bot ID: {self.user.id}')
-        print(f'Connected to {len(self.guilds)} servers')
+        logger.info("Connected to Discord", extra={
+            'user': str(self.user), 'bot_id': self.user.id, 'guilds': len(self.guilds),
+            'cluster': self.cluster_id, 'shards': sorted(self.shards), 'shard_count': self.shard_count
+        })
         
         # Показываем доступные команды
         commands = [cmd.name for cmd in self.tree.get_commands()]
-        print(f'Registered commands: {", ".join(commands)}')
+        logger.info("Registered commands", extra={'commands': commands})
         
         # Set bot status
         activity = discord.Activity(type=discord.ActivityType.watching, name="anime girls")
         await self.change_presence(activity=activity)
         
-        print("Bot is ready!")
-        print("If commands are not visible, wait up to 1 hour or restart Discord")
+        logger.info("Bot is ready! If commands are not visible, wait up to 1 hour or restart Discord")
+    
+    async def on_shard_ready(self, shard_id: int):
+        logger.info("Shard ready", extra={'cluster': self.cluster_id, 'shard': shard_id})
     
     async def close(self):
         """Clean up when bot shuts down"""
+        await self.startup.cancel()
+        if self.prefetch:
+            await self.prefetch.close()
         if self.waifu_api:
             await self.waifu_api.close()
         if self.furry_api:
             await self.furry_api.close()
+        await self.upstream_http.close()
+        if self.image_store:
+            await self.image_store.close()
+            self.image_store = None
+        if self.e621_tags:
+            self.e621_tags.close()
+            self.e621_tags = None
+        if self._metrics_runner:
+            await self._metrics_runner.cleanup()
+            self._metrics_runner = None
+
+bot = WaifuBot(shard_count=SHARD_COUNT, shard_ids=SHARD_IDS, cluster_id=CLUSTER_ID)
 
-bot = WaifuBot()
+def _task_images(task: asyncio.Task) -> list:
+    """Images from a finished get_fresh_images task; failures count as none"""
+    if task.cancelled() or task.exception() is not None:
+        return []
+    return (task.result() or {}).get('images', [])
+
+def split_tags(tag: Optional[str]) -> List[str]:
+    """Comma separated tags, de-duplicated in order"""
+    return list(dict.fromkeys(part.strip() for part in (tag or '').split(',') if part.strip()))
 
 async def process_waifu_request(interaction: discord.Interaction, nsfw: bool = False, tag: Optional[str] = None, count: int = 1):
     """Common function to process waifu requests"""
@@ -155,29 +388,37 @@ async def process_waifu_request(interaction: discord.Interaction, nsfw: bool = F
     
     await interaction.response.defer()
     
+    # Right after a deploy without a cached catalog, give the first tag load a moment;
+    # past the timeout the built-in fallback tags are used
+    if tag and not await bot.startup.wait_ready(STARTUP_GATE_TIMEOUT):
+        logger.info("Serving before startup finished", extra={'stages': bot.startup.results})
+    
     try:
         # Get images from API
-        if tag:
-            # Validate tag against all available tags
-            if nsfw:
-                available_tags = list(set(SFW_TAGS + VERSATILE_TAGS + NSFW_TAGS))
-            else:
-                available_tags = list(set(SFW_TAGS + VERSATILE_TAGS))
-            
-            if tag not in available_tags:
+        tags = split_tags(tag)
+        if len(tags) > MAX_FANOUT_TAGS:
+            await interaction.followup.send(f"Mix at most {MAX_FANOUT_TAGS} tags at once.", ephemeral=True)
+            return
+        
+        # Validate tags against the precomputed tag set for this visibility
+        index = TAG_INDEX_ALL if nsfw else TAG_INDEX_SFW
+        for name in tags:
+            if name not in index:
                 # Show a more helpful error message with suggestions
-                similar_tags = [t for t in available_tags if tag.lower() in t.lower() or t.lower() in tag.lower()][:5]
-                error_msg = f"Unknown tag: `{tag}`"
+                similar_tags = index.suggest(name, limit=5)
+                error_msg = f"Unknown tag: `{name}`"
                 if similar_tags:
                     error_msg += f"\nDid you mean: {', '.join(similar_tags)}"
                 error_msg += f"\nUse `/tags` to view all available tags"
                 
                 await interaction.followup.send(error_msg, ephemeral=True)
                 return
-            
-            result = await bot.waifu_api.get_multiple_waifus(count, nsfw, [tag])
+        
+        if len(tags) > 1:
+            # Several tags: fetched concurrently and mixed into one reply
+            result = await bot.get_mixed_images(interaction, [('waifu', name) for name in tags], nsfw, count)
         else:
-            result = await bot.waifu_api.get_multiple_waifus(count, nsfw)
+            result = await bot.get_fresh_images(interaction, 'waifu', nsfw, tags[0] if tags else None, count)
         
         if not result:
             await interaction.followup.send(
@@ -204,21 +445,19 @@ async def process_waifu_request(interaction: discord.Interaction, nsfw: bool = F
         embeds = []
         for i, image in enumerate(images):
             embed = discord.Embed(
-                title=f"Waifu #{i+1}" + (f" - {tag}" if tag else ""),
-                color=discord.Color.from_str(image.get('dominant_color', '#FF69B4'))
+                title=f"Waifu #{i+1}" + (f" - {', '.join(tags)}" if tags else ""),
+                color=discord.Color.from_str(image.dominant_color or '#FF69B4')
             )
-            embed.set_image(url=image.get('url', ''))
+            embed.set_image(url=image.url)
             
             # Add image info
-            tags = image.get('tags') or []
-            tags_str = ', '.join([t.get('name', '') for t in tags if t and isinstance(t, dict)])
+            tags_str = ', '.join(image.tags)
             embed.add_field(name="Tags", value=tags_str or "None", inline=True)
-            embed.add_field(name="Size", value=f"{image.get('width', '?')}x{image.get('height', '?')}", inline=True)
-            embed.add_field(name="NSFW", value="Yes" if image.get('is_nsfw') else "No", inline=True)
+            embed.add_field(name="Size", value=f"{image.width or '?'}x{image.height or '?'}", inline=True)
+            embed.add_field(name="NSFW", value="Yes" if image.is_nsfw else "No", inline=True)
             
-            artist = image.get('artist')
-            if artist and isinstance(artist, dict) and artist.get('name'):
-                embed.set_footer(text=f"Artist: {artist['name']}")
+            if image.artist:
+                embed.set_footer(text=f"Artist: {image.artist}")
             
             embeds.append(embed)
         
@@ -226,17 +465,19 @@ async def process_waifu_request(interaction: discord.Interaction, nsfw: bool = F
         await interaction.followup.send(embeds=embeds)
         
     except Exception as e:
-        print(f"Error in waifu command: {e}")
+        logger.exception("Error in waifu command")
         await interaction.followup.send("An error occurred while fetching the image.")
 
 @bot.tree.command(name="waifu", description="Get random anime girl picture")
 @app_commands.describe(
     nsfw="Include NSFW content (NSFW channels only)",
-    tag="Select specific tag",
+    tag="Select specific tag (separate several with commas to mix them)",
     count="Number of pictures (1-5)"
 )
 @app_commands.allowed_installs(guilds=True, users=True)
 @app_commands.allowed_contexts(guilds=True, dms=True, private_channels=True)
+@track_command('waifu')
+@with_deadline(COMMAND_DEADLINE)
 async def waifu_command(
     interaction: discord.Interaction,
     nsfw: bool = False,
@@ -247,11 +488,13 @@ async def waifu_command(
 
 @bot.tree.command(name="nsfw", description="Get NSFW anime girl picture")
 @app_commands.describe(
-    tag="Select specific NSFW tag",
+    tag="Select specific NSFW tag (separate several with commas to mix them)",
     count="Number of pictures (1-5)"
 )
 @app_commands.allowed_installs(guilds=True, users=True)
 @app_commands.allowed_contexts(guilds=True, dms=True, private_channels=True)
+@track_command('nsfw')
+@with_deadline(COMMAND_DEADLINE)
 async def nsfw_command(
     interaction: discord.Interaction,
     tag: Optional[str] = None,
@@ -374,7 +617,7 @@ async def help_command(interaction: discord.Interaction):
     
     embed.add_field(
         name="/furry",
-        value="Get random furry picture\n`nsfw:` include NSFW (NSFW channels only)\n`tags:` search tags\n`count:` number (1-5)",
+        value="Get random furry picture\n`nsfw:` include NSFW (NSFW channels only)\n`tags:` search tags\n`count:` number (1-5)\n`size:` smaller images load faster",
         inline=False
     )
     
@@ -400,11 +643,12 @@ async def reload_tags_command(interaction: discord.Interaction):
     SUPER_ADMIN_ID = 1401591841115078862
     
     # Debug info
-    print(f"reload_tags called by user ID: {interaction.user.id}")
-    print(f"Is super admin: {interaction.user.id == SUPER_ADMIN_ID}")
-    print(f"Has guild: {interaction.guild is not None}")
-    if interaction.guild:
-        print(f"Guild permissions: {interaction.user.guild_permissions.administrator}")
+    logger.info("reload_tags called", extra={
+        'user_id': interaction.user.id,
+        'is_super_admin': interaction.user.id == SUPER_ADMIN_ID,
+        'has_guild': interaction.guild is not None,
+        'guild_admin': interaction.user.guild_permissions.administrator if interaction.guild else None
+    })
     
     # Супер-админ всегда имеет доступ, независимо от контекста
     if interaction.user.id == SUPER_ADMIN_ID:
@@ -426,8 +670,8 @@ async def reload_tags_command(interaction: discord.Interaction):
     await interaction.response.defer()
     
     try:
-        print("Administrator requested tags reload...")
-        success = await load_available_tags()
+        logger.info("Administrator requested tags reload")
+        success = await load_available_tags(bot.waifu_api)
         
         if success:
             embed = discord.Embed(
@@ -438,14 +682,14 @@ async def reload_tags_command(interaction: discord.Interaction):
         else:
             embed = discord.Embed(
                 title="Tags updated with errors",
-                description="Using basic tags. Check API connection.",
+                description="Using cached or basic tags. Check API connection.",
                 color=discord.Color.orange()
             )
         
         await interaction.followup.send(embed=embed)
         
     except Exception as e:
-        print(f"Error updating tags: {e}")
+        logger.exception("Error updating tags")
         await interaction.followup.send(
             "An error occurred while updating tags. Check bot logs.",
             ephemeral=True
@@ -457,11 +701,12 @@ async def sync_command(interaction: discord.Interaction):
     SUPER_ADMIN_ID = 1401591841115078862
     
     # Debug info
-    print(f"sync called by user ID: {interaction.user.id}")
-    print(f"Is super admin: {interaction.user.id == SUPER_ADMIN_ID}")
-    print(f"Has guild: {interaction.guild is not None}")
-    if interaction.guild:
-        print(f"Guild permissions: {interaction.user.guild_permissions.administrator}")
+    logger.info("sync called", extra={
+        'user_id': interaction.user.id,
+        'is_super_admin': interaction.user.id == SUPER_ADMIN_ID,
+        'has_guild': interaction.guild is not None,
+        'guild_admin': interaction.user.guild_permissions.administrator if interaction.guild else None
+    })
     
     # Супер-админ всегда имеет доступ, независимо от контекста
     if interaction.user.id == SUPER_ADMIN_ID:
@@ -483,8 +728,8 @@ async def sync_command(interaction: discord.Interaction):
     await interaction.response.defer()
     
     try:
-        print("Administrator requested command sync...")
-        synced = await bot.tree.sync()
+        logger.info("Administrator requested command sync")
+        synced = await sync_commands(bot.tree, COMMAND_SYNC_STATE_PATH, force=True)
         
         embed = discord.Embed(
             title="Commands synced!",
@@ -497,80 +742,63 @@ async def sync_command(interaction: discord.Interaction):
         await interaction.followup.send(embed=embed)
         
     except Exception as e:
-        print(f"Error syncing commands: {e}")
+        logger.exception("Error syncing commands")
         await interaction.followup.send(
             f"An error occurred while syncing commands: {e}",
             ephemeral=True
         )
 
 # Autocomplete for tags
+def tag_choices(index: TagSearchIndex, current: str) -> List[app_commands.Choice[str]]:
+    """Complete the last of the comma separated tags in `current`, keeping the others"""
+    head, _, last = current.rpartition(',')
+    chosen = split_tags(head)
+    prefix = ''.join(f'{name}, ' for name in chosen)
+    return [
+        app_commands.Choice(name=prefix + tag, value=prefix + tag)
+        for tag in index.search(last, limit=25 + len(chosen))  # Discord limit
+        if tag not in chosen and len(prefix + tag) <= 100
+    ][:25]
+
 @waifu_command.autocomplete('tag')
 async def waifu_tag_autocomplete(interaction: discord.Interaction, current: str):
     # Determine available tags based on NSFW channel or DM
     if not hasattr(interaction.channel, 'is_nsfw') or interaction.channel.is_nsfw():
         # In NSFW channels or DM, show all tags
-        available_tags = list(set(SFW_TAGS + VERSATILE_TAGS + NSFW_TAGS))
+        index = TAG_INDEX_ALL
     else:
         # In SFW channels, only show SFW and versatile tags
-        available_tags = list(set(SFW_TAGS + VERSATILE_TAGS))
+        index = TAG_INDEX_SFW
     
-    # Filter tags based on current input and sort by relevance
-    if current:
-        # Prioritize exact matches and starts-with matches
-        exact_matches = [tag for tag in available_tags if tag.lower() == current.lower()]
-        starts_with = [tag for tag in available_tags if tag.lower().startswith(current.lower()) and tag not in exact_matches]
-        contains = [tag for tag in available_tags if current.lower() in tag.lower() and tag not in exact_matches and tag not in starts_with]
-        
-        filtered_tags = exact_matches + starts_with + contains
-    else:
-        # If no input, show popular tags first
-        popular_tags = ['waifu', 'maid', 'uniform', 'selfies', 'oppai', 'ass']
-        filtered_tags = [tag for tag in popular_tags if tag in available_tags] + \
-                       [tag for tag in available_tags if tag not in popular_tags]
-    
-    # Convert to choices
-    choices = [
-        app_commands.Choice(name=tag, value=tag)
-        for tag in filtered_tags[:25]  # Discord limit
-    ]
-    
-    return choices
+    # Exact matches first, then starts-with, then contains (popular tags for empty input)
+    return tag_choices(index, current)
 
 @nsfw_command.autocomplete('tag')
 async def nsfw_tag_autocomplete(interaction: discord.Interaction, current: str):
-    # Filter NSFW tags based on current input
-    if current:
-        exact_matches = [tag for tag in NSFW_TAGS if tag.lower() == current.lower()]
-        starts_with = [tag for tag in NSFW_TAGS if tag.lower().startswith(current.lower()) and tag not in exact_matches]
-        contains = [tag for tag in NSFW_TAGS if current.lower() in tag.lower() and tag not in exact_matches and tag not in starts_with]
-        
-        filtered_tags = exact_matches + starts_with + contains
-    else:
-        # Show popular NSFW tags first
-        popular_nsfw = ['hentai', 'ecchi', 'ero', 'ass', 'oppai']
-        filtered_tags = [tag for tag in popular_nsfw if tag in NSFW_TAGS] + \
-                       [tag for tag in NSFW_TAGS if tag not in popular_nsfw]
-    
-    choices = [
-        app_commands.Choice(name=tag, value=tag)
-        for tag in filtered_tags[:25]
-    ]
-    
-    return choices
+    return tag_choices(TAG_INDEX_NSFW, current)
 
 @bot.tree.command(name="furry", description="Get random furry picture")
 @app_commands.describe(
     nsfw="Include NSFW content (NSFW channels only)",
     tags="Search tags (space separated)",
-    count="Number of pictures (1-5)"
+    count="Number of pictures (1-5)",
+    size="Image size: smaller loads faster (default: balanced)"
 )
+@app_commands.choices(size=[
+    app_commands.Choice(name="Original (full resolution)", value="original"),
+    app_commands.Choice(name="Balanced", value="balanced"),
+    app_commands.Choice(name="Small (fastest)", value="small")
+])
 @app_commands.allowed_installs(guilds=True, users=True)
 @app_commands.allowed_contexts(guilds=True, dms=True, private_channels=True)
+@track_command('furry')
+@with_deadline(COMMAND_DEADLINE)
 async def furry_command(
     interaction: discord.Interaction,
     nsfw: bool = False,
     tags: Optional[str] = None,
-    count: int = 1
+    count: int = 1,
+    size: Optional[app_commands.Choice[str]] = None
 ):
     if nsfw and hasattr(interaction.channel, 'is_nsfw') and not interaction.channel.is_nsfw():
         await interaction.response.send_message(
@@ -581,11 +809,21 @@ async def furry_command(
     
     count = max(1, min(count, 5))
     
+    # Reject misspelled tags locally instead of spending an upstream request on them
+    unknown = bot.e621_tags.unknown_tags(tags) if tags and bot.e621_tags else []
+    if unknown:
+        error_msg = f"Unknown tag: `{unknown[0]}`"
+        similar_tags = bot.e621_tags.suggest(unknown[0], limit=5)
+        if similar_tags:
+            error_msg += f"\nDid you mean: {', '.join(similar_tags)}"
+        await interaction.response.send_message(error_msg, ephemeral=True)
+        return
+    
     await interaction.response.defer()
     
     try:
-        tag_list = tags.split() if tags else None
-        result = await bot.furry_api.get_furry_by_tags(tag_list, nsfw=nsfw, count=count) if tag_list else await bot.furry_api.get_random_furry(nsfw=nsfw, count=count)
+        policy = MEDIA_POLICIES[size.value] if size else DEFAULT_MEDIA_POLICY
+        result = await bot.get_fresh_images(interaction, 'furry', nsfw, tags, count, media_policy=policy)
         
         if not result or not result.get('images'):
             await interaction.followup.send("No furry images found. Try different tags or parameters.")
@@ -594,39 +832,63 @@ async def furry_command(
         images = result['images']
         
         embeds = []
-        for i, image in enumerate(images):
+        for image in images:
+            # The lightest variant within the size limits; the title links to the original
+            variant = select_variant(image, policy)
+            if variant is None:
+                continue
             embed = discord.Embed(
-                title=f"Furry #{i+1}" + (f" - {tags}" if tags else ""),
+                title=f"Furry #{len(embeds)+1}" + (f" - {tags}" if tags else ""),
+                url=image.url if variant.url != image.url else None,
                 color=discord.Color.purple()
             )
-            embed.set_image(url=image.get('url', ''))
+            embed.set_image(url=variant.url)
             
-            tags_list = image.get('tags') or []
-            tags_str = ', '.join([t.get('name', '') for t in tags_list if t and isinstance(t, dict)])
+            tags_str = ', '.join(image.tags)
             embed.add_field(name="Tags", value=tags_str[:100] + "..." if len(tags_str) > 100 else tags_str or "None", inline=False)
-            embed.add_field(name="Size", value=f"{image.get('width', '?')}x{image.get('height', '?')}", inline=True)
-            embed.add_field(name="Rating", value=image.get('rating', 'Unknown').upper(), inline=True)
-            embed.add_field(name="Score", value=str(image.get('score', 0)), inline=True)
+            embed.add_field(name="Size", value=f"{image.width or '?'}x{image.height or '?'}", inline=True)
+            embed.add_field(name="Rating", value=(image.rating or 'Unknown').upper(), inline=True)
+            embed.add_field(name="Score", value=str(image.score), inline=True)
             
             embed.set_footer(text="Powered by e621.net" if nsfw else "Powered by e926.net")
             
             embeds.append(embed)
         
+        if not embeds:
+            await interaction.followup.send("No furry images found in that size. Try a larger `size`.")
+            return
+        
         await interaction.followup.send(embeds=embeds)
         
     except Exception as e:
-        print(f"Error in furry command: {e}")
+        logger.exception("Error in furry command")
         await interaction.followup.send("An error occurred while fetching furry images.")
 
+@furry_command.autocomplete('tags')
+async def furry_tags_autocomplete(interaction: discord.Interaction, current: str):
+    if bot.e621_tags is None:
+        return []
+    # Completes the last of the space separated tags, most used tags first
+    return [
+        app_commands.Choice(name=query, value=query)
+        for query in bot.e621_tags.autocomplete(current, limit=25)
+        if len(query) <= 100  # Discord limit for choice names and values
+    ]
+
 if __name__ == "__main__":
+    setup_logging(LOG_LEVEL, LOG_FILE, LOG_DEBUG_SAMPLE_RATE, LOG_QUEUE_SIZE)
+    
     if not DISCORD_TOKEN:
-        print("DISCORD_TOKEN not found in environment variables!")
-        print("Create .env file based on .env.example")
+        logger.error("DISCORD_TOKEN not found in environment variables! Create .env file based on .env.example")
+        shutdown_logging()
         exit(1)
     
     try:
-        bot.run(DISCORD_TOKEN)
+        # discord.py logs through our handlers instead of installing its own
+        bot.run(DISCORD_TOKEN, log_handler=None)
     except KeyboardInterrupt:
-        print("\nBot stopped by user")
-    except Exception as e:
-        print(f"Bot startup error: {e}")
+        logger.info("Bot stopped by user")
+    except Exception:
+        logger.exception("Bot startup error")
+    finally:
+        shutdown_logging()
@@ -0,0 +1,71 @@
+import hashlib
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional
+from discord import app_commands
+from atomic_file import atomic_write
+
+logger = logging.getLogger(__name__)
+
+# Bump when the on-disk layout changes; older files are ignored
+STATE_FORMAT = 1
+
+
+def tree_fingerprint(tree: app_commands.CommandTree) -> str:
+    """Stable hash of the global commands exactly as they would be sent to Discord"""
+    payload = sorted(
+        (command.to_dict(tree) for command in tree.get_commands()),
+        key=lambda command: (command.get('type', 1), command['name'])
+    )
+    encoded = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def load_sync_state(path: str) -> Dict[str, Any]:
+    """Last synced fingerprint per application id, empty if missing or unreadable"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable command sync state", extra={'path': path, 'error': str(e)})
+        return {}
+    if not isinstance(state, dict) or state.get('format') != STATE_FORMAT:
+        return {}
+    applications = state.get('applications')
+    return applications if isinstance(applications, dict) else {}
+
+
+def save_sync_state(path: str, application_id: int, fingerprint: str):
+    """Atomically record `fingerprint` as synced for `application_id`"""
+    applications = load_sync_state(path)
+    applications[str(application_id)] = {'fingerprint': fingerprint, 'synced_at': time.time()}
+    with atomic_write(path, encoding='utf-8') as f:
+        json.dump({'format': STATE_FORMAT, 'applications': applications}, f)
+
+
+async def sync_commands(tree: app_commands.CommandTree, path: str, force: bool = False) -> Optional[List[app_commands.AppCommand]]:
+    """Sync global commands unless Discord already has this exact command tree.
+
+    Returns the synced commands, or None if the sync was skipped. The
+    fingerprint is only saved after a successful sync, so a failed one is
+    retried on the next start.
+    """
+    application_id = tree.client.application_id
+    fingerprint = tree_fingerprint(tree)
+    previous = load_sync_state(path).get(str(application_id), {})
+    if not force and previous.get('fingerprint') == fingerprint:
+        logger.info("Command tree unchanged, skipping sync", extra={'fingerprint': fingerprint[:12]})
+        return None
+
+    synced = await tree.sync()
+    try:
+        save_sync_state(path, application_id, fingerprint)
+    except OSError as e:
+        logger.warning("Could not save command sync state", extra={'path': path, 'error': str(e)})
+    logger.info("Synced commands", extra={
+        'commands': [command.name for command in synced], 'fingerprint': fingerprint[:12], 'forced': force
+    })
+    return synced
@@ -6,14 +6,115 @@ load_dotenv()
 # Bot configuration
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 WAIFU_API_TOKEN = os.getenv('WAIFU_API_TOKEN')
+# Comma-separated pool of waifu.im tokens; requests are spread over all of them
+WAIFU_API_TOKENS = [t.strip() for t in os.getenv('WAIFU_API_TOKENS', '').split(',') if t.strip()] or \
+    ([WAIFU_API_TOKEN] if WAIFU_API_TOKEN else [])
+TOKEN_QUARANTINE_UNAUTHORIZED = 3600  # seconds a token answered with 401 is left out
 
 # API URLs
 WAIFU_API_BASE_URL = 'https://api.waifu.im'
 
+# Shared upstream HTTP connection pool
+HTTP_POOL_LIMIT = 100
+HTTP_POOL_LIMIT_PER_HOST = 10
+HTTP_DNS_CACHE_TTL = 300      # seconds
+HTTP_KEEPALIVE_TIMEOUT = 60   # seconds
+HTTP_TOTAL_TIMEOUT = 20       # seconds
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 15
+
+# Response bodies at least this large are decoded off the event loop
+JSON_OFFLOAD_THRESHOLD = 64 * 1024  # bytes
+
+# Upstream rate limits: host -> (requests per second, burst)
+RATE_LIMITS = {
+    'api.waifu.im': (float(os.getenv('WAIFU_API_RATE', '1.0')), int(os.getenv('WAIFU_API_BURST', '2'))),
+    'e621.net': (float(os.getenv('E621_API_RATE', '1.0')), int(os.getenv('E621_API_BURST', '2'))),
+}
+# e926 is the SFW mirror of e621 and shares its request budget
+RATE_LIMIT_ALIASES = {'e926.net': 'e621.net'}
+DEFAULT_RATE_LIMIT = (1.0, 1)
+# Background requests (prefetch refills, tag refreshes) leave this many tokens for users
+PRIORITY_RESERVE_TOKENS = 1
+PRIORITY_AGING_SECONDS = 10.0  # a waiting request moves up one priority class this often
+
+# Upstream retries and circuit breaker
+RETRY_MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.5          # seconds, doubled per attempt with full jitter
+RETRY_MAX_DELAY = 4.0
+RETRY_MAX_RETRY_AFTER = 5.0     # longer Retry-After values fail fast instead of sleeping
+RETRY_BUDGET_RATIO = 0.2        # at most ~20% of requests may be retries
+RETRY_BUDGET_MIN_PER_SECOND = 0.5
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30.0    # seconds
+
+# Command deadlines and request hedging
+COMMAND_DEADLINE = float(os.getenv('COMMAND_DEADLINE', '10'))  # seconds a command may spend on upstream work
+HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+HEDGE_QUANTILE = 0.95           # send a second request once the first is slower than this quantile
+HEDGE_MIN_DELAY = 0.05          # seconds
+
+# Prometheus metrics endpoint (0 = disabled)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+# Logging: JSON lines written by a background thread
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FILE = os.getenv('LOG_FILE')             # also write to this file when set
+LOG_DEBUG_SAMPLE_RATE = int(os.getenv('LOG_DEBUG_SAMPLE_RATE', '100'))  # keep 1 in N debug lines per call site
+LOG_QUEUE_SIZE = 10000                      # records beyond this are dropped, never waited for
+
+# Sharding: scripts/run.py sets these for each cluster (worker process)
+# SHARD_COUNT unset = ask Discord for the recommended count
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+SHARD_IDS = [int(i) for i in os.getenv('SHARD_IDS', '').split(',') if i.strip()] or None
+CLUSTER_ID = int(os.getenv('CLUSTER_ID', '0'))
+CLUSTER_COUNT = int(os.getenv('CLUSTER_COUNT', '1'))
+
 # Bot settings
 COMMAND_PREFIX = '!'
+# Startup runs its network stages in the background; a command needing one of them
+# (e.g. the first tag catalog) waits at most this long before using fallbacks
+STARTUP_GATE_TIMEOUT = 3.0
 MAX_IMAGES_PER_REQUEST = 5
 
+# Embedded media: the lightest variant (preview, sample, original) within these limits
+# that is at least MEDIA_MIN_DIMENSION px on its longest side is shown
+MEDIA_MAX_BYTES = int(os.getenv('MEDIA_MAX_BYTES', str(4 * 1024 * 1024)))
+MEDIA_MAX_DIMENSION = int(os.getenv('MEDIA_MAX_DIMENSION', '4096'))
+MEDIA_MIN_DIMENSION = int(os.getenv('MEDIA_MIN_DIMENSION', '800'))
+MEDIA_EMBED_EXTENSIONS = ('jpg', 'jpeg', 'png', 'gif', 'webp')  # Discord can't embed webm/swf as images
+
+# Mixed-tag requests (/waifu tag:"maid, uniform") fetch every tag concurrently;
+# after this many seconds whatever has arrived is shown
+MAX_FANOUT_TAGS = 5
+FANOUT_PARTIAL_AFTER = float(os.getenv('FANOUT_PARTIAL_AFTER', '3.0'))
+
+# Prefetch pool settings
+WAIFU_PREFETCH_PAGE_SIZE = 30   # waifu.im pageSize limit
+FURRY_PREFETCH_PAGE_SIZE = 320  # e621 limit maximum
+PREFETCH_LOW_WATER = 10
+PREFETCH_MAX_KEYS = 64
+# Pools filled in the background at startup, before the first command asks
+PREFETCH_WARMUP_KEYS = [('waifu', False, None), ('furry', False, None)]
+
+# Per-channel memory of recently shown images (avoids repeats)
+RECENT_PER_CHANNEL = 200
+RECENT_MAX_CHANNELS = 5000
+
+# Local state (tag catalog, caches)
+DATA_DIR = os.getenv('DATA_DIR', 'data')
+TAG_CATALOG_PATH = os.path.join(DATA_DIR, 'tags.json')
+TAG_CATALOG_TTL = 6 * 60 * 60  # seconds before the cached catalog is refreshed
+# Fingerprint of the last synced command tree; startup skips the sync when it matches
+COMMAND_SYNC_STATE_PATH = os.path.join(DATA_DIR, 'command_sync.json')
+# e621 tag index for /furry autocomplete, built with scripts/build_e621_tags.py
+E621_TAGS_PATH = os.getenv('E621_TAGS_PATH', os.path.join(DATA_DIR, 'e621_tags.bin'))
+# Every fetched image is recorded here and served when an upstream is down or throttling
+IMAGE_STORE_PATH = os.getenv('IMAGE_STORE_PATH', os.path.join(DATA_DIR, 'images.db'))
+IMAGE_STORE_MAX_IMAGES = int(os.getenv('IMAGE_STORE_MAX_IMAGES', '200000'))
+
 # Note: Tags are now loaded dynamically from the Waifu.im API
-# The bot will automatically fetch all available tags on startup
+# The last fetched catalog is cached at TAG_CATALOG_PATH and used on startup;
+# it is refreshed in the background once older than TAG_CATALOG_TTL
 # Fallback tags are defined in bot.py if API is unavailable
@@ -0,0 +1,94 @@
+import asyncio
+import functools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Iterator, Optional, TypeVar, Union
+
+T = TypeVar('T')
+
+# An absolute time.monotonic() deadline, None for no deadline, or a callable
+# re-evaluated on every check (e.g. "the latest deadline of the commands
+# waiting on this refill")
+DeadlineSource = Union[None, float, Callable[[], Optional[float]]]
+
+_current: ContextVar[DeadlineSource] = ContextVar('upstream_deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Raised instead of doing upstream work that can no longer finish in time"""
+
+
+def current_deadline() -> DeadlineSource:
+    return _current.get()
+
+
+def resolve(source: DeadlineSource) -> Optional[float]:
+    return source() if callable(source) else source
+
+
+def time_left(source: DeadlineSource) -> Optional[float]:
+    """Seconds left before `source`'s deadline, None if unbounded"""
+    deadline = resolve(source)
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def remaining() -> Optional[float]:
+    """Seconds left for the current context, None if unbounded"""
+    return time_left(_current.get())
+
+
+def expired(source: DeadlineSource) -> bool:
+    left = time_left(source)
+    return left is not None and left <= 0
+
+
+@contextmanager
+def upstream_deadline(source: DeadlineSource) -> Iterator[None]:
+    """Bound upstream work inside the block (and tasks it creates) by `source`"""
+    token = _current.set(source)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def deadline_after(seconds: float) -> Iterator[None]:
+    """Deadline `seconds` from now, or the enclosing one if that is sooner"""
+    deadline = time.monotonic() + seconds
+    outer = resolve(_current.get())
+    if outer is not None:
+        deadline = min(deadline, outer)
+    with upstream_deadline(deadline):
+        yield
+
+
+def with_deadline(seconds: float):
+    """Decorator giving every call of a command handler a deadline"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with deadline_after(seconds):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+async def run_within_deadline(aw: Awaitable[T]) -> T:
+    """Await `aw`, cancelling it and raising DeadlineExceeded if the deadline passes first"""
+    left = remaining()
+    if left is None:
+        return await aw
+    if left <= 0:
+        if asyncio.iscoroutine(aw):
+            aw.close()
+        raise DeadlineExceeded("deadline already passed")
+    try:
+        return await asyncio.wait_for(aw, left)
+    except asyncio.TimeoutError:
+        if expired(_current.get()):
+            raise DeadlineExceeded(f"gave up after {left:.2f}s") from None
+        raise
@@ -0,0 +1,258 @@
+import bisect
+import csv
+import gzip
+import heapq
+import io
+import logging
+import mmap
+import struct
+from array import array
+from typing import IO, Iterable, List, Optional, Sequence, Tuple
+from atomic_file import atomic_write
+from tag_index import edit_distance
+
+logger = logging.getLogger(__name__)
+
+# File layout (all integers native-endian u32, checked with BYTE_ORDER_MARK):
+#   header   MAGIC, format, byte order mark, tag count, blob size
+#   offsets  count + 1 offsets into the name blob, names sorted bytewise
+#   posts    post count per tag, in name order
+#   category e621 category per tag (u8), in name order, padded to 4 bytes
+#   popular  tag numbers in name order, sorted by post count descending
+#   blob     UTF-8 names back to back
+MAGIC = b'E6TG'
+INDEX_FORMAT = 1
+BYTE_ORDER_MARK = 0x01020304
+_HEADER = struct.Struct('=4sIIII')
+
+# e621 tag categories (db_export tags-*.csv `category` column)
+CATEGORY_NAMES = {
+    0: 'general', 1: 'artist', 3: 'copyright', 4: 'character',
+    5: 'species', 6: 'invalid', 7: 'meta', 8: 'lore'
+}
+# Prefix ranges up to this size are ranked directly; larger ones walk the popularity order
+_SCAN_LIMIT = 4096
+# Query operators e621 accepts in front of a tag
+_OPERATORS = '-~'
+
+
+def _open_text(path: str) -> IO[str]:
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path, 'rb'), encoding='utf-8', newline='')
+    return open(path, 'r', encoding='utf-8', newline='')
+
+
+def read_tag_dump(path: str, min_posts: int = 1) -> Iterable[Tuple[str, int, int]]:
+    """(name, category, post_count) rows of an e621 tags CSV dump (optionally .gz)"""
+    with _open_text(path) as f:
+        for row in csv.DictReader(f):
+            try:
+                name = row['name'].strip().lower()
+                category = int(row.get('category') or 0)
+                posts = int(row.get('post_count') or 0)
+            except (KeyError, ValueError):
+                continue
+            if name and posts >= min_posts:
+                yield name, category, posts
+
+
+def build_index(rows: Iterable[Tuple[str, int, int]], path: str) -> int:
+    """Write `rows` as an index file at `path` (atomically); returns the tag count"""
+    tags = {}
+    for name, category, posts in rows:
+        # Keep the bigger entry if a dump repeats a name
+        if name not in tags or posts > tags[name][1]:
+            tags[name] = (category, posts)
+
+    encoded = sorted((name.encode('utf-8'), category, posts) for name, (category, posts) in tags.items())
+    count = len(encoded)
+
+    offsets = array('I', [0])
+    posts = array('I')
+    categories = bytearray()
+    blob = bytearray()
+    for name, category, post_count in encoded:
+        blob += name
+        offsets.append(len(blob))
+        posts.append(min(post_count, 0xFFFFFFFF))
+        categories.append(category & 0xFF)
+    categories += bytes(-len(categories) % 4)
+    popular = array('I', sorted(range(count), key=lambda i: (-posts[i], i)))
+
+    with atomic_write(path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, INDEX_FORMAT, BYTE_ORDER_MARK, count, len(blob)))
+        f.write(offsets.tobytes())
+        f.write(posts.tobytes())
+        f.write(categories)
+        f.write(popular.tobytes())
+        f.write(blob)
+    return count
+
+
+class _Names(Sequence[bytes]):
+    """Name-ordered view over the blob, so bisect can search it in place"""
+
+    def __init__(self, offsets: memoryview, blob: memoryview):
+        self._offsets = offsets
+        self._blob = blob
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> bytes:
+        return bytes(self._blob[self._offsets[i]:self._offsets[i + 1]])
+
+
+def split_query(query: str) -> Tuple[str, str, str]:
+    """Split a space separated tag query into (completed part, operator, last term)"""
+    head, _, last = query.rpartition(' ')
+    operator = last[:1] if last[:1] in _OPERATORS else ''
+    return (f'{head} ' if head else ''), operator, last[len(operator):]
+
+
+class E621TagIndex:
+    """Memory-mapped, read-only index of e621 tags.
+
+    Names are sorted bytewise, so an exact lookup or the range of names
+    sharing a prefix is a binary search over the mapped file; a second array
+    orders tags by post count for ranking. Opening the file costs nothing
+    up front: pages are read on demand and shared between bot processes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._load()
+        except Exception:
+            self._mmap.close()
+            raise
+
+    def _load(self):
+        # Validate with plain reads first: a live memoryview would keep the map from closing
+        if len(self._mmap) < _HEADER.size:
+            raise ValueError(f"{self.path}: truncated tag index")
+        magic, version, mark, count, blob_size = _HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != INDEX_FORMAT:
+            raise ValueError(f"{self.path}: not a format {INDEX_FORMAT} e621 tag index")
+        if mark != BYTE_ORDER_MARK:
+            raise ValueError(f"{self.path}: built on a machine with a different byte order")
+        sizes = ((count + 1) * 4, count * 4, count + (-count % 4), count * 4, blob_size)
+        if _HEADER.size + sum(sizes) != len(self._mmap):
+            raise ValueError(f"{self.path}: size does not match its header")
+
+        view = memoryview(self._mmap)
+        position = _HEADER.size
+        sections = []
+        for size in sizes:
+            sections.append(view[position:position + size])
+            position += size
+        offsets, posts, categories, popular, blob = sections
+        self._offsets = offsets.cast('I')
+        self._posts = posts.cast('I')
+        self._categories = categories
+        self._popular = popular.cast('I')
+        self._names = _Names(self._offsets, blob)
+
+    def close(self):
+        for name in ('_offsets', '_posts', '_popular', '_categories', '_names'):
+            self.__dict__.pop(name, None)
+        self._mmap.close()
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def _find(self, name: str) -> Optional[int]:
+        key = name.encode('utf-8')
+        i = bisect.bisect_left(self._names, key)
+        if i < len(self._names) and self._names[i] == key:
+            return i
+        return None
+
+    def __contains__(self, name: str) -> bool:
+        return self._find(name.strip().lower()) is not None
+
+    def post_count(self, name: str) -> int:
+        i = self._find(name.strip().lower())
+        return 0 if i is None else self._posts[i]
+
+    def category(self, name: str) -> Optional[str]:
+        i = self._find(name.strip().lower())
+        return None if i is None else CATEGORY_NAMES.get(self._categories[i], 'unknown')
+
+    def _prefix_range(self, prefix: str) -> Tuple[int, int]:
+        key = prefix.encode('utf-8')
+        lo = bisect.bisect_left(self._names, key)
+        # 0xFF never occurs in UTF-8, so this sorts after every name with the prefix
+        hi = bisect.bisect_left(self._names, key + b'\xff', lo)
+        return lo, hi
+
+    def _top(self, lo: int, hi: int, limit: int) -> List[int]:
+        """The `limit` most used tags among name positions lo..hi"""
+        if hi - lo <= _SCAN_LIMIT:
+            posts = self._posts
+            return heapq.nsmallest(limit, range(lo, hi), key=lambda i: (-posts[i], i))
+        # A wide range (one or two letters): its popular tags come early in the popularity order
+        found = []
+        for i in self._popular:
+            if lo <= i < hi:
+                found.append(i)
+                if len(found) >= limit:
+                    break
+        return found
+
+    def complete(self, prefix: str, limit: int = 25) -> List[str]:
+        """Most used tags starting with `prefix`, most used first"""
+        prefix = prefix.strip().lower().replace(' ', '_')
+        lo, hi = self._prefix_range(prefix) if prefix else (0, len(self._names))
+        return [self._names[i].decode('utf-8') for i in self._top(lo, hi, limit)]
+
+    def autocomplete(self, query: str, limit: int = 25) -> List[str]:
+        """Complete the last term of a space separated query, keeping the rest of it"""
+        head, operator, term = split_query(query.lower())
+        if ':' in term:
+            # Metatags (rating:s, order:score, ...) are passed through untouched
+            return [query.strip()] if query.strip() else []
+        return [f'{head}{operator}{tag}' for tag in self.complete(term, limit)]
+
+    def unknown_tags(self, query: str) -> List[str]:
+        """Terms of a tag query that no e621 post uses (metatags and wildcards are not checked)"""
+        unknown = []
+        for term in query.lower().split():
+            term = term.lstrip(_OPERATORS)
+            if not term or ':' in term or '*' in term:
+                continue
+            if self._find(term) is None:
+                unknown.append(term)
+        return unknown
+
+    def suggest(self, term: str, limit: int = 5) -> List[str]:
+        """"Did you mean" candidates: popular tags sharing the first letters, within a few edits"""
+        term = term.strip().lower()
+        if not term:
+            return []
+        # The most used tags sharing two leading letters, then one (catches swapped second letters)
+        candidates = self._top(*self._prefix_range(term[:2]), 200)
+        seen = set(candidates)
+        candidates += [i for i in self._top(*self._prefix_range(term[:1]), 200) if i not in seen]
+        max_distance = max(1, min(3, len(term) // 3))
+        scored = []
+        for rank, i in enumerate(candidates):
+            name = self._names[i].decode('utf-8')
+            distance = edit_distance(term, name, max_distance)
+            if distance is not None:
+                scored.append((distance, rank, name))
+        scored.sort()
+        return [name for _, _, name in scored[:limit]]
+
+
+def open_index(path: str) -> Optional[E621TagIndex]:
+    """Map the tag index at `path`, or None if it is missing or unusable"""
+    try:
+        return E621TagIndex(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unusable e621 tag index", extra={'path': path, 'error': str(e)})
+        return None
@@ -0,0 +1,73 @@
+import asyncio
+import json
+from typing import Any, Callable, Dict, List, Optional
+from config import JSON_OFFLOAD_THRESHOLD
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> str:
+    """Encode to a JSON string; values JSON can't represent are stringified"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=str).decode()
+    return json.dumps(obj, default=str, ensure_ascii=False)
+
+
+def _decode(body: bytes, projector: Optional[Callable[[Any], Any]]) -> Any:
+    payload = loads(body)
+    return projector(payload) if projector else payload
+
+
+async def decode_json(body: bytes, projector: Optional[Callable[[Any], Any]] = None) -> Any:
+    """Decode a response body, optionally keeping only what `projector` returns.
+
+    Large bodies are decoded and projected in a worker thread so the full
+    object tree never blocks (or lingers on) the event loop.
+    """
+    if len(body) >= JSON_OFFLOAD_THRESHOLD:
+        return await asyncio.to_thread(_decode, body, projector)
+    return _decode(body, projector)
+
+
+def project_e621_posts(payload: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+    """Strip an e621 /posts.json payload down to the fields FurryAPI converts"""
+    posts = []
+    for post in payload.get('posts', []):
+        file_info = post.get('file') or {}
+        if not file_info.get('url'):
+            continue
+        sample = post.get('sample') or {}
+        preview = post.get('preview') or {}
+        posts.append({
+            'file': {
+                'url': file_info['url'],
+                'width': file_info.get('width'),
+                'height': file_info.get('height'),
+                'ext': file_info.get('ext'),
+                'size': file_info.get('size')
+            },
+            'sample': {
+                'has': sample.get('has', False),
+                'url': sample.get('url'),
+                'width': sample.get('width'),
+                'height': sample.get('height')
+            },
+            'preview': {
+                'url': preview.get('url'),
+                'width': preview.get('width'),
+                'height': preview.get('height')
+            },
+            'tags': {'general': (post.get('tags') or {}).get('general', [])[:5]},
+            'rating': post.get('rating'),
+            'score': {'total': (post.get('score') or {}).get('total', 0)}
+        })
+    return {'posts': posts}
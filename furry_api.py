@@ -1,39 +1,80 @@
 import aiohttp
-import asyncio
-from typing import List, Optional, Dict, Any
+import logging
 import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+from deadline import DeadlineExceeded, run_within_deadline
+from fast_json import decode_json, project_e621_posts
+from hedging import HedgePolicy, hedged
+from http_client import create_session
+from image_store import ImageStore
+from metrics import DEADLINE_EXCEEDED, IMAGE_STORE_FALLBACKS, UPSTREAM_LATENCY
+from media import MEDIA_POLICIES, select_variant, url_extension
+from models import ImageRecord, MediaVariant, intern_tags
+from rate_limiter import get_limiter
+from retry import CircuitOpenError, RetryableError, UpstreamUnavailableError, get_retry_engine, parse_retry_after
+from singleflight import SingleFlight, make_key
+
+logger = logging.getLogger(__name__)
+
+def parse_tag_query(query: str) -> Tuple[List[str], List[str], List[str]]:
+    """Split an e621 tag query into (required tags, excluded tags, allowed ratings).
+
+    Other metatags, wildcards and ~ (or) terms can't be answered locally and are dropped.
+    """
+    tags, excluded, ratings, excluded_ratings = [], [], [], []
+    for term in query.lower().split():
+        negated = term.startswith('-')
+        term = term.lstrip('-')
+        if term.startswith('rating:') and term[7:8] in ('s', 'q', 'e'):
+            (excluded_ratings if negated else ratings).append(term[7])
+        elif term and ':' not in term and '*' not in term and not term.startswith('~'):
+            (excluded if negated else tags).append(term)
+    if excluded_ratings and not ratings:
+        ratings = [rating for rating in ('s', 'q', 'e') if rating not in excluded_ratings]
+    return tags, excluded, ratings
 
 class FurryAPI:
-    def __init__(self):
-        self.base_url_nsfw = "https://e621.net"
-        self.base_url_sfw = "https://e926.net"
-        self.session = None
-        self.last_request_time = 0
-        self.min_request_interval = 1.0
+    def __init__(
+        self,
+        session: Optional[aiohttp.ClientSession] = None,
+        base_url_nsfw: str = "https://e621.net",
+        base_url_sfw: str = "https://e926.net",
+        store: Optional[ImageStore] = None
+    ):
+        self.base_url_nsfw = base_url_nsfw
+        self.base_url_sfw = base_url_sfw
+        # An injected session is owned (and closed) by whoever created it
+        self.session = session
+        self._owns_session = session is None
+        # Fetched posts are recorded here and served from it when e621 fails
+        self.store = store
+        self._flights = SingleFlight('e621')
+        self._hedge = HedgePolicy()
         self.user_agent = "CatGirlDiscordBot/2.0 (by sqrilizz on GitHub)"
     
     async def __aenter__(self):
-        self.session = aiohttp.ClientSession()
+        self._ensure_session()
         return self
     
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self.session:
-            await self.session.close()
+        await self.close()
+    
+    def _ensure_session(self):
+        if not self.session:
+            self.session = create_session()
+            self._owns_session = True
     
     def _get_headers(self) -> Dict[str, str]:
         return {
             'User-Agent': self.user_agent
         }
     
-    async def _wait_for_rate_limit(self):
-        current_time = time.time()
-        time_since_last = current_time - self.last_request_time
-        
-        if time_since_last < self.min_request_interval:
-            wait_time = self.min_request_interval - time_since_last
-            await asyncio.sleep(wait_time)
-        
-        self.last_request_time = time.time()
+    async def _wait_for_rate_limit(self, base_url: str) -> float:
+        wait_time = await get_limiter(urlparse(base_url).hostname).acquire()
+        if wait_time >= 1.0:
+            logger.info("Rate limiter wait", extra={'upstream': urlparse(base_url).hostname, 'wait_s': round(wait_time, 3)})
+        return wait_time
     
     async def search_posts(
         self,
@@ -41,8 +82,7 @@ class FurryAPI:
         limit: int = 1,
         nsfw: bool = False
     ) -> Optional[Dict[str, Any]]:
-        if not self.session:
-            self.session = aiohttp.ClientSession()
+        self._ensure_session()
         
         base_url = self.base_url_nsfw if nsfw else self.base_url_sfw
         
@@ -51,96 +91,148 @@ class FurryAPI:
         }
         
         if tags:
-            params['tags'] = ' '.join(tags)
-        
-        await self._wait_for_rate_limit()
+            params['tags'] = ' '.join(sorted(tags))
         
+        # Identical concurrent searches share one upstream request
+        return await self._flights.do(
+            make_key(f'{base_url}/posts.json', params),
+            lambda: self._fetch_posts(base_url, params, nsfw)
+        )
+    
+    async def _fetch_posts(self, base_url: str, params: Dict[str, Any], nsfw: bool) -> Optional[Dict[str, Any]]:
+        logger.debug("Furry API request", extra={'url': f'{base_url}/posts.json', 'params': params})
+        # Large pages are decoded off-loop and cut down to the converted fields
         try:
-            print(f"Furry API Request: {base_url}/posts.json with params: {params}")
-            async with self.session.get(
-                f'{base_url}/posts.json',
-                params=params,
-                headers=self._get_headers()
-            ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    posts = result.get('posts', [])
-                    print(f"Furry API Success: Got {len(posts)} posts")
-                    
-                    converted_result = {'images': []}
-                    
-                    for post in posts:
-                        file_info = post.get('file', {})
-                        
-                        if not file_info.get('url'):
-                            continue
-                        
-                        converted_image = {
-                            'url': file_info.get('url'),
-                            'width': file_info.get('width'),
-                            'height': file_info.get('height'),
-                            'is_nsfw': nsfw,
-                            'tags': [{'name': tag} for tag in post.get('tags', {}).get('general', [])[:5]],
-                            'rating': post.get('rating'),
-                            'score': post.get('score', {}).get('total', 0)
-                        }
-                        converted_result['images'].append(converted_image)
-                    
-                    return converted_result
-                elif response.status == 429:
-                    error_text = await response.text()
-                    print(f"Furry API Rate Limited: {error_text}")
-                    
-                    retry_after = response.headers.get('Retry-After', '5')
-                    try:
-                        wait_time = int(retry_after)
-                    except:
-                        wait_time = 5
-                    
-                    print(f"Waiting {wait_time} seconds before retry...")
-                    await asyncio.sleep(wait_time)
-                    
-                    async with self.session.get(
-                        f'{base_url}/posts.json',
-                        params=params,
-                        headers=self._get_headers()
-                    ) as retry_response:
-                        if retry_response.status == 200:
-                            result = await retry_response.json()
-                            posts = result.get('posts', [])
-                            print(f"Furry API Success (retry): Got {len(posts)} posts")
-                            
-                            converted_result = {'images': []}
-                            
-                            for post in posts:
-                                file_info = post.get('file', {})
-                                
-                                if not file_info.get('url'):
-                                    continue
-                                
-                                converted_image = {
-                                    'url': file_info.get('url'),
-                                    'width': file_info.get('width'),
-                                    'height': file_info.get('height'),
-                                    'is_nsfw': nsfw,
-                                    'tags': [{'name': tag} for tag in post.get('tags', {}).get('general', [])[:5]],
-                                    'rating': post.get('rating'),
-                                    'score': post.get('score', {}).get('total', 0)
-                                }
-                                converted_result['images'].append(converted_image)
-                            
-                            return converted_result
-                        else:
-                            error_text = await retry_response.text()
-                            print(f"Furry API Error (retry): {retry_response.status} - {error_text}")
-                            return None
-                else:
+            result = await self._get_json(
+                base_url, '/posts.json', params, projector=project_e621_posts,
+                raise_unavailable=self.store is not None
+            )
+        except UpstreamUnavailableError:
+            return await self._search_store(params, nsfw)
+        if result is None:
+            return None
+        
+        posts = result.get('posts', [])
+        logger.debug("Furry API success", extra={'url': f'{base_url}/posts.json', 'posts': len(posts)})
+        
+        converted_result = {'images': []}
+        for post in posts:
+            converted_image = self._convert_post(post, nsfw)
+            if converted_image:
+                converted_result['images'].append(converted_image)
+        
+        if self.store is not None:
+            tags, _, _ = parse_tag_query(params.get('tags', ''))
+            self.store.record('e621', converted_result['images'], tags)
+        return converted_result
+    
+    async def _search_store(self, params: Dict[str, Any], nsfw: bool) -> Optional[Dict[str, Any]]:
+        tags, excluded, ratings = parse_tag_query(params.get('tags', ''))
+        # e926 results are safe for any channel; e621 results only for NSFW ones
+        images = await self.store.random_images(
+            'e621', tags, excluded, nsfw=None if nsfw else False, ratings=ratings, count=params['limit']
+        )
+        IMAGE_STORE_FALLBACKS.inc(source='e621', result='hit' if images else 'empty')
+        logger.info("Serving furry images from the local store", extra={'params': params, 'images': len(images)})
+        return {'images': images} if images else None
+    
+    @staticmethod
+    def _convert_post(post: Dict[str, Any], nsfw: bool) -> Optional[ImageRecord]:
+        file_info = post.get('file') or {}
+        
+        if not file_info.get('url'):
+            return None
+        
+        # Lighter renditions for embeds: the sample (~850px jpg, also the still of a video), then the preview
+        variants = []
+        for kind in ('sample', 'preview'):
+            info = post.get(kind) or {}
+            if info.get('url') and (kind != 'sample' or info.get('has')):
+                variants.append(MediaVariant(
+                    kind, info['url'], info.get('width'), info.get('height'), url_extension(info['url'])
+                ))
+        
+        image = ImageRecord(
+            url=file_info['url'],
+            width=file_info.get('width'),
+            height=file_info.get('height'),
+            is_nsfw=nsfw,
+            tags=intern_tags((post.get('tags') or {}).get('general', [])[:5]),
+            rating=post.get('rating'),
+            score=(post.get('score') or {}).get('total', 0),
+            ext=file_info.get('ext'),
+            size=file_info.get('size'),
+            variants=tuple(variants)
+        )
+        # A flash or video post without a still can't be shown at all: don't let it take a slot
+        if select_variant(image, MEDIA_POLICIES['original']) is None:
+            return None
+        return image
+    
+    async def _get_json(
+        self,
+        base_url: str,
+        path: str,
+        params: Optional[Dict[str, Any]] = None,
+        projector: Optional[Callable[[Any], Any]] = None,
+        raise_unavailable: bool = False
+    ) -> Optional[Any]:
+        """GET an e621/e926 endpoint through the rate limiter and retry engine.
+        
+        Failed requests return None, or raise UpstreamUnavailableError with `raise_unavailable`.
+        """
+        url = f'{base_url}{path}'
+        
+        host = urlparse(base_url).hostname
+        
+        async def attempt():
+            await self._wait_for_rate_limit(base_url)
+            # A hedge only goes out if the limiter has a spare token
+            return await run_within_deadline(hedged(
+                request, self._hedge.delay(url), get_limiter(host).try_acquire, name=host
+            ))
+        
+        async def request():
+            started = time.perf_counter()
+            status = 'error'
+            try:
+                async with self.session.get(url, params=params, headers=self._get_headers()) as response:
+                    status = str(response.status)
+                    if response.status == 200:
+                        return await decode_json(await response.read(), projector)
                     error_text = await response.text()
-                    print(f"Furry API Error: {response.status} - {error_text}")
+                    if response.status == 429 or response.status >= 500:
+                        retry_after = None
+                        if response.status == 429:
+                            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                        raise RetryableError(
+                            f"{response.status} - {error_text}",
+                            status=response.status,
+                            retry_after=retry_after
+                        )
+                    logger.warning("Furry API error", extra={'url': url, 'status': response.status, 'body': error_text[:500]})
                     return None
+            finally:
+                elapsed = time.perf_counter() - started
+                UPSTREAM_LATENCY.observe(elapsed, upstream=host, endpoint=path, status=status)
+                if status == '200':
+                    self._hedge.observe(url, elapsed)
+        
+        try:
+            return await get_retry_engine(host).run(attempt)
+        except CircuitOpenError as e:
+            logger.warning("Furry API request skipped", extra={'url': url, 'error': str(e)})
+            error = e
+        except DeadlineExceeded as e:
+            DEADLINE_EXCEEDED.inc(upstream=host)
+            logger.info("Furry API request dropped past its deadline", extra={'url': url, 'error': str(e)})
+            error = e
         except Exception as e:
-            print(f"Furry API request failed: {e}")
-            return None
+            logger.error("Furry API request failed", extra={'url': url, 'error': repr(e)})
+            error = e
+        if raise_unavailable:
+            raise UpstreamUnavailableError(str(error)) from error
+        return None
     
     async def get_random_furry(self, nsfw: bool = False, count: int = 1) -> Optional[Dict[str, Any]]:
         tags = ['order:random']
@@ -151,5 +243,6 @@ class FurryAPI:
         return await self.search_posts(tags=search_tags, limit=count, nsfw=nsfw)
     
     async def close(self):
-        if self.session:
+        if self.session and self._owns_session:
             await self.session.close()
+            self.session = None
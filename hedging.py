@@ -0,0 +1,94 @@
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, TypeVar
+from config import HEDGE_ENABLED, HEDGE_QUANTILE, HEDGE_MIN_DELAY
+from metrics import HEDGED_REQUESTS
+
+T = TypeVar('T')
+
+
+class LatencyTracker:
+    """Rolling latency quantile over the most recent successful requests"""
+
+    def __init__(self, quantile: float = 0.95, window: int = 256, min_samples: int = 20):
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._cached: Optional[float] = None
+        self._since_cached = 0
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+        self._since_cached += 1
+
+    def value(self) -> Optional[float]:
+        """The tracked quantile, or None until there are enough samples"""
+        if len(self._samples) < self.min_samples:
+            return None
+        # Re-sort at most every few samples; the quantile moves slowly
+        if self._cached is None or self._since_cached >= 16:
+            ordered = sorted(self._samples)
+            self._cached = ordered[min(len(ordered) - 1, int(self.quantile * len(ordered)))]
+            self._since_cached = 0
+        return self._cached
+
+
+class HedgePolicy:
+    """Per-endpoint latency tracking that decides when to send a hedged request"""
+
+    def __init__(self, enabled: bool = HEDGE_ENABLED, quantile: float = HEDGE_QUANTILE, min_delay: float = HEDGE_MIN_DELAY):
+        self.enabled = enabled
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self._trackers: Dict[str, LatencyTracker] = {}
+
+    def observe(self, endpoint: str, seconds: float):
+        tracker = self._trackers.get(endpoint)
+        if tracker is None:
+            tracker = self._trackers[endpoint] = LatencyTracker(self.quantile)
+        tracker.observe(seconds)
+
+    def delay(self, endpoint: str) -> Optional[float]:
+        """How long to wait before hedging, None to never hedge"""
+        tracker = self._trackers.get(endpoint)
+        if not self.enabled or tracker is None:
+            return None
+        value = tracker.value()
+        return None if value is None else max(self.min_delay, value)
+
+
+async def hedged(
+    call: Callable[[], Awaitable[T]],
+    delay: Optional[float],
+    try_spare: Callable[[], bool],
+    name: str = ''
+) -> T:
+    """Run `call`; if it is still going after `delay`, race a second copy of it.
+
+    The second call is only made if `try_spare()` grants it spare upstream
+    budget. The first successful result wins and the other call is cancelled.
+    """
+    first = asyncio.ensure_future(call())
+    if delay is None:
+        return await first
+    second = None
+    try:
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done or not try_spare():
+            return await first
+
+        second = asyncio.ensure_future(call())
+        pending = {first, second}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and task.exception() is None:
+                    HEDGED_REQUESTS.inc(upstream=name, winner='first' if task is first else 'hedge')
+                    return task.result()
+        # Both failed: report the original request's error
+        HEDGED_REQUESTS.inc(upstream=name, winner='none')
+        return first.result()
+    finally:
+        for task in (first, second):
+            if task is not None and not task.done():
+                task.cancel()
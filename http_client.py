@@ -0,0 +1,62 @@
+import asyncio
+import aiohttp
+from typing import Iterable, Optional
+from config import (
+    HTTP_POOL_LIMIT, HTTP_POOL_LIMIT_PER_HOST, HTTP_DNS_CACHE_TTL,
+    HTTP_KEEPALIVE_TIMEOUT, HTTP_TOTAL_TIMEOUT, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+)
+
+
+def create_session() -> aiohttp.ClientSession:
+    """Create a ClientSession with a connector tuned for a few long-lived upstreams"""
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        use_dns_cache=True,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=HTTP_TOTAL_TIMEOUT,
+        connect=HTTP_CONNECT_TIMEOUT,
+        sock_read=HTTP_READ_TIMEOUT
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+class UpstreamHTTP:
+    """Bot-owned HTTP layer whose session is shared by every upstream client"""
+
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = create_session()
+        return self._session
+
+    async def warmup(self, urls: Iterable[str], timeout: float = 5.0) -> bool:
+        """Resolve DNS and open a pooled keep-alive connection to each upstream.
+
+        The first command then skips the DNS lookup and TLS handshake.
+        A HEAD of the site root does not touch the API or its rate limit.
+        """
+        session = await self.start()
+
+        async def touch(url: str):
+            async with session.head(url, allow_redirects=False, timeout=aiohttp.ClientTimeout(total=timeout)):
+                pass
+
+        results = await asyncio.gather(*(touch(url) for url in urls), return_exceptions=True)
+        return not any(isinstance(result, Exception) for result in results)
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            raise RuntimeError("UpstreamHTTP.start() has not been called")
+        return self._session
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
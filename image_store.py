@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence
+from fast_json import dumps, loads
+from models import ImageRecord, MediaVariant, intern_tags
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    url TEXT NOT NULL UNIQUE,
+    width INTEGER,
+    height INTEGER,
+    is_nsfw INTEGER NOT NULL,
+    tags TEXT NOT NULL,
+    dominant_color TEXT,
+    artist TEXT,
+    rating TEXT,
+    score INTEGER NOT NULL DEFAULT 0,
+    ext TEXT,
+    size INTEGER,
+    variants TEXT,
+    seen_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_by_source ON images (source, is_nsfw);
+CREATE INDEX IF NOT EXISTS images_by_age ON images (seen_at);
+CREATE TABLE IF NOT EXISTS tags (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+-- The inverted index: tag -> images carrying it
+CREATE TABLE IF NOT EXISTS image_tags (
+    tag_id INTEGER NOT NULL,
+    image_id INTEGER NOT NULL,
+    PRIMARY KEY (tag_id, image_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS image_tags_by_image ON image_tags (image_id);
+"""
+
+_COLUMNS = 'url, width, height, is_nsfw, tags, dominant_color, artist, rating, score, ext, size, variants'
+
+
+class ImageStore:
+    """Local SQLite copy of the image metadata the upstreams have returned.
+
+    Every page fetched from an upstream is recorded with an inverted tag
+    index, so "random images with tags X and Y" can be answered locally
+    while an upstream is throttling us or its circuit is open. All SQLite
+    work runs on one dedicated thread; writes are fire-and-forget. Cluster
+    processes may share the file: writes upsert and eviction counts the
+    table inside its own write transaction.
+    """
+
+    def __init__(self, path: str, max_images: int = 200_000):
+        self.path = path
+        self.max_images = max_images
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='image-store')
+        self._conn: Optional[sqlite3.Connection] = None
+        self._closed = False
+
+    # --- worker thread ---
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Transactions are explicit, see _record
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _record(self, source: str, images: Sequence[ImageRecord], extra_tags: Sequence[str]):
+        conn = self._connect()
+        now = time.time()
+        # Take the write lock up front: a deferred transaction that reads first can't
+        # upgrade once another cluster process has written, and would fail with SQLITE_BUSY
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for image in images:
+                variants = dumps([list(variant) for variant in image.variants]) if image.variants else None
+                conn.execute(
+                    f'INSERT INTO images (source, {_COLUMNS}, seen_at) VALUES ({", ".join("?" * 14)}) '
+                    f'ON CONFLICT (url) DO UPDATE SET seen_at = excluded.seen_at, score = excluded.score',
+                    (source, image.url, image.width, image.height, int(image.is_nsfw), ' '.join(image.tags),
+                     image.dominant_color, image.artist, image.rating, image.score,
+                     image.ext, image.size, variants, now)
+                )
+                image_id = conn.execute('SELECT id FROM images WHERE url = ?', (image.url,)).fetchone()[0]
+                # The query's own tags are indexed too: e621 pages only carry a few display tags
+                names = set(image.tags) | set(extra_tags)
+                if not names:
+                    continue
+                conn.executemany('INSERT OR IGNORE INTO tags (name) VALUES (?)', ((name,) for name in names))
+                conn.execute(
+                    f'INSERT OR IGNORE INTO image_tags (tag_id, image_id) '
+                    f'SELECT id, ? FROM tags WHERE name IN ({",".join("?" * len(names))})',
+                    (image_id, *names)
+                )
+            self._evict(conn)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _evict(self, conn: sqlite3.Connection):
+        # Counted inside the write transaction, so images other processes added are included
+        excess = conn.execute('SELECT COUNT(*) FROM images').fetchone()[0] - self.max_images
+        if excess <= 0:
+            return
+        # Drop the least recently seen images in chunks, not one per insert
+        excess += self.max_images // 20
+        oldest = 'SELECT id FROM images ORDER BY seen_at LIMIT ?'
+        conn.execute(f'DELETE FROM image_tags WHERE image_id IN ({oldest})', (excess,))
+        conn.execute(f'DELETE FROM images WHERE id IN ({oldest})', (excess,))
+
+    def _random(
+        self,
+        source: str,
+        tags: Sequence[str],
+        excluded: Sequence[str],
+        nsfw: Optional[bool],
+        ratings: Sequence[str],
+        count: int
+    ) -> List[ImageRecord]:
+        conn = self._connect()
+        sql = [f'SELECT {_COLUMNS} FROM images WHERE source = ?']
+        args: List[Any] = [source]
+        if nsfw is not None:
+            sql.append('AND is_nsfw = ?')
+            args.append(int(nsfw))
+        if ratings:
+            sql.append(f'AND rating IN ({",".join("?" * len(ratings))})')
+            args.extend(ratings)
+        tag_ids = {}
+        if tags or excluded:
+            names = list(set(tags) | set(excluded))
+            tag_ids = dict(conn.execute(
+                f'SELECT name, id FROM tags WHERE name IN ({",".join("?" * len(names))})', names
+            ).fetchall())
+        for tag in tags:
+            if tag not in tag_ids:
+                # Nothing was ever recorded with this tag
+                return []
+            sql.append('AND id IN (SELECT image_id FROM image_tags WHERE tag_id = ?)')
+            args.append(tag_ids[tag])
+        for tag in excluded:
+            if tag in tag_ids:
+                sql.append('AND id NOT IN (SELECT image_id FROM image_tags WHERE tag_id = ?)')
+                args.append(tag_ids[tag])
+        sql.append('ORDER BY random() LIMIT ?')
+        args.append(count)
+
+        return [
+            ImageRecord(
+                url=url, width=width, height=height, is_nsfw=bool(is_nsfw),
+                tags=intern_tags(tag_text.split()), dominant_color=dominant_color,
+                artist=artist, rating=rating, score=score, ext=ext, size=size,
+                variants=tuple(MediaVariant(*variant) for variant in loads(variants)) if variants else ()
+            )
+            for url, width, height, is_nsfw, tag_text, dominant_color, artist, rating, score, ext, size, variants
+            in conn.execute(' '.join(sql), args)
+        ]
+
+    def _stats(self) -> Dict[str, int]:
+        conn = self._connect()
+        return {
+            'images': conn.execute('SELECT COUNT(*) FROM images').fetchone()[0],
+            'tags': conn.execute('SELECT COUNT(*) FROM tags').fetchone()[0]
+        }
+
+    def _shutdown(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    # --- event loop side ---
+
+    async def _run(self, func: Callable, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def open(self):
+        """Create the database and schema; raises sqlite3.Error or OSError if the file is unusable"""
+        await self._run(self._connect)
+
+    def record(self, source: str, images: Iterable[ImageRecord], extra_tags: Iterable[str] = ()):
+        """Queue a fetched page for storage without waiting for the write"""
+        images = list(images)
+        if not images or self._closed:
+            return
+        future = self._executor.submit(self._record, source, images, tuple(extra_tags))
+        future.add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(future: Future):
+        error = future.exception()
+        if error is not None:
+            logger.warning("Failed to record images", extra={'error': repr(error)})
+
+    async def random_images(
+        self,
+        source: str,
+        tags: Sequence[str] = (),
+        excluded: Sequence[str] = (),
+        nsfw: Optional[bool] = None,
+        ratings: Sequence[str] = (),
+        count: int = 1
+    ) -> List[ImageRecord]:
+        """Random stored images of `source` carrying every tag in `tags` and none in `excluded`"""
+        if self._closed:
+            return []
+        return await self._run(self._random, source, tuple(tags), tuple(excluded), nsfw, tuple(ratings), count)
+
+    async def stats(self) -> Dict[str, int]:
+        return await self._run(self._stats)
+
+    async def close(self):
+        """Finish queued writes and close the database"""
+        if self._closed:
+            return
+        self._closed = True
+        await self._run(self._shutdown)
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,69 @@
+from typing import Dict, FrozenSet, Iterable, NamedTuple, Optional
+from config import MEDIA_EMBED_EXTENSIONS, MEDIA_MAX_BYTES, MEDIA_MAX_DIMENSION, MEDIA_MIN_DIMENSION
+from models import ImageRecord, MediaVariant
+
+
+def url_extension(url: str) -> Optional[str]:
+    """File extension of a media URL, lowercased"""
+    path = url.split('?', 1)[0]
+    name = path.rsplit('/', 1)[-1]
+    return name.rsplit('.', 1)[-1].lower() if '.' in name else None
+
+
+class MediaPolicy(NamedTuple):
+    """Limits a variant must fit to be embedded; None means unlimited.
+    
+    `min_dimension` is the smallest longest side worth showing; None asks for
+    the fullest variant that fits instead of the lightest.
+    """
+    max_bytes: Optional[int] = MEDIA_MAX_BYTES
+    max_dimension: Optional[int] = MEDIA_MAX_DIMENSION
+    extensions: FrozenSet[str] = frozenset(MEDIA_EMBED_EXTENSIONS)
+    min_dimension: Optional[int] = MEDIA_MIN_DIMENSION
+
+    def accepts(self, variant: MediaVariant) -> bool:
+        ext = variant.ext or url_extension(variant.url)
+        if ext not in self.extensions:
+            return False
+        # Unknown sizes pass: only e621 originals report a byte size
+        if self.max_bytes is not None and variant.size is not None and variant.size > self.max_bytes:
+            return False
+        if self.max_dimension is not None:
+            for side in (variant.width, variant.height):
+                if side is not None and side > self.max_dimension:
+                    return False
+        return True
+
+
+# Per-command choices for /furry's `size` option
+MEDIA_POLICIES: Dict[str, MediaPolicy] = {
+    'original': MediaPolicy(max_bytes=None, max_dimension=None, min_dimension=None),
+    'balanced': MediaPolicy(),
+    'small': MediaPolicy(max_bytes=1024 * 1024, max_dimension=1280, min_dimension=400)
+}
+DEFAULT_MEDIA_POLICY = MEDIA_POLICIES['balanced']
+
+
+def variants(image: ImageRecord) -> Iterable[MediaVariant]:
+    """The original file, then the image's lighter variants"""
+    yield MediaVariant('original', image.url, image.width, image.height, image.ext, image.size)
+    yield from image.variants
+
+
+def _longest_side(variant: MediaVariant) -> int:
+    return max(variant.width or 0, variant.height or 0)
+
+
+def select_variant(image: ImageRecord, policy: MediaPolicy = DEFAULT_MEDIA_POLICY) -> Optional[MediaVariant]:
+    """The lightest variant that fits `policy` and is still `min_dimension` large:
+    the preview, then the sample, then the original. If none is that large, the
+    fullest one that fits. None if nothing can be embedded.
+    """
+    fitting = [variant for variant in variants(image) if policy.accepts(variant)]
+    if not fitting:
+        return None
+    if policy.min_dimension is not None:
+        for variant in reversed(fitting):
+            if _longest_side(variant) >= policy.min_dimension:
+                return variant
+    return fitting[0]
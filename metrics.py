@@ -0,0 +1,272 @@
+import functools
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _escape_help(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {_escape_help(self.documentation)}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> List[str]:
+        return [
+            f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+        self._functions: Dict[LabelValues, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, fn: Callable[[], float], **labels):
+        """Compute the value at scrape time (e.g. current pool size)"""
+        self._functions[self._key(labels)] = fn
+
+    @contextmanager
+    def track_inprogress(self, **labels) -> Iterator[None]:
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self) -> List[str]:
+        values = dict(self._values)
+        for key, fn in self._functions.items():
+            try:
+                values[key] = float(fn())
+            except Exception:
+                continue
+        return [
+            f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+            for key, value in values.items()
+        ]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # labels -> [bucket counts..., sum, count]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = [0.0] * (len(self.buckets) + 2)
+            self._values[key] = state
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+                break
+        state[-2] += value
+        state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, state in self._values.items():
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {_format_value(cumulative)}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(state[-2])}')
+            lines.append(f'{self.name}_count{labels} {_format_value(state[-1])}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, cls, name: str, documentation: str, labelnames: Sequence[str], **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = cls(name, documentation, labelnames, **kwargs)
+            self._metrics[name] = metric
+        elif not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} already registered as {metric.kind}")
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)"""
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+# Upstream HTTP
+UPSTREAM_LATENCY = REGISTRY.histogram(
+    'upstream_request_seconds', 'Upstream HTTP request latency', ('upstream', 'endpoint', 'status'))
+RATE_LIMIT_WAIT = REGISTRY.histogram(
+    'rate_limit_wait_seconds', 'Time spent waiting for an upstream rate-limit token', ('upstream', 'priority'),
+    buckets=(0, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+RATE_LIMIT_DROPPED = REGISTRY.counter(
+    'rate_limit_dropped_total', 'Queued upstream requests dropped because their deadline passed', ('upstream',))
+HEDGED_REQUESTS = REGISTRY.counter(
+    'upstream_hedged_requests_total', 'Second requests sent after the first exceeded the latency quantile',
+    ('upstream', 'winner'))
+DEADLINE_EXCEEDED = REGISTRY.counter(
+    'upstream_deadline_exceeded_total', 'Upstream calls abandoned because the command deadline passed', ('upstream',))
+UPSTREAM_RETRIES = REGISTRY.counter(
+    'upstream_retries_total', 'Upstream requests retried by the retry engine', ('upstream', 'reason'))
+CIRCUIT_FAST_FAILURES = REGISTRY.counter(
+    'upstream_circuit_open_total', 'Upstream calls rejected because the circuit was open', ('upstream',))
+TOKENS_AVAILABLE = REGISTRY.gauge(
+    'upstream_tokens_available', 'API tokens not currently quarantined', ('upstream',))
+TOKEN_QUARANTINES = REGISTRY.counter(
+    'upstream_token_quarantines_total', 'API tokens quarantined after a 401/429', ('upstream', 'reason'))
+SINGLEFLIGHT_CALLS = REGISTRY.counter(
+    'singleflight_calls_total', 'Upstream calls started vs. coalesced onto an in-flight call', ('client', 'result'))
+
+# Caches
+PREFETCH_REQUESTS = REGISTRY.counter(
+    'prefetch_requests_total', 'Image requests served from the pool (hit) or that waited for a refill (miss)',
+    ('source', 'result'))
+PREFETCH_REFILLS = REGISTRY.counter(
+    'prefetch_refills_total', 'Prefetch pool refills by outcome', ('source', 'result'))
+PREFETCH_POOL_IMAGES = REGISTRY.gauge(
+    'prefetch_pool_images', 'Images currently held by the prefetch pool')
+IMAGE_STORE_FALLBACKS = REGISTRY.counter(
+    'image_store_fallbacks_total', 'Searches answered from the local image store because the upstream failed',
+    ('source', 'result'))
+
+# Interactions
+INTERACTIONS_IN_FLIGHT = REGISTRY.gauge(
+    'interactions_in_flight', 'Slash-command interactions currently being handled', ('command',))
+COMMAND_LATENCY = REGISTRY.histogram(
+    'command_seconds', 'End-to-end slash-command handling time', ('command',))
+FANOUT_REQUESTS = REGISTRY.counter(
+    'fanout_requests_total', 'Mixed-tag requests by whether every tag arrived in time', ('result',))
+
+# Startup
+STARTUP_STAGE_SECONDS = REGISTRY.gauge(
+    'startup_stage_seconds', 'How long each startup stage took to finish', ('stage',))
+
+# Logging
+LOG_RECORDS_DROPPED = REGISTRY.counter(
+    'log_records_dropped_total', 'Log records dropped because the log queue was full')
+
+
+def track_command(command: str):
+    """Decorator counting in-flight interactions and their latency for a command handler"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with INTERACTIONS_IN_FLIGHT.track_inprogress(command=command), COMMAND_LATENCY.time(command=command):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=REGISTRY.render().encode('utf-8'),
+                        headers={'Content-Type': CONTENT_TYPE, 'X-Content-Type-Options': 'nosniff'})
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """Serve /metrics for Prometheus on host:port"""
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Metrics endpoint started", extra={'url': f'http://{host}:{port}/metrics'})
+    return runner
@@ -0,0 +1,34 @@
+import sys
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+
+def intern_tags(tags: Iterable[str]) -> Tuple[str, ...]:
+    """Tags repeat across thousands of images, so share one string per tag"""
+    return tuple(sys.intern(tag) for tag in tags if tag)
+
+
+class MediaVariant(NamedTuple):
+    """One rendition of an image: the original file, or a lighter sample/preview"""
+    kind: str
+    url: str
+    width: Optional[int] = None
+    height: Optional[int] = None
+    ext: Optional[str] = None
+    size: Optional[int] = None  # bytes, when the upstream reports it
+
+
+class ImageRecord(NamedTuple):
+    """Immutable, tuple-backed image returned by every provider"""
+    url: str
+    width: Optional[int] = None
+    height: Optional[int] = None
+    is_nsfw: bool = False
+    tags: Tuple[str, ...] = ()
+    dominant_color: Optional[str] = None
+    artist: Optional[str] = None
+    rating: Optional[str] = None
+    score: int = 0
+    # Original file type and size; `variants` are lighter renditions, largest first
+    ext: Optional[str] = None
+    size: Optional[int] = None
+    variants: Tuple[MediaVariant, ...] = ()
@@ -0,0 +1,297 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+from deadline import current_deadline, remaining, resolve as resolve_deadline, upstream_deadline
+from metrics import PREFETCH_REFILLS, PREFETCH_REQUESTS
+from priority import INTERACTIVE, REFILL, upstream_priority
+
+logger = logging.getLogger(__name__)
+
+# fetcher(nsfw, tag, page_size) -> {'images': [...]} or None
+Fetcher = Callable[[bool, Optional[str], int], Awaitable[Optional[Dict[str, Any]]]]
+PoolKey = Tuple[str, bool, Optional[str]]
+
+
+class _Waiter:
+    """A command waiting for a pool to be refilled"""
+
+    __slots__ = ('count', 'exclude', 'reject', 'images', 'skipped', 'future', 'fruitless', 'deadline')
+
+    def __init__(self, count: int, exclude, reject, images: List[Any], skipped: List[Any]):
+        self.count = count
+        self.exclude = exclude
+        self.reject = reject
+        self.images = images
+        self.skipped = skipped
+        self.future = asyncio.get_running_loop().create_future()
+        self.fruitless = 0
+        # The command's own deadline, which bounds the refill it waits on
+        self.deadline = current_deadline()
+
+    def resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class PrefetchPool:
+    """In-memory pool of pre-fetched images per (source, nsfw, tag).
+
+    Commands are served from the pool; full upstream pages are fetched in the
+    background whenever a pool drops below its low-water mark. Commands that
+    find a pool short queue up in arrival order and are handed images as
+    refills land, so a burst larger than one page is served page by page.
+    """
+
+    def __init__(self, low_water: int = 10, max_keys: int = 64, max_refill_waits: int = 2):
+        self.low_water = low_water
+        self.max_keys = max_keys
+        # Refills a queued command sits through without getting enough usable images
+        self.max_refill_waits = max_refill_waits
+        self._sources: Dict[str, Tuple[Fetcher, int]] = {}
+        self._pools: "OrderedDict[PoolKey, Deque[Any]]" = OrderedDict()
+        self._waiters: Dict[PoolKey, Deque[_Waiter]] = {}
+        self._refills: Dict[PoolKey, asyncio.Task] = {}
+        self._closed = False
+
+    def register_source(self, source: str, fetcher: Fetcher, page_size: int):
+        self._sources[source] = (fetcher, page_size)
+
+    def _normalize_key(self, source: str, nsfw: bool, tag: Optional[str]) -> PoolKey:
+        if tag:
+            tag = ' '.join(sorted(tag.lower().split())) or None
+        return (source, nsfw, tag)
+
+    def _get_pool(self, key: PoolKey) -> Deque[Any]:
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = deque()
+            self._pools[key] = pool
+            while len(self._pools) > self.max_keys:
+                evicted, _ = self._pools.popitem(last=False)
+                task = self._refills.pop(evicted, None)
+                if task:
+                    task.cancel()
+                self._release_waiters(evicted)
+        else:
+            self._pools.move_to_end(key)
+        return pool
+
+    def _release_waiters(self, key: PoolKey):
+        """Wake every queued command for `key` with whatever it has so far"""
+        for waiter in self._waiters.pop(key, ()):
+            waiter.resolve()
+
+    def _schedule_refill(self, key: PoolKey) -> asyncio.Task:
+        task = self._refills.get(key)
+        if task is None or task.done():
+            task = asyncio.create_task(self._refill(key))
+            self._refills[key] = task
+        return task
+
+    async def _refill(self, key: PoolKey) -> bool:
+        source, nsfw, tag = key
+        fetcher, page_size = self._sources[source]
+        # Background work until a command queues up on this pool, then it is what the user waits on
+        priority = lambda: INTERACTIVE if self._waiters.get(key) else REFILL
+        try:
+            with upstream_priority(priority), upstream_deadline(lambda: self._waiters_deadline(key)):
+                result = await fetcher(nsfw, tag, page_size)
+        except Exception as e:
+            logger.warning("Prefetch refill failed", extra={'pool': key, 'error': repr(e)})
+            result = None
+        finally:
+            if self._refills.get(key) is asyncio.current_task():
+                del self._refills[key]
+
+        added = 0
+        pool = self._pools.get(key)
+        if pool is not None and result and result.get('images'):
+            seen = {image.url for image in pool}
+            for image in result['images']:
+                if image.url not in seen:
+                    pool.append(image)
+                    seen.add(image.url)
+                    added += 1
+
+        PREFETCH_REFILLS.inc(source=source, result='ok' if added else ('empty' if result else 'error'))
+        self._serve_waiters(key, refilled=added > 0)
+        return added > 0
+
+    def _waiters_deadline(self, key: PoolKey) -> Optional[float]:
+        """Latest deadline among the commands queued on `key`, None if any is unbounded"""
+        waiters = self._waiters.get(key)
+        if not waiters:
+            return None
+        deadlines = [resolve_deadline(waiter.deadline) for waiter in waiters]
+        if None in deadlines:
+            return None
+        return max(deadlines)
+
+    def _serve_waiters(self, key: PoolKey, refilled: bool):
+        waiters = self._waiters.get(key)
+        if not waiters:
+            return
+        pool = self._pools.get(key)
+        if pool is None or not refilled or self._closed:
+            # Upstream failed or had nothing new: don't keep commands hanging
+            self._release_waiters(key)
+            return
+
+        while waiters:
+            waiter = waiters[0]
+            waiter.images.extend(self._take(
+                pool, waiter.count - len(waiter.images), waiter.exclude, waiter.reject, waiter.skipped,
+                taken={image.url for image in waiter.images}
+            ))
+            if len(waiter.images) >= waiter.count:
+                waiters.popleft()
+                waiter.resolve()
+                continue
+            # The head of the queue is still short; it gets a bounded number of refills
+            waiter.fruitless += 1
+            if waiter.fruitless > self.max_refill_waits:
+                waiters.popleft()
+                waiter.resolve()
+                continue
+            break
+
+        if waiters:
+            self._schedule_refill(key)
+        else:
+            self._waiters.pop(key, None)
+
+    def _take(
+        self,
+        pool: Deque[Any],
+        count: int,
+        exclude: Optional[Callable[[Any], bool]],
+        reject: Optional[Callable[[Any], bool]],
+        skipped: List[Any],
+        taken: Optional[Set[str]] = None
+    ) -> List[Any]:
+        images = []
+        # Scan each image at most once; excluded, rejected and already `taken` ones
+        # (a refill can bring back an image the caller holds) go back for other callers
+        for _ in range(len(pool)):
+            if len(images) >= count:
+                break
+            image = pool.popleft()
+            if (reject is not None and reject(image)) or (taken and image.url in taken):
+                pool.append(image)
+            elif exclude is not None and exclude(image):
+                skipped.append(image)
+                pool.append(image)
+            else:
+                images.append(image)
+        return images
+
+    async def get_images(
+        self,
+        source: str,
+        nsfw: bool,
+        tag: Optional[str],
+        count: int,
+        exclude: Optional[Callable[[Any], bool]] = None,
+        reject: Optional[Callable[[Any], bool]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Take up to `count` images from the pool, waiting for a refill if it is short.
+
+        Images for which `exclude` returns True (e.g. already seen in the
+        channel) are left in the pool, and more pages are fetched to replace
+        them; they are only served as a last resort. Images for which `reject`
+        returns True (e.g. too large for the command) are never served.
+        """
+        if source not in self._sources:
+            raise KeyError(f"Unknown prefetch source: {source}")
+
+        key = self._normalize_key(source, nsfw, tag)
+        pool = self._get_pool(key)
+
+        images: List[Any] = []
+        skipped: List[Any] = []
+        # Commands already queued for this pool go first
+        if not self._waiters.get(key):
+            images = self._take(pool, count, exclude, reject, skipped)
+
+        # A hit is a command served without waiting on the upstream
+        PREFETCH_REQUESTS.inc(source=source, result='hit' if len(images) >= count else 'miss')
+        if len(images) < count and not self._closed:
+            waiter = _Waiter(count, exclude, reject, images, skipped)
+            self._waiters.setdefault(key, deque()).append(waiter)
+            self._schedule_refill(key)
+            try:
+                # Stop waiting at the command's deadline and serve what has been collected
+                done, _ = await asyncio.wait({waiter.future}, timeout=remaining())
+                if not done:
+                    self._remove_waiter(key, waiter)
+            except asyncio.CancelledError:
+                self._remove_waiter(key, waiter)
+                # Hand back what this command had collected
+                current = self._pools.get(key)
+                if current is not None:
+                    current.extendleft(reversed(waiter.images))
+                raise
+
+        if len(images) < count and skipped:
+            # Nothing new upstream: repeat rather than come back empty
+            repeats = list({image.url: image for image in skipped}.values())[:count - len(images)]
+            pool = self._get_pool(key)
+            for image in repeats:
+                if image in pool:
+                    pool.remove(image)
+            images.extend(repeats)
+
+        pool = self._pools.get(key)
+        if pool is not None and len(pool) < self.low_water and not self._closed:
+            self._schedule_refill(key)
+
+        if not images:
+            return None
+        return {'images': images}
+
+    def give_back(self, source: str, nsfw: bool, tag: Optional[str], images: List[Any]):
+        """Put images taken with `get_images` but never served back at the front of their pool"""
+        pool = self._pools.get(self._normalize_key(source, nsfw, tag))
+        if pool is None or self._closed:
+            return
+        # A refill may have brought some of them in again meanwhile
+        pooled = {image.url for image in pool}
+        pool.extendleft(reversed([image for image in images if image.url not in pooled]))
+
+    def _remove_waiter(self, key: PoolKey, waiter: _Waiter):
+        waiters = self._waiters.get(key)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self._waiters[key]
+
+    async def warmup(self, keys):
+        """Fill the given (source, nsfw, tag) pools ahead of the first command"""
+        tasks = []
+        for source, nsfw, tag in keys:
+            key = self._normalize_key(source, nsfw, tag)
+            self._get_pool(key)
+            tasks.append(self._schedule_refill(key))
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'pools': len(self._pools),
+            'images': sum(len(pool) for pool in self._pools.values()),
+            'waiters': sum(len(waiters) for waiters in self._waiters.values()),
+            'refills_in_flight': len(self._refills)
+        }
+
+    async def close(self):
+        self._closed = True
+        for key in list(self._waiters):
+            self._release_waiters(key)
+        tasks = list(self._refills.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._refills.clear()
+        self._pools.clear()
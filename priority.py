@@ -0,0 +1,35 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator, Union
+
+# Upstream request priority classes, lower is more urgent
+INTERACTIVE = 0   # a user is waiting on a deferred interaction
+REFILL = 1        # background prefetch refills
+MAINTENANCE = 2   # tag catalog refreshes and other housekeeping
+
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', REFILL: 'refill', MAINTENANCE: 'maintenance'}
+
+# A fixed class, or a callable re-evaluated while the request waits for a token
+# (so a background refill that a user starts waiting on is promoted)
+PrioritySource = Union[int, Callable[[], int]]
+
+_current: ContextVar[PrioritySource] = ContextVar('upstream_priority', default=INTERACTIVE)
+
+
+def current_priority() -> PrioritySource:
+    """Priority for upstream requests made from the current task"""
+    return _current.get()
+
+
+def resolve(source: PrioritySource) -> int:
+    return source() if callable(source) else source
+
+
+@contextmanager
+def upstream_priority(source: PrioritySource) -> Iterator[None]:
+    """Run upstream requests inside the block (and tasks it creates) at `source` priority"""
+    token = _current.set(source)
+    try:
+        yield
+    finally:
+        _current.reset(token)
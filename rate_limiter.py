@@ -0,0 +1,213 @@
+import asyncio
+import itertools
+import time
+from typing import Dict, List, Optional, Tuple
+from config import (
+    RATE_LIMITS, RATE_LIMIT_ALIASES, DEFAULT_RATE_LIMIT, CLUSTER_COUNT,
+    PRIORITY_RESERVE_TOKENS, PRIORITY_AGING_SECONDS
+)
+from deadline import DeadlineExceeded, DeadlineSource, current_deadline, expired, remaining
+from metrics import RATE_LIMIT_DROPPED, RATE_LIMIT_WAIT
+from priority import INTERACTIVE, PRIORITY_NAMES, REFILL, PrioritySource, current_priority, resolve
+
+
+class _Waiter:
+    __slots__ = ('future', 'priority', 'deadline', 'enqueued', 'seq')
+
+    def __init__(self, priority: PrioritySource, deadline: DeadlineSource, seq: int):
+        self.future = asyncio.get_running_loop().create_future()
+        self.priority = priority
+        self.deadline = deadline
+        self.enqueued = time.monotonic()
+        self.seq = seq
+
+
+class TokenBucket:
+    """Async token bucket shared by every request to one upstream.
+
+    Callers that can't be served at once queue up and are granted tokens by
+    a dispatcher in priority order (see priority.py), oldest first within a
+    class. Background classes only get a token while `reserve` more are left
+    for interactive requests, and move up one class per `aging` seconds
+    waited so they are never starved. Waiters whose deadline (see
+    deadline.py) passes are dropped with DeadlineExceeded.
+    """
+
+    def __init__(self, rate: float, burst: int = 1, name: str = '',
+                 reserve: int = PRIORITY_RESERVE_TOKENS, aging: float = PRIORITY_AGING_SECONDS):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.name = name
+        self.rate = rate
+        self.burst = max(1, burst)
+        # A reserve can't exceed the bucket, or background work would never run
+        self.reserve = max(0, min(reserve, self.burst - 1))
+        self.aging = aging
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self.total_acquired = 0
+        self.total_wait = 0.0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _level(self, waiter: _Waiter, now: float) -> int:
+        level = resolve(waiter.priority)
+        if self.aging > 0:
+            level -= int((now - waiter.enqueued) / self.aging)
+        return max(INTERACTIVE, level)
+
+    def _needed(self, level: int) -> float:
+        return 1.0 if level <= INTERACTIVE else 1.0 + self.reserve
+
+    async def acquire(self, priority: Optional[PrioritySource] = None) -> float:
+        """Take one token, waiting for it if needed. Returns seconds waited.
+
+        `priority` defaults to the caller's context (see priority.upstream_priority).
+        """
+        if priority is None:
+            priority = current_priority()
+        now = time.monotonic()
+        self._refill(now)
+        if not self._waiters and self._tokens >= self._needed(resolve(priority)):
+            self._tokens -= 1
+            self._record(0.0, priority)
+            return 0.0
+
+        left = remaining()
+        if left is not None and left < self.estimated_wait(priority):
+            # Would still be queued when the caller gives up: don't take a place in line
+            RATE_LIMIT_DROPPED.inc(upstream=self.name)
+            raise DeadlineExceeded(f"{self.name}: no token within {max(0.0, left):.2f}s")
+
+        waiter = _Waiter(priority, current_deadline(), next(self._seq))
+        self._waiters.append(waiter)
+        self._wake_dispatcher()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif waiter.future.done() and not waiter.future.cancelled():
+                # Granted but never used: give the token back
+                self._tokens = min(self.burst, self._tokens + 1)
+                self._wake_dispatcher()
+            raise
+        wait_time = time.monotonic() - now
+        self._record(wait_time, priority)
+        return wait_time
+
+    def try_acquire(self, priority: PrioritySource = REFILL) -> bool:
+        """Take a token only if one is free right now for `priority` (never waits)"""
+        self._refill(time.monotonic())
+        if self._waiters or self._tokens < self._needed(resolve(priority)):
+            return False
+        self._tokens -= 1
+        self._record(0.0, priority)
+        return True
+
+    def defer(self, seconds: float):
+        """Hold the next token back for `seconds`, as an upstream's Retry-After asks.
+
+        Queued and new callers keep their place in line and are served once it
+        has passed, or dropped when their deadline comes first.
+        """
+        self._refill(time.monotonic())
+        self._tokens = min(self._tokens, 1.0 - seconds * self.rate)
+
+    def _record(self, wait_time: float, priority: PrioritySource):
+        self.total_acquired += 1
+        self.total_wait += wait_time
+        RATE_LIMIT_WAIT.observe(wait_time, upstream=self.name, priority=PRIORITY_NAMES.get(resolve(priority), 'other'))
+
+    def _wake_dispatcher(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        else:
+            self._wakeup.set()
+
+    def _drop_expired(self):
+        for waiter in [w for w in self._waiters if expired(w.deadline)]:
+            self._waiters.remove(waiter)
+            RATE_LIMIT_DROPPED.inc(upstream=self.name)
+            if not waiter.future.done():
+                waiter.future.set_exception(DeadlineExceeded(f"{self.name}: deadline passed while queued"))
+
+    async def _dispatch(self):
+        while True:
+            self._drop_expired()
+            if not self._waiters:
+                break
+            now = time.monotonic()
+            self._refill(now)
+            waiter = min(self._waiters, key=lambda w: (self._level(w, now), w.seq))
+            if waiter.future.done():
+                # Cancelled, and its task hasn't resumed yet to leave the queue itself
+                self._waiters.remove(waiter)
+                continue
+            needed = self._needed(self._level(waiter, now))
+            if self._tokens >= needed:
+                self._waiters.remove(waiter)
+                self._tokens -= 1
+                waiter.future.set_result(None)
+                continue
+            # Sleep until the token is there; new arrivals, promotions and aging can change the pick
+            delay = min((needed - self._tokens) / self.rate, 0.5)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def estimated_wait(self, priority: Optional[PrioritySource] = None) -> float:
+        """Seconds an `acquire` at `priority` would wait now, without taking a token.
+
+        Only waiters the dispatcher would serve first count: those at the same or a
+        more urgent level (after aging). A lower bound, as later arrivals of a more
+        urgent class can still go ahead.
+        """
+        if priority is None:
+            priority = current_priority()
+        now = time.monotonic()
+        self._refill(now)
+        level = max(INTERACTIVE, resolve(priority))
+        ahead = sum(1 for waiter in self._waiters if self._level(waiter, now) <= level)
+        return max(0.0, (ahead + self._needed(level) - self._tokens) / self.rate)
+
+    @property
+    def queued(self) -> int:
+        """Number of callers currently waiting for a token"""
+        return len(self._waiters)
+
+
+_limiters: Dict[str, TokenBucket] = {}
+
+
+def get_limiter(host: str) -> TokenBucket:
+    """Return the shared limiter for an upstream host"""
+    host = RATE_LIMIT_ALIASES.get(host, host)
+    limiter = _limiters.get(host)
+    if limiter is None:
+        rate, burst = RATE_LIMITS.get(host, DEFAULT_RATE_LIMIT)
+        # Every cluster process has its own bucket, so each gets an equal share
+        limiter = TokenBucket(rate / CLUSTER_COUNT, max(1, burst // CLUSTER_COUNT), name=host)
+        _limiters[host] = limiter
+    return limiter
+
+
+def configure_limiter(host: str, rate: float, burst: int = 1) -> TokenBucket:
+    """Replace the limiter for a host (used by tests and benchmarks)"""
+    host = RATE_LIMIT_ALIASES.get(host, host)
+    limiter = TokenBucket(rate, burst, name=host)
+    _limiters[host] = limiter
+    return limiter
+
+
+def limiter_stats() -> Dict[str, Tuple[int, float]]:
+    return {host: (l.total_acquired, l.total_wait) for host, l in _limiters.items()}
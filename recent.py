@@ -0,0 +1,70 @@
+import math
+from collections import OrderedDict
+from typing import Hashable, Iterable
+
+
+class _RotatingBloom:
+    """Two-generation Bloom filter: remembers roughly the last `capacity`..2x`capacity` items"""
+
+    __slots__ = ('current', 'previous', 'count')
+
+    def __init__(self, size_bytes: int):
+        self.current = bytearray(size_bytes)
+        self.previous = bytearray(size_bytes)
+        self.count = 0
+
+
+class RecentlySeen:
+    """Bounded, memory-efficient record of images recently shown per channel.
+
+    Each channel gets a rotating Bloom filter of a few hundred bytes, and
+    the least recently active channels are dropped beyond `max_channels`.
+    False positives only make us skip an image the channel has not seen.
+    """
+
+    def __init__(self, per_channel: int = 200, max_channels: int = 5000, error_rate: float = 0.01):
+        self.capacity = per_channel
+        self.max_channels = max_channels
+        bits = max(64, int(-per_channel * math.log(error_rate) / (math.log(2) ** 2)))
+        self._bits = bits
+        self._size_bytes = (bits + 7) // 8
+        self._hashes = max(1, round(bits / per_channel * math.log(2)))
+        self._channels: "OrderedDict[Hashable, _RotatingBloom]" = OrderedDict()
+
+    def _positions(self, key: str) -> Iterable[int]:
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        return ((h1 + i * h2) % self._bits for i in range(self._hashes))
+
+    @staticmethod
+    def _test(bits: bytearray, positions) -> bool:
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in positions)
+
+    def seen(self, channel_id: Hashable, key: str) -> bool:
+        bloom = self._channels.get(channel_id)
+        if bloom is None:
+            return False
+        positions = list(self._positions(key))
+        return self._test(bloom.current, positions) or self._test(bloom.previous, positions)
+
+    def add(self, channel_id: Hashable, keys: Iterable[str]):
+        bloom = self._channels.get(channel_id)
+        if bloom is None:
+            bloom = _RotatingBloom(self._size_bytes)
+            self._channels[channel_id] = bloom
+            if len(self._channels) > self.max_channels:
+                self._channels.popitem(last=False)
+        else:
+            self._channels.move_to_end(channel_id)
+
+        for key in keys:
+            if bloom.count >= self.capacity:
+                bloom.previous = bloom.current
+                bloom.current = bytearray(self._size_bytes)
+                bloom.count = 0
+            for p in self._positions(key):
+                bloom.current[p >> 3] |= 1 << (p & 7)
+            bloom.count += 1
+
+    def __len__(self) -> int:
+        return len(self._channels)
@@ -0,0 +1,262 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+import aiohttp
+from config import (
+    RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY, RETRY_MAX_RETRY_AFTER,
+    RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_PER_SECOND,
+    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT, RATE_LIMIT_ALIASES
+)
+from deadline import remaining
+from metrics import CIRCUIT_FAST_FAILURES, UPSTREAM_RETRIES
+from rate_limiter import TokenBucket, get_limiter
+
+logger = logging.getLogger(__name__)
+
+
+class RetryableError(Exception):
+    """Raised by an operation for failures worth retrying (429, 5xx).
+
+    `key_scoped` marks failures tied to the credentials used (a throttled or
+    revoked API token): they say nothing about the upstream's health and
+    never touch its circuit. The retry goes out at once with another token,
+    or after `retry_after` when no token is left.
+    """
+
+    def __init__(
+        self,
+        message: str,
+        status: Optional[int] = None,
+        retry_after: Optional[float] = None,
+        key_scoped: bool = False
+    ):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.key_scoped = key_scoped
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit is open"""
+
+
+class UpstreamUnavailableError(Exception):
+    """Raised by API clients, when asked to, instead of returning None for a failed request"""
+
+
+def parse_retry_after(value: Optional[str], default: float = 5.0) -> float:
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return default
+
+
+class CircuitBreaker:
+    """Fast-fails calls after repeated failures until a probe succeeds"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._open_until = 0.0
+        self._probe_in_flight = False
+
+    def allow_request(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() < self._open_until:
+                return False
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+        # Half-open: let exactly one probe through
+        if self._probe_in_flight:
+            return False
+        self._probe_in_flight = True
+        return True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.open_for(self.reset_timeout)
+
+    def release_probe(self):
+        self._probe_in_flight = False
+
+    def open_for(self, seconds: float):
+        self.state = self.OPEN
+        self._open_until = max(self._open_until, time.monotonic() + seconds)
+
+    @property
+    def retry_in(self) -> float:
+        return max(0.0, self._open_until - time.monotonic()) if self.state == self.OPEN else 0.0
+
+
+class RetryBudget:
+    """Limits retries to a fraction of recent first attempts.
+
+    Every first attempt deposits `ratio` tokens and every retry withdraws one,
+    with a small time-based allowance so a quiet bot can still retry.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_per_second: float = 0.5, max_tokens: float = 10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def record_request(self):
+        self._refill()
+        self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_withdraw(self) -> bool:
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+
+class RetryEngine:
+    """Runs upstream operations with jittered backoff, a retry budget and a circuit breaker.
+
+    A 429 says the upstream is busy, not broken: it holds `limiter` back for
+    Retry-After so every caller queues for the next token, and leaves the
+    circuit to 5xx, timeouts and connection errors.
+    """
+
+    RETRYABLE = (RetryableError, asyncio.TimeoutError, aiohttp.ClientError)
+
+    def __init__(
+        self,
+        name: str,
+        max_attempts: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 4.0,
+        max_retry_after: float = 5.0,
+        breaker: Optional[CircuitBreaker] = None,
+        budget: Optional[RetryBudget] = None,
+        limiter: Optional[TokenBucket] = None
+    ):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.breaker = breaker or CircuitBreaker()
+        self.budget = budget or RetryBudget()
+        self.limiter = limiter
+        self.retries = 0
+        self.fast_failures = 0
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter: spread retries of concurrent callers across the window
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def run(self, operation: Callable[[], Awaitable[Any]]) -> Any:
+        if not self.breaker.allow_request():
+            self.fast_failures += 1
+            CIRCUIT_FAST_FAILURES.inc(upstream=self.name)
+            raise CircuitOpenError(f"{self.name} circuit open, retry in {self.breaker.retry_in:.1f}s")
+
+        self.budget.record_request()
+        attempt = 0
+        while True:
+            try:
+                result = await operation()
+            except self.RETRYABLE as e:
+                retry_after = getattr(e, 'retry_after', None)
+                key_scoped = getattr(e, 'key_scoped', False)
+                throttled = not key_scoped and getattr(e, 'status', None) == 429
+                if key_scoped:
+                    self.breaker.release_probe()
+                elif throttled:
+                    self.breaker.release_probe()
+                    if self.limiter is not None:
+                        # Pause every caller for Retry-After instead of each one sleeping,
+                        # but no longer than an open circuit would
+                        pause = retry_after if retry_after is not None else self.base_delay
+                        self.limiter.defer(min(pause, self.breaker.reset_timeout))
+                else:
+                    self.breaker.record_failure()
+
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    raise
+                if retry_after is not None and retry_after > self.max_retry_after:
+                    raise
+                if key_scoped:
+                    delay = retry_after or 0.0
+                elif throttled and self.limiter is not None:
+                    # The retry queues for its token like everyone else, within its deadline
+                    delay = 0.0
+                else:
+                    delay = max(retry_after or 0.0, self._backoff(attempt))
+                left = remaining()
+                if left is not None and left <= delay:
+                    # The caller's deadline passes before the retry could even start
+                    raise
+                # A throttled retry is held to the host's rate by the limiter, so it can't add load
+                if not (throttled and self.limiter is not None) and not self.budget.try_withdraw():
+                    raise
+
+                self.retries += 1
+                UPSTREAM_RETRIES.inc(upstream=self.name, reason=str(getattr(e, 'status', None) or type(e).__name__))
+                logger.info("Retrying upstream request", extra={
+                    'upstream': self.name, 'attempt': attempt, 'delay_s': round(delay, 3), 'error': repr(e)
+                })
+                await asyncio.sleep(delay)
+
+                if not self.breaker.allow_request():
+                    self.fast_failures += 1
+                    CIRCUIT_FAST_FAILURES.inc(upstream=self.name)
+                    raise CircuitOpenError(f"{self.name} circuit open, retry in {self.breaker.retry_in:.1f}s")
+                continue
+            except BaseException:
+                # Neither success nor upstream failure (bad payload, cancellation)
+                self.breaker.release_probe()
+                raise
+
+            self.breaker.record_success()
+            return result
+
+
+_engines: Dict[str, RetryEngine] = {}
+
+
+def get_retry_engine(host: str) -> RetryEngine:
+    """Return the shared retry engine (and circuit) for an upstream host, throttled through its limiter"""
+    host = RATE_LIMIT_ALIASES.get(host, host)
+    engine = _engines.get(host)
+    if engine is None:
+        engine = RetryEngine(
+            host,
+            max_attempts=RETRY_MAX_ATTEMPTS,
+            base_delay=RETRY_BASE_DELAY,
+            max_delay=RETRY_MAX_DELAY,
+            max_retry_after=RETRY_MAX_RETRY_AFTER,
+            breaker=CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT),
+            budget=RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_PER_SECOND),
+            limiter=get_limiter(host)
+        )
+        _engines[host] = engine
+    return engine
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Build the e621 tag index used for /furry autocomplete and tag validation
+
+Download the latest tags dump from https://e621.net/db_export/ first:
+
+    python scripts/build_e621_tags.py tags-2024-01-01.csv.gz
+    python scripts/build_e621_tags.py tags.csv --output data/e621_tags.bin --min-posts 5
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config import E621_TAGS_PATH
+from e621_tags import build_index, open_index, read_tag_dump
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build the e621 tag index from a db_export tags CSV")
+    parser.add_argument('dump', help="tags-*.csv or tags-*.csv.gz from e621's db_export")
+    parser.add_argument('--output', default=E621_TAGS_PATH,
+                        help=f"index file to write (default: {E621_TAGS_PATH})")
+    parser.add_argument('--min-posts', type=int, default=1,
+                        help="skip tags used on fewer posts (default: 1)")
+    return parser.parse_args()
+
+def main() -> int:
+    args = parse_args()
+    started = time.perf_counter()
+    try:
+        count = build_index(read_tag_dump(args.dump, args.min_posts), args.output)
+    except OSError as e:
+        print(f"Failed to build tag index: {e}", file=sys.stderr)
+        return 1
+
+    index = open_index(args.output)
+    if index is None:
+        print(f"Built {args.output} but it could not be opened", file=sys.stderr)
+        return 1
+    top = ', '.join(index.complete('', limit=5))
+    index.close()
+    size = Path(args.output).stat().st_size
+    print(f"Wrote {count} tags to {args.output} ({size / 1024 / 1024:.1f} MiB) "
+          f"in {time.perf_counter() - started:.1f}s; most used: {top}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
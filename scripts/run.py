@@ -2,26 +2,49 @@
 """
 Launcher script for CatGirl Discord Bot
 Handles startup, error recovery, and graceful shutdown
+
+    python scripts/run.py                          # one process, shards chosen by Discord
+    python scripts/run.py --clusters 4             # 4 supervised worker processes
+    python scripts/run.py --clusters 4 --shards 16 # 4 workers x 4 shards each
 """
 
+import argparse
 import asyncio
 import logging
+import multiprocessing
+import os
 import signal
 import sys
+import time
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler(sys.stdout)
-    ]
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import aiohttp
+from config import DISCORD_TOKEN, CLUSTER_ID, LOG_LEVEL, LOG_FILE, LOG_DEBUG_SAMPLE_RATE, LOG_QUEUE_SIZE
+from logging_setup import setup_logging, shutdown_logging
+
+# Setup logging: JSON lines to stdout and bot.log, written by a background thread
+# (worker processes re-import this module, so each one gets its own writer)
+_is_worker = 'CLUSTER_ID' in os.environ
+setup_logging(
+    LOG_LEVEL, LOG_FILE or 'bot.log', LOG_DEBUG_SAMPLE_RATE, LOG_QUEUE_SIZE,
+    fields={'cluster': CLUSTER_ID} if _is_worker else None
 )
 
 logger = logging.getLogger(__name__)
 
+# Worker exit codes
+EXIT_OK = 0
+EXIT_CRASH = 1   # supervisor restarts the cluster
+EXIT_FATAL = 2   # bad token or config: restarting will not help
+
+RESTART_BACKOFF_MAX = 60    # seconds
+STABLE_UPTIME = 300         # a cluster up this long has its crash backoff reset
+SHUTDOWN_TIMEOUT = 30       # seconds to wait for workers before killing them
+IDENTIFY_INTERVAL = 5       # seconds Discord requires between identifies per bucket
+
 def check_requirements():
     """Check if all required files exist"""
     required_files = [
@@ -48,24 +71,25 @@ def check_requirements():
     
     return True
 
-async def main():
+async def main() -> int:
     """Main function to run the bot"""
     logger.info("🚀 Запуск CatGirl Discord Bot...")
     
     # Check requirements
     if not check_requirements():
-        sys.exit(1)
+        return EXIT_FATAL
     
     # Import bot after checking requirements
     try:
+        import discord
         from bot import bot
     except ImportError as e:
         logger.error(f"❌ Ошибка импорта: {e}")
         logger.info("💡 Убедитесь, что установлены все зависимости: pip install -r requirements.txt")
-        sys.exit(1)
+        return EXIT_FATAL
     except Exception as e:
         logger.error(f"❌ Ошибка конфигурации: {e}")
-        sys.exit(1)
+        return EXIT_FATAL
     
     # Setup signal handlers for graceful shutdown
     def signal_handler(signum, frame):
@@ -77,22 +101,203 @@ async def main():
     
     # Run bot with error handling
     try:
-        await bot.start(bot.http.token)
+        await bot.start(DISCORD_TOKEN)
     except discord.LoginFailure:
         logger.error("❌ Неверный токен Discord!")
         logger.info("💡 Проверьте DISCORD_TOKEN в файле .env")
+        return EXIT_FATAL
     except discord.HTTPException as e:
         logger.error(f"❌ HTTP ошибка Discord: {e}")
+        return EXIT_CRASH
     except Exception as e:
-        logger.error(f"❌ Неожиданная ошибка: {e}")
+        logger.exception(f"❌ Неожиданная ошибка: {e}")
+        return EXIT_CRASH
     finally:
+        if not bot.is_closed():
+            await bot.close()
         logger.info("👋 Бот остановлен")
+    return EXIT_OK
 
-if __name__ == "__main__":
+def run_worker() -> int:
+    """Run one bot process to completion and return its exit code"""
     try:
-        asyncio.run(main())
+        return asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("👋 Остановка по запросу пользователя")
+        return EXIT_OK
     except Exception as e:
         logger.error(f"❌ Критическая ошибка: {e}")
-        sys.exit(1)
+        return EXIT_CRASH
+    finally:
+        shutdown_logging()
+
+def _cluster_main():
+    # Entry point of a worker process; its shard slice comes from the environment
+    sys.exit(run_worker())
+
+def fetch_gateway_info(token: str) -> Tuple[int, int]:
+    """Ask Discord for the recommended shard count and identify concurrency"""
+    async def fetch():
+        async with aiohttp.ClientSession() as session:
+            async with session.get(
+                'https://discord.com/api/v10/gateway/bot',
+                headers={'Authorization': f'Bot {token}'}
+            ) as response:
+                response.raise_for_status()
+                data = await response.json()
+        return data['shards'], data.get('session_start_limit', {}).get('max_concurrency', 1)
+    return asyncio.run(fetch())
+
+def split_shards(shard_count: int, clusters: int) -> List[List[int]]:
+    """Spread shard ids 0..shard_count-1 over clusters as contiguous, near-equal ranges"""
+    clusters = max(1, min(clusters, shard_count))
+    size, extra = divmod(shard_count, clusters)
+    ranges = []
+    start = 0
+    for i in range(clusters):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+class ClusterSupervisor:
+    """Runs one worker process per shard range and restarts crashed workers with backoff"""
+    
+    def __init__(self, shard_count: int, clusters: List[List[int]], max_concurrency: int = 1):
+        self.shard_count = shard_count
+        self.clusters = clusters
+        self.max_concurrency = max(1, max_concurrency)
+        # spawn: workers start from a clean interpreter instead of a forked event loop
+        self._ctx = multiprocessing.get_context('spawn')
+        self.processes: Dict[int, multiprocessing.process.BaseProcess] = {}
+        self._started_at: Dict[int, float] = {}
+        self._crashes: Dict[int, int] = {}
+        self._restart_at: Dict[int, float] = {}
+        self._stopping = False
+        self.exitcode = EXIT_OK
+    
+    def _start_delay(self, cluster_id: int) -> float:
+        # Discord allows max_concurrency identifies per 5s; let each cluster's shards log in first
+        return IDENTIFY_INTERVAL * len(self.clusters[cluster_id]) / self.max_concurrency
+    
+    def _spawn(self, cluster_id: int):
+        # Workers read their shard slice from config, i.e. from the inherited environment
+        os.environ.update({
+            'CLUSTER_ID': str(cluster_id),
+            'CLUSTER_COUNT': str(len(self.clusters)),
+            'SHARD_COUNT': str(self.shard_count),
+            'SHARD_IDS': ','.join(str(i) for i in self.clusters[cluster_id])
+        })
+        process = self._ctx.Process(target=_cluster_main, name=f'cluster-{cluster_id}')
+        process.start()
+        self.processes[cluster_id] = process
+        self._started_at[cluster_id] = time.monotonic()
+        logger.info("Cluster started", extra={
+            'cluster_id': cluster_id, 'pid': process.pid, 'shards': self.clusters[cluster_id]
+        })
+    
+    def _handle_exit(self, cluster_id: int, exitcode: int):
+        del self.processes[cluster_id]
+        if exitcode == EXIT_OK or self._stopping:
+            logger.info("Cluster stopped", extra={'cluster_id': cluster_id, 'exitcode': exitcode})
+            return
+        if exitcode == EXIT_FATAL:
+            logger.error("Cluster failed with a fatal error, shutting down", extra={'cluster_id': cluster_id})
+            self._stopping = True
+            self.exitcode = EXIT_FATAL
+            return
+        
+        if time.monotonic() - self._started_at[cluster_id] >= STABLE_UPTIME:
+            self._crashes[cluster_id] = 0
+        crashes = self._crashes.get(cluster_id, 0) + 1
+        self._crashes[cluster_id] = crashes
+        delay = min(RESTART_BACKOFF_MAX, 2 ** (crashes - 1))
+        self._restart_at[cluster_id] = time.monotonic() + delay
+        logger.warning("Cluster crashed, restarting", extra={
+            'cluster_id': cluster_id, 'exitcode': exitcode, 'crashes': crashes, 'restart_in_s': delay
+        })
+    
+    def _request_stop(self, signum, frame):
+        logger.info(f"📡 Получен сигнал {signum}, остановка кластеров...")
+        self._stopping = True
+    
+    def _reap(self):
+        for cluster_id, process in list(self.processes.items()):
+            if not process.is_alive():
+                process.join()
+                self._handle_exit(cluster_id, process.exitcode)
+    
+    def _sleep(self, seconds: float):
+        # Keep watching the workers while staggering startup
+        deadline = time.monotonic() + seconds
+        while not self._stopping and time.monotonic() < deadline:
+            time.sleep(max(0.0, min(0.5, deadline - time.monotonic())))
+            self._reap()
+    
+    def run(self) -> int:
+        signal.signal(signal.SIGINT, self._request_stop)
+        signal.signal(signal.SIGTERM, self._request_stop)
+        
+        for cluster_id in range(len(self.clusters)):
+            if self._stopping:
+                break
+            self._spawn(cluster_id)
+            if cluster_id < len(self.clusters) - 1:
+                self._sleep(self._start_delay(cluster_id))
+        
+        while not self._stopping and (self.processes or self._restart_at):
+            self._reap()
+            now = time.monotonic()
+            for cluster_id, restart_at in list(self._restart_at.items()):
+                if now >= restart_at and not self._stopping:
+                    del self._restart_at[cluster_id]
+                    self._spawn(cluster_id)
+            time.sleep(1)
+        
+        self.shutdown()
+        return self.exitcode
+    
+    def shutdown(self):
+        """Ask every worker to close, then kill the ones that do not exit in time"""
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for cluster_id, process in self.processes.items():
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning("Cluster did not stop in time, killing it", extra={'cluster_id': cluster_id})
+                process.kill()
+                process.join()
+        self.processes.clear()
+        logger.info("👋 Все кластеры остановлены")
+
+def run_clusters(clusters: int, shard_count: Optional[int]) -> int:
+    max_concurrency = 1
+    if shard_count is None:
+        if not DISCORD_TOKEN:
+            logger.error("❌ DISCORD_TOKEN не задан, невозможно определить число шардов")
+            return EXIT_FATAL
+        shard_count, max_concurrency = fetch_gateway_info(DISCORD_TOKEN)
+        logger.info("Discord recommends shards", extra={'shard_count': shard_count, 'max_concurrency': max_concurrency})
+    
+    ranges = split_shards(shard_count, clusters)
+    supervisor = ClusterSupervisor(shard_count, ranges, max_concurrency)
+    try:
+        return supervisor.run()
+    finally:
+        shutdown_logging()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run CatGirl Discord Bot")
+    parser.add_argument('--clusters', type=int, default=0,
+                        help="worker processes to spread shards over (0 = run in this process)")
+    parser.add_argument('--shards', type=int, default=None,
+                        help="total shard count (default: Discord's recommendation)")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.clusters > 0 or args.shards:
+        sys.exit(run_clusters(max(1, args.clusters), args.shards))
+    sys.exit(run_worker())
@@ -0,0 +1,82 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Mapping, Optional, Tuple
+from deadline import DeadlineSource, current_deadline, resolve as resolve_deadline, run_within_deadline, upstream_deadline
+from metrics import SINGLEFLIGHT_CALLS
+from priority import REFILL, PrioritySource, current_priority, resolve as resolve_priority, upstream_priority
+
+
+def make_key(endpoint: str, params: Mapping[str, Any]) -> Tuple:
+    """Build a hashable key from an endpoint and its query params"""
+    return (endpoint, tuple(sorted((k, str(v)) for k, v in params.items())))
+
+
+class _Flight:
+    """One shared call and the deadline/priority of every caller waiting on it"""
+
+    __slots__ = ('task', 'waiters')
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.waiters: List[Tuple[DeadlineSource, PrioritySource]] = []
+
+    def deadline(self) -> Optional[float]:
+        """Latest deadline among the waiters, None if any is unbounded (or none is left)"""
+        deadlines = [resolve_deadline(deadline) for deadline, _ in self.waiters]
+        if not deadlines or None in deadlines:
+            return None
+        return max(deadlines)
+
+    def priority(self) -> int:
+        """Most urgent priority among the waiters; background work once nobody waits"""
+        return min((resolve_priority(priority) for _, priority in self.waiters), default=REFILL)
+
+
+class SingleFlight:
+    """Coalesce identical concurrent calls into one in-flight task.
+
+    Every caller with the same key awaits the same task and receives the
+    same result object, so results must be treated as read-only. The shared
+    call runs with the latest deadline and most urgent priority of the
+    callers still waiting on it, not just those of the caller that started
+    it; each caller still gives up at its own deadline.
+    """
+
+    def __init__(self, name: str = ''):
+        self.name = name
+        self._calls: Dict[Hashable, _Flight] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        waiter = (current_deadline(), current_priority())
+        flight = self._calls.get(key)
+        if flight is None:
+            flight = _Flight()
+            flight.waiters.append(waiter)
+            with upstream_deadline(flight.deadline), upstream_priority(flight.priority):
+                flight.task = asyncio.create_task(fn())
+            self._calls[key] = flight
+            flight.task.add_done_callback(lambda t: self._forget(key, flight))
+            self.started += 1
+            SINGLEFLIGHT_CALLS.inc(client=self.name, result='started')
+        else:
+            flight.waiters.append(waiter)
+            self.coalesced += 1
+            SINGLEFLIGHT_CALLS.inc(client=self.name, result='coalesced')
+        try:
+            return await run_within_deadline(self._wait(flight.task))
+        finally:
+            flight.waiters.remove(waiter)
+
+    @staticmethod
+    async def _wait(task: asyncio.Task) -> Any:
+        # A cancelled or timed-out waiter must not cancel the call other waiters share
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, flight: _Flight):
+        if self._calls.get(key) is flight:
+            del self._calls[key]
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Dict, Optional
+from metrics import STARTUP_STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+OK = 'ok'
+DEGRADED = 'degraded'   # finished, but the bot runs on a fallback (e.g. cached or built-in tags)
+FAILED = 'failed'
+PENDING = 'pending'
+
+
+class StartupStages:
+    """Independent startup stages running concurrently in the background.
+
+    The gateway connects while the stages run. Stages a command cannot do
+    without are started as `gating`: `wait_ready` lets a command wait for
+    them for a bounded time, after which it goes ahead with whatever
+    fallback is in place rather than keep the user waiting.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._gating: Dict[str, asyncio.Task] = {}
+        self.results: Dict[str, str] = {}
+        self._started = time.monotonic()
+
+    def start(self, name: str, work: Awaitable[Any], gating: bool = False) -> asyncio.Task:
+        """Run `work` as stage `name`; a result of False marks the stage degraded"""
+        self.results[name] = PENDING
+        task = asyncio.create_task(self._run(name, work), name=f'startup:{name}')
+        task.add_done_callback(lambda _: self._abandon(name, work))
+        self._tasks[name] = task
+        if gating:
+            self._gating[name] = task
+        return task
+
+    async def _run(self, name: str, work: Awaitable[Any]):
+        started = time.monotonic()
+        try:
+            result = await work
+            self.results[name] = DEGRADED if result is False else OK
+        except asyncio.CancelledError:
+            self.results[name] = FAILED
+            raise
+        except Exception as e:
+            self.results[name] = FAILED
+            logger.error("Startup stage failed", extra={'stage': name, 'error': repr(e)})
+        finally:
+            elapsed = time.monotonic() - started
+            STARTUP_STAGE_SECONDS.set(elapsed, stage=name)
+            logger.info("Startup stage finished", extra={
+                'stage': name, 'result': self.results[name], 'duration_s': round(elapsed, 3)
+            })
+            if self.ready:
+                logger.info("Startup complete", extra={
+                    'stages': dict(self.results), 'duration_s': round(time.monotonic() - self._started, 3)
+                })
+
+    def _abandon(self, name: str, work: Awaitable[Any]):
+        if self.results[name] == PENDING:
+            # Cancelled before it even started
+            self.results[name] = FAILED
+            if asyncio.iscoroutine(work):
+                work.close()
+
+    @property
+    def ready(self) -> bool:
+        return all(task.done() for task in self._tasks.values())
+
+    async def wait_ready(self, timeout: Optional[float]) -> bool:
+        """Wait up to `timeout` for the gating stages; False if the caller should use fallbacks"""
+        pending = [task for task in self._gating.values() if not task.done()]
+        if pending:
+            await asyncio.wait(pending, timeout=timeout)
+        return all(task.done() and self.results[name] == OK for name, task in self._gating.items())
+
+    async def cancel(self):
+        tasks = [task for task in self._tasks.values() if not task.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,47 @@
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional
+from atomic_file import atomic_write
+
+logger = logging.getLogger(__name__)
+
+# Bump when the on-disk layout changes; older files are ignored
+CATALOG_FORMAT = 1
+
+
+def load_catalog(path: str) -> Optional[Dict[str, Any]]:
+    """Read a saved tag catalog, or None if it is missing or unreadable"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            catalog = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable tag catalog", extra={'path': path, 'error': str(e)})
+        return None
+
+    if not isinstance(catalog, dict) or catalog.get('format') != CATALOG_FORMAT:
+        return None
+    if not isinstance(catalog.get('versatile'), list) or not isinstance(catalog.get('nsfw'), list):
+        return None
+    return catalog
+
+
+def save_catalog(path: str, versatile: List[str], nsfw: List[str]) -> Dict[str, Any]:
+    """Atomically write the tag catalog with the current timestamp"""
+    catalog = {
+        'format': CATALOG_FORMAT,
+        'fetched_at': time.time(),
+        'versatile': list(versatile),
+        'nsfw': list(nsfw)
+    }
+    with atomic_write(path, encoding='utf-8') as f:
+        json.dump(catalog, f, ensure_ascii=False)
+    return catalog
+
+
+def is_stale(catalog: Optional[Dict[str, Any]], ttl: float) -> bool:
+    if not catalog:
+        return True
+    return time.time() - catalog.get('fetched_at', 0) > ttl
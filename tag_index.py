@@ -0,0 +1,138 @@
+from typing import Dict, FrozenSet, Iterable, List, Optional, Sequence, Tuple
+
+# Prefix table depth; longer queries filter the deepest bucket
+MAX_PREFIX_LENGTH = 8
+# Substring index gram size; shorter queries are looked up directly
+GRAM_SIZE = 3
+# How many gram-overlap candidates "did you mean" scores with edit distance
+MAX_SUGGESTION_CANDIDATES = 50
+
+
+def _grams(text: str, size: int) -> Iterable[str]:
+    return (text[i:i + size] for i in range(len(text) - size + 1))
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> Optional[int]:
+    """Levenshtein distance with adjacent transpositions, or None if above max_distance"""
+    if abs(len(a) - len(b)) > max_distance:
+        return None
+    previous2: List[int] = []
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i] + [0] * len(b)
+        for j, cb in enumerate(b, 1):
+            cost = 0 if ca == cb else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > max_distance:
+            return None
+        previous2, previous = previous, current
+    return previous[-1] if previous[-1] <= max_distance else None
+
+
+class TagSearchIndex:
+    """Case-folded autocomplete index over a fixed set of tags.
+
+    Built once per tag catalog: a prefix table (a flattened trie) answers
+    starts-with queries and an n-gram index answers substring queries, so a
+    keystroke never scans the whole catalog.
+    """
+
+    def __init__(self, tags: Iterable[str], popular: Sequence[str] = ()):
+        self.tags: Tuple[str, ...] = tuple(sorted(set(tags)))
+        self.tag_set: FrozenSet[str] = frozenset(self.tags)
+        self._folded: Dict[str, str] = {tag: tag.casefold() for tag in self.tags}
+
+        exact: Dict[str, List[str]] = {}
+        prefixes: Dict[str, List[str]] = {}
+        grams: Dict[str, set] = {}
+        for tag, folded in self._folded.items():
+            exact.setdefault(folded, []).append(tag)
+            for end in range(1, min(len(folded), MAX_PREFIX_LENGTH) + 1):
+                prefixes.setdefault(folded[:end], []).append(tag)
+            for size in range(1, GRAM_SIZE + 1):
+                for gram in _grams(folded, size):
+                    grams.setdefault(gram, set()).add(tag)
+
+        self._exact: Dict[str, Tuple[str, ...]] = {k: tuple(v) for k, v in exact.items()}
+        self._prefixes: Dict[str, Tuple[str, ...]] = {k: tuple(v) for k, v in prefixes.items()}
+        self._grams: Dict[str, FrozenSet[str]] = {k: frozenset(v) for k, v in grams.items()}
+
+        tag_set = set(self.tags)
+        popular_first = [tag for tag in popular if tag in tag_set]
+        self._default: Tuple[str, ...] = tuple(popular_first) + tuple(
+            tag for tag in self.tags if tag not in set(popular_first)
+        )
+
+    def __len__(self) -> int:
+        return len(self.tags)
+
+    def __contains__(self, tag: str) -> bool:
+        return tag in self.tag_set
+
+    def _starts_with(self, query: str) -> Tuple[str, ...]:
+        bucket = self._prefixes.get(query[:MAX_PREFIX_LENGTH], ())
+        if len(query) <= MAX_PREFIX_LENGTH:
+            return bucket
+        return tuple(tag for tag in bucket if self._folded[tag].startswith(query))
+
+    def _contains(self, query: str) -> List[str]:
+        if len(query) <= GRAM_SIZE:
+            return sorted(self._grams.get(query, ()))
+        candidates = None
+        for gram in _grams(query, GRAM_SIZE):
+            matches = self._grams.get(gram)
+            if not matches:
+                return []
+            candidates = matches if candidates is None else candidates & matches
+        return sorted(tag for tag in candidates if query in self._folded[tag])
+
+    def search(self, query: str, limit: int = 25) -> List[str]:
+        """Exact matches first, then prefix matches, then substring matches"""
+        query = query.strip().casefold()
+        if not query:
+            return list(self._default[:limit])
+
+        results = list(self._exact.get(query, ()))
+        seen = set(results)
+        for group in (self._starts_with, self._contains):
+            if len(results) >= limit:
+                break
+            for tag in group(query):
+                if tag not in seen:
+                    results.append(tag)
+                    seen.add(tag)
+                    if len(results) >= limit:
+                        break
+        return results
+
+    def suggest(self, term: str, limit: int = 5) -> List[str]:
+        """Typo-tolerant "did you mean" suggestions for an unknown tag"""
+        term = term.strip().casefold()
+        if not term:
+            return []
+
+        # Bounded candidate set: tags sharing the most bigrams with the term
+        # (bigrams survive typos and transpositions better than trigrams).
+        # A short term can share no bigram with its tag ('miad' -> 'maid'): use letters
+        size = 1 if len(term) <= 4 else 2
+        overlap: Dict[str, int] = {}
+        for gram in set(_grams(term, size)):
+            for tag in self._grams.get(gram, ()):
+                overlap[tag] = overlap.get(tag, 0) + 1
+        candidates = sorted(overlap, key=lambda tag: (-overlap[tag], tag))[:MAX_SUGGESTION_CANDIDATES]
+
+        max_distance = max(1, min(3, len(term) // 3))
+        scored = []
+        for tag in candidates:
+            folded = self._folded[tag]
+            if term in folded or folded in term:
+                scored.append((0, -overlap[tag], tag))
+                continue
+            distance = edit_distance(term, folded, max_distance)
+            if distance is not None:
+                scored.append((distance, -overlap[tag], tag))
+
+        scored.sort()
+        return [tag for _, _, tag in scored[:limit]]
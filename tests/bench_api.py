@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for the upstream API clients
+Runs WaifuAPI and FurryAPI against local mock servers and reports
+throughput and p50/p99 latency, so performance changes can be measured
+without touching the real APIs
+
+    python tests/bench_api.py --requests 500 --concurrency 50 --latency 0.05
+"""
+
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from mock_upstreams import MockUpstream
+from furry_api import FurryAPI
+from rate_limiter import configure_limiter
+from waifu_api import WaifuAPI
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+async def run_scenario(
+    name: str,
+    call: Callable[[int], Awaitable[object]],
+    requests: int,
+    concurrency: int
+) -> Dict[str, float]:
+    """Fire `requests` calls with at most `concurrency` in flight and time each one"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    failures = 0
+
+    async def one(i: int):
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            result = await call(i)
+            latencies.append(time.perf_counter() - start)
+            if not result:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        'name': name,
+        'requests': requests,
+        'failures': failures,
+        'throughput': requests / elapsed if elapsed else 0.0,
+        'mean': statistics.mean(latencies) if latencies else 0.0,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99)
+    }
+
+
+def print_report(results: List[Dict[str, float]], upstream: MockUpstream):
+    print(f"\n{'scenario':<32} {'reqs':>6} {'fail':>5} {'req/s':>9} {'mean ms':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    print('-' * 84)
+    for r in results:
+        print(
+            f"{r['name']:<32} {r['requests']:>6} {r['failures']:>5} {r['throughput']:>9.1f} "
+            f"{r['mean'] * 1000:>9.1f} {r['p50'] * 1000:>9.1f} {r['p99'] * 1000:>9.1f}"
+        )
+    print('-' * 84)
+    print(f"Upstream requests: {upstream.requests}  (429 injected: {upstream.rate_limited})")
+
+
+async def main(args) -> List[Dict[str, float]]:
+    upstream = MockUpstream(
+        latency=args.latency,
+        jitter=args.latency / 5,
+        rate_limit_ratio=args.rate_limit_ratio,
+        retry_after=1,
+        invalid_tokens=[f'token{i}' for i in range(args.invalid_tokens)]
+    )
+    async with upstream:
+        # Mock servers live on 127.0.0.1, which gets its own limiter
+        configure_limiter('127.0.0.1', rate=args.rate, burst=args.burst)
+
+        # With --tokens each token gets its own --rate/--burst budget
+        tokens = [f'token{i}' for i in range(args.tokens)]
+        async with WaifuAPI(base_url=upstream.base_url, tokens=tokens) as waifu, \
+                FurryAPI(base_url_nsfw=upstream.base_url, base_url_sfw=upstream.base_url) as furry:
+            results = [
+                await run_scenario(
+                    'search_images (distinct tags)',
+                    lambda i: waifu.search_images(included_tags=[f'tag{i}'], page_size=1),
+                    args.requests, args.concurrency
+                ),
+                await run_scenario(
+                    'search_images (identical)',
+                    lambda i: waifu.search_images(included_tags=['maid'], page_size=1),
+                    args.requests, args.concurrency
+                ),
+                await run_scenario(
+                    'get_available_tags',
+                    lambda i: waifu.get_available_tags(),
+                    max(1, args.requests // 10), args.concurrency
+                ),
+                await run_scenario(
+                    f'search_posts (limit={args.e621_page})',
+                    lambda i: furry.search_posts(tags=[f'tag{i}'], limit=args.e621_page),
+                    max(1, args.requests // 10), args.concurrency
+                ),
+            ]
+
+        print_report(results, upstream)
+        if upstream.token_requests:
+            print(f"Requests per token: {dict(sorted(upstream.token_requests.items()))}")
+        return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark for WaifuAPI and FurryAPI")
+    parser.add_argument('--requests', type=int, default=300, help="calls per scenario")
+    parser.add_argument('--concurrency', type=int, default=50, help="calls in flight at once")
+    parser.add_argument('--latency', type=float, default=0.05, help="mock upstream latency in seconds")
+    parser.add_argument('--rate', type=float, default=1000.0, help="client rate limit (req/s)")
+    parser.add_argument('--burst', type=int, default=100, help="client rate limit burst")
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help="fraction of responses that are 429")
+    parser.add_argument('--e621-page', type=int, default=320, help="posts per e621 page")
+    parser.add_argument('--tokens', type=int, default=0, help="waifu.im API tokens to rotate over")
+    parser.add_argument('--invalid-tokens', type=int, default=0, help="how many of those tokens the mock rejects with 401")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    print("CatGirl Discord Bot - API benchmark (offline)")
+    print("=" * 50)
+    try:
+        asyncio.run(main(parse_args()))
+    except KeyboardInterrupt:
+        print("\nBenchmark interrupted")
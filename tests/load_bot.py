@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+End-to-end load generator for the slash-command handlers
+Drives thousands of simulated /waifu, /nsfw, /furry and autocomplete
+interactions concurrently against local mock upstreams and reports
+end-to-end latency, upstream call counts and event-loop lag
+
+    python tests/load_bot.py --commands 2000 --concurrency 200
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+# Keep the tag catalog written during the run out of the real data dir
+os.environ.setdefault('DATA_DIR', tempfile.mkdtemp(prefix='catgirl-load-'))
+
+from mock_upstreams import MockUpstream
+from bench_api import percentile
+from rate_limiter import configure_limiter
+import bot as bot_module
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int, nsfw: bool):
+        self.id = channel_id
+        self._nsfw = nsfw
+
+    def is_nsfw(self) -> bool:
+        return self._nsfw
+
+
+class FakeResponse:
+    """Records interaction.response calls"""
+
+    def __init__(self, interaction: 'FakeInteraction'):
+        self._interaction = interaction
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def defer(self, **kwargs):
+        self._done = True
+        self._interaction.deferred_at = time.perf_counter()
+
+    async def send_message(self, content: Optional[str] = None, **kwargs):
+        self._done = True
+        self._interaction.record_reply(content, kwargs)
+
+
+class FakeFollowup:
+    """Records interaction.followup calls"""
+
+    def __init__(self, interaction: 'FakeInteraction'):
+        self._interaction = interaction
+
+    async def send(self, content: Optional[str] = None, **kwargs):
+        self._interaction.record_reply(content, kwargs)
+
+
+class FakeInteraction:
+    """Just enough of discord.Interaction for the command handlers"""
+
+    def __init__(self, channel: FakeChannel, user_id: int):
+        self.channel = channel
+        self.channel_id = channel.id
+        self.user = FakeUser(user_id)
+        self.guild = None
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.created_at = time.perf_counter()
+        self.deferred_at: Optional[float] = None
+        self.replied_at: Optional[float] = None
+        self.replies: List[Dict] = []
+
+    def record_reply(self, content: Optional[str], kwargs: Dict):
+        if self.replied_at is None:
+            self.replied_at = time.perf_counter()
+        self.replies.append({'content': content, **kwargs})
+
+    @property
+    def succeeded(self) -> bool:
+        return any(reply.get('embeds') or reply.get('embed') for reply in self.replies)
+
+
+class LoopLagMonitor:
+    """Measures how late a periodic timer fires, i.e. event-loop blocking"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+async def simulate(kind: str, channel: FakeChannel, user_id: int, tags: List[str]) -> FakeInteraction:
+    interaction = FakeInteraction(channel, user_id)
+    if kind == 'waifu':
+        await bot_module.process_waifu_request(interaction, count=random.randint(1, 5))
+    elif kind == 'waifu_tag':
+        await bot_module.process_waifu_request(interaction, tag=random.choice(tags), count=random.randint(1, 3))
+    elif kind == 'nsfw':
+        await bot_module.process_waifu_request(interaction, nsfw=True, count=1)
+    elif kind == 'furry':
+        await bot_module.furry_command.callback(interaction, nsfw=False, tags=None, count=random.randint(1, 5))
+    elif kind == 'autocomplete':
+        prefix = random.choice(tags)[:random.randint(0, 4)]
+        choices = await bot_module.waifu_tag_autocomplete(interaction, prefix)
+        interaction.record_reply(None, {'choices': choices, 'embeds': choices or [None]})
+    return interaction
+
+
+MIX = [('waifu', 45), ('waifu_tag', 20), ('nsfw', 5), ('furry', 15), ('autocomplete', 15)]
+
+
+async def main(args):
+    upstream = MockUpstream(latency=args.latency, jitter=args.latency / 5, rate_limit_ratio=args.rate_limit_ratio)
+    async with upstream:
+        configure_limiter('127.0.0.1', rate=args.rate, burst=args.burst)
+        bot = bot_module.bot
+        await bot.setup_services(
+            waifu_base_url=upstream.base_url,
+            furry_base_urls={'base_url_nsfw': upstream.base_url, 'base_url_sfw': upstream.base_url}
+        )
+        await bot_module.load_available_tags(bot.waifu_api)
+        tags = list(bot_module.TAG_INDEX_SFW.tags) or ['waifu']
+
+        channels = [FakeChannel(1000 + i, nsfw=(i % 5 == 0)) for i in range(args.channels)]
+        kinds = random.choices([k for k, _ in MIX], weights=[w for _, w in MIX], k=args.commands)
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+        results: List[tuple] = []
+
+        async def run_one(kind: str):
+            async with semaphore:
+                channel = random.choice(channels)
+                if kind == 'nsfw' and not channel.is_nsfw():
+                    channel = channels[0]
+                interaction = await simulate(kind, channel, random.randint(1, 10_000), tags)
+                results.append((kind, interaction))
+
+        monitor = LoopLagMonitor()
+        monitor.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(run_one(kind) for kind in kinds))
+        elapsed = time.perf_counter() - started
+        await monitor.stop()
+        await bot.close()
+
+    print(f"\n{'command':<14} {'count':>6} {'ok':>6} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    print('-' * 68)
+    for kind, _ in MIX:
+        batch = [i for k, i in results if k == kind]
+        if not batch:
+            continue
+        latencies = [(i.replied_at or time.perf_counter()) - i.created_at for i in batch]
+        ok = sum(1 for i in batch if i.succeeded)
+        print(
+            f"{kind:<14} {len(batch):>6} {ok:>6} {percentile(latencies, 50) * 1000:>9.1f} "
+            f"{percentile(latencies, 90) * 1000:>9.1f} {percentile(latencies, 99) * 1000:>9.1f} "
+            f"{max(latencies) * 1000:>9.1f}"
+        )
+    print('-' * 68)
+    print(f"Commands: {len(results)} in {elapsed:.2f}s ({len(results) / elapsed:.0f}/s)")
+    print(f"Upstream requests: {upstream.requests}  (429 injected: {upstream.rate_limited})")
+    lag = monitor.samples
+    print(
+        f"Event-loop lag: p50 {percentile(lag, 50) * 1000:.1f} ms, "
+        f"p99 {percentile(lag, 99) * 1000:.1f} ms, max {max(lag, default=0) * 1000:.1f} ms"
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load generator for the bot's slash-command handlers")
+    parser.add_argument('--commands', type=int, default=2000, help="simulated interactions")
+    parser.add_argument('--concurrency', type=int, default=200, help="interactions in flight at once")
+    parser.add_argument('--channels', type=int, default=50, help="distinct channels")
+    parser.add_argument('--latency', type=float, default=0.05, help="mock upstream latency in seconds")
+    parser.add_argument('--rate', type=float, default=5.0, help="client rate limit (req/s)")
+    parser.add_argument('--burst', type=int, default=5, help="client rate limit burst")
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help="fraction of responses that are 429")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    print("CatGirl Discord Bot - command load test (offline)")
+    print("=" * 50)
+    try:
+        asyncio.run(main(parse_args()))
+    except KeyboardInterrupt:
+        print("\nLoad test interrupted")
@@ -0,0 +1,155 @@
+"""
+Local stand-ins for the waifu.im and e621 APIs
+Used by the benchmarks and the load harness so they run without network
+"""
+
+import asyncio
+import random
+from typing import Dict, Iterable, Optional
+from aiohttp import web
+
+
+class MockUpstream:
+    """Serves /images, /tags and /posts.json with configurable latency, page sizes and 429s.
+
+    Requests are counted per bearer token; tokens in `invalid_tokens` get a 401.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        jitter: float = 0.01,
+        rate_limit_ratio: float = 0.0,
+        retry_after: int = 1,
+        max_waifu_page: int = 30,
+        max_e621_page: int = 320,
+        tag_count: int = 40,
+        invalid_tokens: Iterable[str] = ()
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.max_waifu_page = max_waifu_page
+        self.max_e621_page = max_e621_page
+        self.tags = [f'tag{i}' for i in range(tag_count)]
+        self.invalid_tokens = set(invalid_tokens)
+        self.requests: Dict[str, int] = {}
+        self.token_requests: Dict[str, int] = {}
+        self.rate_limited = 0
+        self._counter = 0
+        self._runner: Optional[web.AppRunner] = None
+        self.base_url = ''
+
+    async def _delay(self, request: web.Request) -> Optional[web.Response]:
+        self.requests[request.path] = self.requests.get(request.path, 0) + 1
+        token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if token:
+            self.token_requests[token] = self.token_requests.get(token, 0) + 1
+        await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if token in self.invalid_tokens:
+            return web.Response(status=401, text='Unauthorized')
+        if self.rate_limit_ratio and random.random() < self.rate_limit_ratio:
+            self.rate_limited += 1
+            return web.Response(
+                status=429,
+                text='Too Many Requests',
+                headers={'Retry-After': str(self.retry_after)}
+            )
+        return None
+
+    def _next_id(self) -> int:
+        self._counter += 1
+        return self._counter
+
+    async def images(self, request: web.Request) -> web.Response:
+        limited = await self._delay(request)
+        if limited:
+            return limited
+        page_size = min(int(request.query.get('pageSize', 1)), self.max_waifu_page)
+        tags = [t for t in request.query.get('tags', '').split(',') if t] or ['waifu']
+        nsfw = request.query.get('isNsfw') == 'true'
+        items = []
+        for _ in range(page_size):
+            image_id = self._next_id()
+            items.append({
+                'id': image_id,
+                'url': f'https://cdn.example/waifu/{image_id}.jpg',
+                'width': 1200,
+                'height': 1800,
+                'isNsfw': nsfw,
+                'dominantColor': '#a0b0c0',
+                'tags': [{'slug': tag} for tag in tags],
+                'artists': [{'name': 'mock-artist'}]
+            })
+        return web.json_response({'items': items})
+
+    async def tag_list(self, request: web.Request) -> web.Response:
+        limited = await self._delay(request)
+        if limited:
+            return limited
+        items = [{'slug': tag, 'description': 'explicit' if i % 4 == 0 else 'safe'} for i, tag in enumerate(self.tags)]
+        return web.json_response({'items': items})
+
+    async def posts(self, request: web.Request) -> web.Response:
+        limited = await self._delay(request)
+        if limited:
+            return limited
+        limit = min(int(request.query.get('limit', 1)), self.max_e621_page)
+        tags = request.query.get('tags', '').split()
+        posts = []
+        for _ in range(limit):
+            post_id = self._next_id()
+            # Roughly the shape (and bulk) of a real e621 post
+            posts.append({
+                'id': post_id,
+                'file': {
+                    'width': 2000, 'height': 1500, 'ext': 'png', 'size': 2500000,
+                    'md5': f'{post_id:032x}',
+                    'url': f'https://static.example/data/{post_id}.png'
+                },
+                'preview': {'width': 150, 'height': 112, 'url': f'https://static.example/preview/{post_id}.jpg'},
+                'sample': {
+                    'has': True, 'width': 850, 'height': 637,
+                    'url': f'https://static.example/sample/{post_id}.jpg',
+                    'alternates': {}
+                },
+                'score': {'up': 10, 'down': 0, 'total': 10},
+                'tags': {
+                    'general': tags + [f'general_{j}' for j in range(40)],
+                    'species': ['mammal', 'canine'],
+                    'character': [], 'copyright': [], 'artist': ['mock_artist'],
+                    'invalid': [], 'lore': [], 'meta': ['hi_res']
+                },
+                'rating': 's',
+                'fav_count': 5,
+                'sources': [f'https://example.org/{post_id}'],
+                'description': 'x' * 200,
+                'relationships': {'parent_id': None, 'children': []}
+            })
+        return web.json_response({'posts': posts})
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_get('/images', self.images)
+        app.router.add_get('/tags', self.tag_list)
+        app.router.add_get('/posts.json', self.posts)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f'http://{host}:{port}'
+        return self.base_url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
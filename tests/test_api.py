@@ -18,9 +18,9 @@ async def test_api():
         result = await api.get_random_waifu()
         if result and 'images' in result:
             image = result['images'][0]
-            print(f"✅ Успешно! URL: {image['url']}")
-            print(f"   Размер: {image['width']}x{image['height']}")
-            print(f"   NSFW: {image['is_nsfw']}")
+            print(f"✅ Успешно! URL: {image.url}")
+            print(f"   Размер: {image.width}x{image.height}")
+            print(f"   NSFW: {image.is_nsfw}")
         else:
             print("❌ Ошибка получения случайной waifu")
             return False
@@ -30,8 +30,8 @@ async def test_api():
         result = await api.get_waifu_by_tag('maid')
         if result and 'images' in result:
             image = result['images'][0]
-            tags = [tag['name'] for tag in image.get('tags', [])]
-            print(f"✅ Успешно! URL: {image['url']}")
+            tags = list(image.tags)
+            print(f"✅ Успешно! URL: {image.url}")
             print(f"   Теги: {', '.join(tags)}")
         else:
             print("❌ Ошибка получения waifu с тегом")
@@ -43,7 +43,7 @@ async def test_api():
         if result and 'images' in result:
             print(f"✅ Успешно! Получено {len(result['images'])} изображений")
             for i, image in enumerate(result['images'], 1):
-                print(f"   {i}. {image['url']}")
+                print(f"   {i}. {image.url}")
         else:
             print("❌ Ошибка получения нескольких waifu")
             return False
@@ -53,7 +53,7 @@ async def test_api():
         result = await api.get_random_waifu(nsfw=True)
         if result and 'images' in result:
             image = result['images'][0]
-            print(f"✅ Успешно! NSFW: {image['is_nsfw']}")
+            print(f"✅ Успешно! NSFW: {image.is_nsfw}")
         else:
             print("❌ Ошибка получения NSFW waifu")
             return False
@@ -107,7 +107,7 @@ async def test_detailed_search():
         if result and 'images' in result:
             print(f"✅ Расширенный поиск: найдено {len(result['images'])} изображений")
             for image in result['images']:
-                print(f"   - {image['width']}x{image['height']} px, NSFW: {image['is_nsfw']}")
+                print(f"   - {image.width}x{image.height} px, NSFW: {image.is_nsfw}")
         else:
             print("❌ Ошибка расширенного поиска")
 
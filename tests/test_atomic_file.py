@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Tests for replacing data files atomically
+
+    python -m pytest tests/test_atomic_file.py
+"""
+
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from atomic_file import atomic_write
+
+
+def test_write_replaces_the_file(tmp_path):
+    path = tmp_path / 'data' / 'state.json'
+    with atomic_write(str(path), encoding='utf-8') as f:
+        json.dump({'a': 1}, f)
+    # The directory is created and nothing is left behind
+    assert json.loads(path.read_text(encoding='utf-8')) == {'a': 1}
+    assert [p.name for p in path.parent.iterdir()] == ['state.json']
+
+
+def test_failed_write_keeps_the_old_file(tmp_path):
+    path = tmp_path / 'index.bin'
+    path.write_bytes(b'old')
+    with pytest.raises(ValueError):
+        with atomic_write(str(path), 'wb') as f:
+            f.write(b'half')
+            raise ValueError('row out of range')
+    assert path.read_bytes() == b'old'
+    assert [p.name for p in tmp_path.iterdir()] == ['index.bin']
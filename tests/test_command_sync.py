@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Tests for skipping the slash command sync when the command tree is unchanged
+
+    python -m pytest tests/test_command_sync.py
+"""
+
+import asyncio
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Optional
+
+import discord
+from discord import app_commands
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from command_sync import load_sync_state, sync_commands, tree_fingerprint
+
+
+def make_tree(description: str = 'Get a random waifu image', with_count: bool = True) -> app_commands.CommandTree:
+    client = discord.Client(intents=discord.Intents.none())
+    client._connection.application_id = 1234
+    tree = app_commands.CommandTree(client)
+
+    @tree.command(name='waifu', description=description)
+    @app_commands.describe(tag='Tag to search for')
+    async def waifu(interaction: discord.Interaction, tag: Optional[str] = None):
+        pass
+
+    if with_count:
+        @tree.command(name='furry', description='Get furry images')
+        async def furry(interaction: discord.Interaction, tags: Optional[str] = None, count: int = 1):
+            pass
+    else:
+        @tree.command(name='furry', description='Get furry images')
+        async def furry(interaction: discord.Interaction, tags: Optional[str] = None):
+            pass
+
+    return tree
+
+
+def test_fingerprint_is_stable_across_runs():
+    script = 'from tests.test_command_sync import make_tree, tree_fingerprint; print(tree_fingerprint(make_tree()))'
+    fingerprints = {
+        subprocess.run(
+            [sys.executable, '-c', script], cwd=ROOT, capture_output=True, text=True, check=True,
+            env={**os.environ, 'PYTHONHASHSEED': seed}
+        ).stdout.strip()
+        for seed in ('1', '2', '3')
+    }
+    assert fingerprints == {tree_fingerprint(make_tree())}
+
+
+def test_fingerprint_changes_with_the_commands():
+    fingerprint = tree_fingerprint(make_tree())
+    assert tree_fingerprint(make_tree(description='Get a waifu')) != fingerprint
+    assert tree_fingerprint(make_tree(with_count=False)) != fingerprint
+
+
+def test_unchanged_tree_skips_the_sync(tmp_path):
+    path = str(tmp_path / 'command_sync.json')
+    calls = []
+
+    async def fake_sync():
+        calls.append(1)
+        return []
+
+    async def sync(tree, force=False):
+        tree.sync = fake_sync
+        return await sync_commands(tree, path, force=force)
+
+    assert asyncio.run(sync(make_tree())) == []
+    assert load_sync_state(path)['1234']['fingerprint'] == tree_fingerprint(make_tree())
+    # A restart with the same commands skips it, a changed command or /sync doesn't
+    assert asyncio.run(sync(make_tree())) is None
+    assert len(calls) == 1
+    asyncio.run(sync(make_tree(description='Get a waifu')))
+    asyncio.run(sync(make_tree(description='Get a waifu'), force=True))
+    assert len(calls) == 3
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Tests for the e621 tag index, built from the fixture dump in tests/fixtures
+
+    python -m pytest tests/test_e621_tags.py
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from e621_tags import E621TagIndex, build_index, open_index, read_tag_dump
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'e621_tags.csv')
+
+
+@pytest.fixture
+def index(tmp_path):
+    path = str(tmp_path / 'e621_tags.bin')
+    build_index(read_tag_dump(FIXTURE), path)
+    index = E621TagIndex(path)
+    yield index
+    index.close()
+
+
+def test_dump_skips_unused_and_malformed_rows():
+    names = [name for name, _, _ in read_tag_dump(FIXTURE)]
+    assert 'dead_tag' not in names
+    assert 'rating_test' not in names
+    assert 'mixed_case' in names
+
+
+def test_lookup(index):
+    assert len(index) == 23
+    assert 'wolf' in index
+    assert 'WOLF ' in index
+    assert 'wolv' not in index
+    assert 'pokémon_(species)' in index
+    # A repeated name keeps its largest count
+    assert index.post_count('wolf') == 412000
+    assert index.category('foxy_(fnaf)') == 'character'
+    assert index.category('nope') is None
+
+
+def test_complete_orders_by_popularity(index):
+    assert index.complete('fo') == ['fox', 'forest', 'fox_tail', 'foxy_(fnaf)', 'fortnite']
+    assert index.complete('wolf', limit=2) == ['wolf', 'wolf_tail']
+    assert index.complete('zzz') == []
+    assert index.complete('')[:3] == ['mammal', 'anthro', 'male']
+
+
+def test_complete_wide_range_walks_popularity_order(index, monkeypatch):
+    monkeypatch.setattr('e621_tags._SCAN_LIMIT', 1)
+    assert index.complete('fo') == ['fox', 'forest', 'fox_tail', 'foxy_(fnaf)', 'fortnite']
+
+
+def test_autocomplete_keeps_earlier_terms(index):
+    assert index.autocomplete('solo -fluf', limit=2) == ['solo -fluffy', 'solo -fluffy_tail']
+    assert index.autocomplete('rating:s') == ['rating:s']
+
+
+def test_unknown_tags_and_suggestions(index):
+    assert index.unknown_tags('wolf -fluffy ~fox rating:s order:score wol*') == []
+    assert index.unknown_tags('wolf flufy') == ['flufy']
+    assert index.suggest('flufy')[0] == 'fluffy'
+    assert index.suggest('wlof') == ['wolf']
+
+
+def test_unusable_files(tmp_path):
+    assert open_index(str(tmp_path / 'missing.bin')) is None
+    corrupt = tmp_path / 'corrupt.bin'
+    corrupt.write_bytes(b'not an index at all')
+    assert open_index(str(corrupt)) is None
+    # A truncated file is rejected, not read past its end
+    path = str(tmp_path / 'e621_tags.bin')
+    build_index(read_tag_dump(FIXTURE), path)
+    data = Path(path).read_bytes()
+    Path(path).write_bytes(data[:-3])
+    assert open_index(path) is None
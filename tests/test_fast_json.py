@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Tests for decoding upstream JSON: the e621 projection and moving large
+bodies off the event loop
+
+    python -m pytest tests/test_fast_json.py
+"""
+
+import asyncio
+import json
+import sys
+import threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config import JSON_OFFLOAD_THRESHOLD
+from fast_json import decode_json, project_e621_posts
+from furry_api import FurryAPI
+
+
+def make_post(post_id: int, **overrides):
+    """Roughly the shape of a real e621 post"""
+    post = {
+        'id': post_id,
+        'file': {
+            'width': 2000, 'height': 1500, 'ext': 'png', 'size': 2500000,
+            'md5': f'{post_id:032x}', 'url': f'https://static.example/data/{post_id}.png'
+        },
+        'preview': {'width': 150, 'height': 112, 'url': f'https://static.example/preview/{post_id}.jpg'},
+        'sample': {
+            'has': True, 'width': 850, 'height': 637,
+            'url': f'https://static.example/sample/{post_id}.jpg', 'alternates': {}
+        },
+        'score': {'up': 12, 'down': 2, 'total': 10},
+        'tags': {
+            'general': [f'general_{j}' for j in range(40)],
+            'species': ['mammal', 'canine'], 'artist': ['mock_artist'], 'meta': ['hi_res']
+        },
+        'rating': 's',
+        'fav_count': 5,
+        'description': 'x' * 200,
+        'relationships': {'parent_id': None, 'children': []}
+    }
+    post.update(overrides)
+    return post
+
+
+def convert(payload):
+    return [image for image in (FurryAPI._convert_post(post, True) for post in payload['posts']) if image]
+
+
+def assert_same_records(posts):
+    payload = {'posts': posts}
+    projected = project_e621_posts(json.loads(json.dumps(payload)))
+    assert convert(projected) == convert(payload)
+    return convert(projected)
+
+
+def test_projection_keeps_what_conversion_reads():
+    (image,) = assert_same_records([make_post(1)])
+    assert image.url == 'https://static.example/data/1.png'
+    assert image.tags == tuple(f'general_{j}' for j in range(5))
+    assert image.score == 10 and image.rating == 's' and image.ext == 'png' and image.size == 2500000
+    assert [variant.kind for variant in image.variants] == ['sample', 'preview']
+
+
+def test_posts_without_a_file_url_are_dropped():
+    # Deleted or hidden posts come back without a url
+    posts = [make_post(1, file={'url': None, 'ext': 'png'}), make_post(2, file=None), make_post(3)]
+    assert len(project_e621_posts({'posts': posts})['posts']) == 1
+    assert [image.url for image in assert_same_records(posts)] == ['https://static.example/data/3.png']
+
+
+def test_sample_without_has_is_not_a_variant():
+    post = make_post(1, sample={'has': False, 'url': 'https://static.example/sample/1.jpg', 'width': 850, 'height': 637})
+    (image,) = assert_same_records([post])
+    assert [variant.kind for variant in image.variants] == ['preview']
+
+
+def test_null_tags_and_score():
+    (image,) = assert_same_records([make_post(1, tags=None, score=None)])
+    assert image.tags == () and image.score == 0
+
+
+def test_large_bodies_are_decoded_off_the_loop():
+    threads = []
+
+    def projector(payload):
+        threads.append(threading.get_ident())
+        return project_e621_posts(payload)
+
+    async def scenario():
+        small = json.dumps({'posts': [make_post(1)]}).encode()
+        large = json.dumps({'posts': [make_post(i) for i in range(100)]}).encode()
+        assert len(small) < JSON_OFFLOAD_THRESHOLD <= len(large)
+        assert len((await decode_json(small, projector))['posts']) == 1
+        assert len((await decode_json(large, projector))['posts']) == 100
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(scenario())
+    assert threads[0] == loop_thread and threads[1] != loop_thread
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Tests for the local image store used when an upstream is unavailable
+
+    python -m pytest tests/test_image_store.py
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from furry_api import parse_tag_query
+from image_store import ImageStore
+from models import ImageRecord
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def page(prefix: str, count: int, **fields):
+    return [ImageRecord(url=f'https://cdn.example/{prefix}/{i}.jpg', **fields) for i in range(count)]
+
+
+def test_tag_queries(tmp_path):
+    async def scenario():
+        store = ImageStore(str(tmp_path / 'images.db'))
+        await store.open()
+        store.record('e621', page('wolf', 10, tags=('wolf', 'solo'), rating='s'), extra_tags=['canine'])
+        store.record('e621', page('fox', 10, tags=('fox', 'solo'), rating='e', is_nsfw=True))
+        store.record('waifu', page('maid', 10, tags=('maid',)))
+
+        wolves = await store.random_images('e621', ['canine', 'solo'], count=20)
+        assert len(wolves) == 10 and all('wolf' in image.url for image in wolves)
+        assert wolves[0].tags == ('wolf', 'solo')
+        assert len(await store.random_images('e621', ['solo'], excluded=['wolf'], count=20)) == 10
+        assert await store.random_images('e621', ['solo'], nsfw=False, ratings=['e']) == []
+        assert len(await store.random_images('e621', count=50)) == 20
+        assert len(await store.random_images('waifu', count=50)) == 10
+        assert await store.random_images('e621', ['never_seen']) == []
+        await store.close()
+
+    run(scenario())
+
+
+def test_eviction_and_reopen(tmp_path):
+    path = str(tmp_path / 'images.db')
+
+    async def fill():
+        store = ImageStore(path, max_images=100)
+        await store.open()
+        for i in range(5):
+            store.record('waifu', page(f'p{i}', 40, tags=('maid',)))
+        # Re-recording an image refreshes it instead of duplicating it
+        store.record('waifu', page('p4', 40, tags=('maid',)))
+        stats = await store.stats()
+        await store.close()
+        return stats
+
+    async def reopen():
+        store = ImageStore(path, max_images=100)
+        await store.open()
+        images = await store.random_images('waifu', ['maid'], count=500)
+        await store.close()
+        return images
+
+    assert run(fill())['images'] <= 100
+    images = run(reopen())
+    # The newest pages survive eviction
+    assert any('/p4/' in image.url for image in images)
+    assert not any('/p0/' in image.url for image in images)
+
+
+def test_parse_tag_query():
+    assert parse_tag_query('wolf -fox rating:s order:random ~cat wol*') == (['wolf'], ['fox'], ['s'])
+    assert parse_tag_query('-rating:e solo') == (['solo'], [], ['s', 'q'])
+
+
+def test_cluster_processes_share_one_file(tmp_path, caplog):
+    path = str(tmp_path / 'images.db')
+
+    async def scenario():
+        # Two stores on one file, each with its own connection and thread, like two cluster processes
+        first, second = ImageStore(path, max_images=100), ImageStore(path, max_images=100)
+        await first.open()
+        await second.open()
+        first.record('waifu', page('p', 90, tags=('maid',)))
+        await first.stats()
+        # The second process didn't write those, but eviction must still count them
+        second.record('waifu', page('p', 10, tags=('maid',)) + page('q', 80, tags=('maid',)))
+        await second.stats()
+        fresh = ImageStore(path, max_images=100)
+        await fresh.open()
+        stats = await fresh.stats()
+        await fresh.close()
+        # Both keep recording the same images at the same time
+        for i in range(5):
+            first.record('waifu', page(f'r{i}', 30, tags=('maid',)))
+            second.record('waifu', page(f'r{i}', 30, tags=('maid',)))
+        await first.close()
+        await second.close()
+        return stats
+
+    assert run(scenario())['images'] <= 100
+    assert not [record for record in caplog.records if record.getMessage() == "Failed to record images"]
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Tests for the JSON log lines, DEBUG sampling and the non-blocking log queue
+
+    python -m pytest tests/test_logging_setup.py
+"""
+
+import json
+import logging
+import queue
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from logging_setup import DebugSampler, JsonFormatter, NonBlockingQueueHandler
+from metrics import LOG_RECORDS_DROPPED
+
+
+def make_record(msg: str, *args, level: int = logging.DEBUG, extra=None, exc_info=None) -> logging.LogRecord:
+    return logging.getLogger('bot').makeRecord('bot', level, 'bot.py', 1, msg, args, exc_info, extra=extra)
+
+
+def test_debug_records_are_sampled_per_call_site():
+    sampler = DebugSampler(rate=3)
+    kept = {
+        template: [sampler.filter(make_record(template, i)) for i in range(6)]
+        for template in ('Pool hit %s', 'Pool miss %s')
+    }
+    # Every third record of each site, whatever its arguments
+    assert kept == {site: [True, False, False, True, False, False] for site in ('Pool hit %s', 'Pool miss %s')}
+
+    record = make_record('Pool hit %s', 'x')
+    sampler = DebugSampler(rate=3)
+    assert sampler.filter(record) and record.sample_rate == 3
+    # INFO and above are never sampled
+    assert all(sampler.filter(make_record('Pool hit %s', i, level=logging.INFO)) for i in range(5))
+
+
+def test_full_queue_drops_records_and_counts_them():
+    log_queue = queue.Queue(maxsize=2)
+    handler = NonBlockingQueueHandler(log_queue)
+    dropped = LOG_RECORDS_DROPPED.value()
+    for i in range(5):
+        handler.handle(make_record('Refill %s', i, level=logging.INFO))
+    assert log_queue.qsize() == 2
+    assert LOG_RECORDS_DROPPED.value() == dropped + 3
+    # Queued records carry the merged message, not the arguments
+    record = log_queue.get_nowait()
+    assert record.msg == 'Refill 0' and record.args is None
+
+
+def test_json_lines_carry_extra_fields():
+    formatter = JsonFormatter(fields={'cluster': 2})
+    line = formatter.format(make_record(
+        'Rate limiter wait', level=logging.INFO, extra={'upstream': 'e621.net', 'wait_s': 1.5, '_private': 1}
+    ))
+    entry = json.loads(line)
+    assert entry.pop('ts').endswith('Z')
+    assert entry == {
+        'level': 'INFO', 'logger': 'bot', 'msg': 'Rate limiter wait',
+        'cluster': 2, 'upstream': 'e621.net', 'wait_s': 1.5
+    }
+
+    try:
+        raise ValueError('bad payload')
+    except ValueError:
+        record = make_record('Decode failed', level=logging.ERROR, exc_info=sys.exc_info())
+    assert 'ValueError: bad payload' in json.loads(formatter.format(record))['exc']
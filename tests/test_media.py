@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Tests for e621 media variant selection
+
+    python -m pytest tests/test_media.py
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from furry_api import FurryAPI
+from media import MEDIA_POLICIES, MediaPolicy, select_variant, url_extension
+
+
+def post(ext='png', size=2_500_000, width=2000, height=1500, sample=True):
+    return {
+        'file': {'url': f'https://static.example/data/1.{ext}', 'ext': ext, 'size': size, 'width': width, 'height': height},
+        'sample': {'has': sample, 'url': 'https://static.example/sample/1.jpg', 'width': 850, 'height': 637},
+        'preview': {'url': 'https://static.example/preview/1.jpg', 'width': 150, 'height': 112},
+        'tags': {'general': ['wolf']},
+        'rating': 's',
+        'score': {'total': 3}
+    }
+
+
+def test_url_extension():
+    assert url_extension('https://x.example/a/b.JPG?v=1') == 'jpg'
+    assert url_extension('https://x.example/a/b') is None
+
+
+def test_lightest_variant_that_fits():
+    image = FurryAPI._convert_post(post(), nsfw=False)
+    assert select_variant(image, MEDIA_POLICIES['original']).kind == 'original'
+    # The 850px sample is large enough, so the 2.5 MB original is not sent
+    assert select_variant(image, MEDIA_POLICIES['balanced']).kind == 'sample'
+    assert select_variant(image, MEDIA_POLICIES['small']).kind == 'sample'
+    assert select_variant(image, MediaPolicy(min_dimension=100)).kind == 'preview'
+    assert select_variant(image, MediaPolicy(min_dimension=1000)).kind == 'original'
+    # Nothing reaches the minimum size: the fullest variant that fits
+    assert select_variant(image, MediaPolicy(max_dimension=200)).kind == 'preview'
+    assert select_variant(image, MediaPolicy(extensions=frozenset({'gif'}))) is None
+
+    huge = FurryAPI._convert_post(post(size=40_000_000, width=6000, height=4000), nsfw=False)
+    assert select_variant(huge, MEDIA_POLICIES['balanced']).kind == 'sample'
+    assert select_variant(huge, MediaPolicy(min_dimension=1000)).kind == 'sample'
+
+    # A small original without a sample is shown as is
+    small = FurryAPI._convert_post(post(size=300_000, width=640, height=480, sample=False), nsfw=False)
+    assert select_variant(small, MEDIA_POLICIES['balanced']).kind == 'original'
+
+
+def test_videos_embed_their_still_or_are_dropped():
+    video = FurryAPI._convert_post(post(ext='webm'), nsfw=False)
+    assert select_variant(video, MEDIA_POLICIES['original']).kind == 'sample'
+    # Without a sample, the preview still is used
+    assert select_variant(FurryAPI._convert_post(post(ext='webm', sample=False), nsfw=False)).kind == 'preview'
+    no_stills = post(ext='swf', sample=False)
+    no_stills['preview'] = {}
+    assert FurryAPI._convert_post(no_stills, nsfw=False) is None
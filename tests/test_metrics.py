@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Tests for the Prometheus text exposition of the metrics registry
+
+    python -m pytest tests/test_metrics.py
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+from aiohttp.test_utils import make_mocked_request
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from metrics import MetricsRegistry, metrics_handler
+
+
+def test_help_type_and_escaped_labels():
+    registry = MetricsRegistry()
+    requests = registry.counter('requests_total', 'Requests by "path"\nand status \\ code', ('path', 'status'))
+    requests.inc(path='/a"b\\c\nd', status=200)
+    requests.inc(2.5, path='/plain', status=500)
+    registry.gauge('queue_depth', 'Queued commands').set(3)
+
+    assert registry.render().splitlines() == [
+        '# HELP requests_total Requests by "path"\\nand status \\\\ code',
+        '# TYPE requests_total counter',
+        'requests_total{path="/a\\"b\\\\c\\nd",status="200"} 1',
+        'requests_total{path="/plain",status="500"} 2.5',
+        '# HELP queue_depth Queued commands',
+        '# TYPE queue_depth gauge',
+        'queue_depth 3',
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    latency = registry.histogram('latency_seconds', 'Latency', ('upstream',), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        latency.observe(value, upstream='e621')
+
+    assert registry.render().splitlines()[2:] == [
+        'latency_seconds_bucket{upstream="e621",le="0.1"} 2',
+        'latency_seconds_bucket{upstream="e621",le="1"} 3',
+        'latency_seconds_bucket{upstream="e621",le="+Inf"} 4',
+        'latency_seconds_sum{upstream="e621"} 3.65',
+        'latency_seconds_count{upstream="e621"} 4',
+    ]
+
+
+def test_function_gauge_is_read_at_scrape_time():
+    registry = MetricsRegistry()
+    pool = []
+    registry.gauge('pool_images', 'Images in the pool').set_function(lambda: len(pool))
+    pool.extend(range(7))
+    assert registry.render().splitlines()[-1] == 'pool_images 7'
+
+
+def test_metrics_endpoint_content_type():
+    async def scenario():
+        return await metrics_handler(make_mocked_request('GET', '/metrics'))
+
+    response = asyncio.run(scenario())
+    assert response.headers['Content-Type'] == 'text/plain; version=0.0.4; charset=utf-8'
+    assert response.body.decode('utf-8').endswith('\n')
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Tests for mixed-tag requests: the partial-results cutoff, the round-robin
+merge and what happens to images that are not shown
+
+    python -m pytest tests/test_mixed_images.py
+"""
+
+import asyncio
+import functools
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bot import WaifuBot
+from models import ImageRecord
+from prefetch import PrefetchPool
+from recent import RecentlySeen
+
+CHANNEL = 42
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def page(prefix: str, count: int):
+    return [ImageRecord(url=f'https://cdn.example/{prefix}/{i}.jpg') for i in range(count)]
+
+
+def urls(images):
+    return [image.url for image in images]
+
+
+class Tags:
+    """A fetcher serving a page per tag, after a delay (None: never)"""
+
+    def __init__(self, **pages):
+        self.pages = pages
+        self.delays = {}
+
+    async def fetch(self, nsfw, tag, page_size):
+        delay = self.delays.get(tag, 0)
+        if delay is None:
+            await asyncio.Event().wait()
+        await asyncio.sleep(delay)
+        return {'images': self.pages.pop(tag, [])}
+
+
+def make_bot(tags: Tags):
+    """Just what get_mixed_images needs from the bot"""
+    pool = PrefetchPool(low_water=0)
+    pool.register_source('waifu', tags.fetch, 4)
+    bot = SimpleNamespace(prefetch=pool, recent=RecentlySeen(per_channel=50, max_channels=10))
+    bot.get_fresh_images = functools.partial(WaifuBot.get_fresh_images, bot)
+    return bot
+
+
+async def mixed(bot, tags, count, partial_after=1.0):
+    interaction = SimpleNamespace(channel_id=CHANNEL)
+    requests = [('waifu', tag) for tag in tags]
+    return await WaifuBot.get_mixed_images(bot, interaction, requests, False, count, partial_after=partial_after)
+
+
+def test_parts_are_interleaved_without_duplicates():
+    maid = page('maid', 2)
+    shared = ImageRecord(url='https://cdn.example/shared.jpg')
+    tags = Tags(maid=[maid[0], shared], uniform=[shared, maid[1]])
+
+    async def scenario():
+        bot = make_bot(tags)
+        result = await mixed(bot, ['maid', 'uniform'], 4)
+        await bot.prefetch.close()
+        return result
+
+    assert urls(run(scenario())['images']) == urls([maid[0], shared, maid[1]])
+
+
+def test_images_trimmed_off_go_back_unseen():
+    maid, uniform = page('maid', 2), page('uniform', 2)
+    tags = Tags(maid=maid, uniform=uniform)
+
+    async def scenario():
+        bot = make_bot(tags)
+        # Two per tag are taken for three images
+        result = await mixed(bot, ['maid', 'uniform'], 3)
+        recent = [bot.recent.seen(CHANNEL, image.url) for image in maid + uniform]
+        again = await bot.prefetch.get_images('waifu', False, 'uniform', 1)
+        await bot.prefetch.close()
+        return result, recent, again
+
+    result, recent, again = run(scenario())
+    assert urls(result['images']) == urls([maid[0], uniform[0], maid[1]])
+    assert recent == [True, True, True, False]
+    # The next command for the tag gets it first
+    assert urls(again['images']) == urls(uniform[1:])
+
+
+def test_slow_part_is_cut_off_and_hands_its_images_back():
+    maid = page('maid', 2)
+    tags = Tags(maid=maid, uniform=page('uniform', 1))
+
+    async def scenario():
+        bot = make_bot(tags)
+        pool = bot.prefetch
+        # The uniform part gets one image, then waits on a refill that never comes
+        await pool.warmup([('waifu', False, 'uniform')])
+        tags.delays['uniform'] = None
+        result = await mixed(bot, ['maid', 'uniform'], 4, partial_after=0.05)
+        stats = pool.stats()
+        await pool.close()
+        return result, stats
+
+    result, stats = run(scenario())
+    assert urls(result['images']) == urls(maid)
+    assert stats['images'] == 1 and stats['waiters'] == 0
+
+
+def test_waits_past_the_cutoff_for_the_first_images():
+    tags = Tags(maid=page('maid', 2))
+    tags.delays.update(maid=0.1, uniform=None)
+
+    async def scenario():
+        bot = make_bot(tags)
+        result = await mixed(bot, ['maid', 'uniform'], 4, partial_after=0.01)
+        await bot.prefetch.close()
+        return result
+
+    assert urls(run(scenario())['images']) == urls(page('maid', 2))
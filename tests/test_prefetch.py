@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Tests for the prefetch pool and its queue of waiting commands
+
+    python -m pytest tests/test_prefetch.py
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from deadline import deadline_after
+from models import ImageRecord
+from prefetch import PrefetchPool
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def page(prefix: str, count: int):
+    return [ImageRecord(url=f'https://cdn.example/{prefix}/{i}.jpg') for i in range(count)]
+
+
+def urls(result):
+    return [image.url for image in result['images']] if result else []
+
+
+class Upstream:
+    """A fetcher that returns the pages the test hands it, one per call"""
+
+    def __init__(self):
+        self.pages = asyncio.Queue()
+        self.calls = 0
+
+    async def fetch(self, nsfw, tag, page_size):
+        self.calls += 1
+        return {'images': await self.pages.get()}
+
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_queued_commands_are_served_in_order_across_refills():
+    async def scenario():
+        pool = PrefetchPool(low_water=0)
+        upstream = Upstream()
+        pool.register_source('test', upstream.fetch, 2)
+        tasks = [asyncio.create_task(pool.get_images('test', False, None, 2)) for _ in range(3)]
+        await settle()
+        assert pool.stats()['waiters'] == 3 and upstream.calls == 1
+
+        served = []
+        for n in range(3):
+            upstream.pages.put_nowait(page(f'page{n}', 2))
+            await settle()
+            served.append([task.done() for task in tasks])
+        assert served == [[True, False, False], [True, True, False], [True, True, True]]
+        # Each command got the whole page that arrived while it was first in line
+        assert [urls(task.result()) for task in tasks] == [urls({'images': page(f'page{n}', 2)}) for n in range(3)]
+        assert upstream.calls == 3
+        await pool.close()
+
+    run(scenario())
+
+
+def test_short_head_of_queue_waits_a_bounded_number_of_refills():
+    async def scenario():
+        pool = PrefetchPool(low_water=0, max_refill_waits=2)
+        upstream = Upstream()
+        pool.register_source('test', upstream.fetch, 2)
+        for n in range(10):
+            upstream.pages.put_nowait(page(f'page{n}', 2))
+        # Everything upstream was already seen in this channel
+        result = await pool.get_images('test', False, None, 2, exclude=lambda image: True)
+        calls = upstream.calls
+        await pool.close()
+        return result, calls
+
+    result, calls = run(scenario())
+    # The first refill plus max_refill_waits more, then repeats rather than nothing
+    assert calls == 3
+    assert len(result['images']) == 2
+
+
+def test_deadline_returns_what_was_collected():
+    async def scenario():
+        pool = PrefetchPool(low_water=0)
+        upstream = Upstream()
+        pool.register_source('test', upstream.fetch, 2)
+        upstream.pages.put_nowait(page('first', 2))
+        # The second page never arrives
+        with deadline_after(0.05):
+            result = await pool.get_images('test', False, None, 4)
+        stats = pool.stats()
+        await pool.close()
+        return result, stats
+
+    result, stats = run(scenario())
+    assert urls(result) == urls({'images': page('first', 2)})
+    assert stats['waiters'] == 0
+
+
+def test_cancelled_command_hands_its_images_back():
+    async def scenario():
+        pool = PrefetchPool(low_water=0)
+        upstream = Upstream()
+        pool.register_source('test', upstream.fetch, 2)
+        task = asyncio.create_task(pool.get_images('test', False, None, 4))
+        upstream.pages.put_nowait(page('first', 2))
+        await settle()
+        assert not task.done() and pool.stats()['images'] == 0
+        task.cancel()
+        await settle()
+        assert task.cancelled()
+        # They are back at the front of the pool for the next command
+        assert pool.stats()['images'] == 2
+        result = await pool.get_images('test', False, None, 2)
+        await pool.close()
+        return result
+
+    assert urls(run(scenario())) == urls({'images': page('first', 2)})
+
+
+def test_rejected_images_are_never_served_as_repeats():
+    async def scenario():
+        pool = PrefetchPool(low_water=0)
+        images = page('p', 4)
+
+        async def fetcher(nsfw, tag, page_size):
+            return {'images': images}
+
+        pool.register_source('test', fetcher, 4)
+        seen = {images[0].url, images[1].url}
+        rejected = {images[1].url, images[2].url}
+        result = await pool.get_images(
+            'test', False, None, 4,
+            exclude=lambda image: image.url in seen,
+            reject=lambda image: image.url in rejected
+        )
+        await pool.close()
+        return urls(result)
+
+    served = run(scenario())
+    # The fresh image first, then the seen one as a repeat; rejected ones never
+    assert served == ['https://cdn.example/p/3.jpg', 'https://cdn.example/p/0.jpg']
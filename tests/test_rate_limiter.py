@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Tests for the token bucket's dispatcher: FIFO order, the interactive
+reserve, aging of background waiters, deadline drops, cancellation and
+holding callers back for Retry-After
+
+    python -m pytest tests/test_rate_limiter.py
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import deadline
+import rate_limiter
+from deadline import DeadlineExceeded, upstream_deadline
+from priority import INTERACTIVE, MAINTENANCE, REFILL
+from rate_limiter import TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    # Only the limiter and deadlines see the fake time; the event loop keeps the real clock
+    fake_time = SimpleNamespace(monotonic=clock.monotonic)
+    monkeypatch.setattr(rate_limiter, 'time', fake_time)
+    monkeypatch.setattr(deadline, 'time', fake_time)
+    return clock
+
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+class Harness:
+    """Queues acquires on a bucket and records the order tokens are granted in"""
+
+    def __init__(self, bucket: TokenBucket, clock: FakeClock):
+        self.bucket = bucket
+        self.clock = clock
+        self.granted = []
+
+    def acquire(self, name: str, priority=INTERACTIVE) -> asyncio.Task:
+        async def run():
+            await self.bucket.acquire(priority)
+            self.granted.append(name)
+        return asyncio.create_task(run())
+
+    async def advance(self, seconds: float):
+        self.clock.now += seconds
+        self.bucket._wake_dispatcher()
+        await settle()
+
+
+async def drained(rate=1.0, burst=1, reserve=0, aging=0.0, clock=None):
+    """A bucket with every token taken"""
+    bucket = TokenBucket(rate, burst, name='test', reserve=reserve, aging=aging)
+    for _ in range(burst):
+        await bucket.acquire(INTERACTIVE)
+    return Harness(bucket, clock)
+
+
+def test_waiters_are_served_in_arrival_order(clock):
+    async def scenario():
+        h = await drained(clock=clock)
+        tasks = [h.acquire(name) for name in 'abcd']
+        await settle()
+        for expected in (['a'], ['a', 'b'], ['a', 'b', 'c'], ['a', 'b', 'c', 'd']):
+            await h.advance(1.0)
+            assert h.granted == expected
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiters_keep_fifo_order(clock):
+    async def scenario():
+        h = await drained(clock=clock)
+        a, b, c = h.acquire('a'), h.acquire('b'), h.acquire('c')
+        await settle()
+        # A queued waiter leaving takes no token with it
+        b.cancel()
+        await h.advance(1.0)
+        assert h.granted == ['a']
+
+        # Granted, but cancelled before it could use the token: the token goes
+        # back and the next in line gets it, not a later arrival
+        await h.advance(1.0)
+        assert h.granted == ['a', 'c']
+        d, e = h.acquire('d'), h.acquire('e')
+        await settle()
+        # Grant d's token as the dispatcher does, and cancel d before its task resumes
+        h.clock.now += 1.0
+        h.bucket._refill(h.clock.now)
+        waiter = h.bucket._waiters.pop(0)
+        h.bucket._tokens -= 1
+        waiter.future.set_result(None)
+        d.cancel()
+        late = h.acquire('late')
+        await settle()
+        assert h.granted == ['a', 'c', 'e']
+        assert h.bucket.queued == 1
+        await h.advance(1.0)
+        assert h.granted == ['a', 'c', 'e', 'late']
+        await asyncio.gather(a, c, e, late)
+        for task in (b, d):
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_is_skipped_before_its_task_resumes(clock):
+    async def scenario():
+        h = await drained(clock=clock)
+        b, c = h.acquire('b'), h.acquire('c')
+        await settle()
+        # Cancelling b cancels its queued future at once; b only leaves the queue
+        # when its task next runs. A dispatcher pass in between must skip it.
+        b.cancel()
+        clock.now += 1.0
+        dispatch = h.bucket._dispatch()
+        with pytest.raises(StopIteration):
+            dispatch.send(None)
+        await settle()
+        assert h.granted == ['c'] and h.bucket.queued == 0
+        with pytest.raises(asyncio.CancelledError):
+            await b
+        await c
+
+    asyncio.run(scenario())
+
+
+def test_background_work_leaves_the_reserve_to_interactive(clock):
+    async def scenario():
+        bucket = TokenBucket(1.0, burst=3, name='test', reserve=1, aging=0.0)
+        h = Harness(bucket, clock)
+        await bucket.acquire(INTERACTIVE)
+        await bucket.acquire(INTERACTIVE)
+        # One token left, and it is the interactive reserve
+        assert not bucket.try_acquire(REFILL)
+        refill = h.acquire('refill', REFILL)
+        await settle()
+        assert h.granted == []
+        command = h.acquire('command')
+        await settle()
+        assert h.granted == ['command']
+        # The refill runs once a token beyond the reserve is there
+        await h.advance(1.0)
+        assert h.granted == ['command']
+        await h.advance(1.0)
+        assert h.granted == ['command', 'refill']
+        await asyncio.gather(refill, command)
+
+    asyncio.run(scenario())
+
+
+def test_interactive_goes_first_without_aging(clock):
+    async def scenario():
+        h = await drained(clock=clock)
+        tasks = [h.acquire('maintenance', MAINTENANCE), h.acquire('refill', REFILL), h.acquire('command')]
+        await settle()
+        for _ in range(3):
+            await h.advance(1.0)
+        assert h.granted == ['command', 'refill', 'maintenance']
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+
+def test_aged_background_waiter_is_not_starved(clock):
+    async def scenario():
+        h = await drained(rate=0.01, aging=10.0, clock=clock)
+        refill = h.acquire('refill', REFILL)
+        await settle()
+        # After waiting one aging period the refill counts as interactive,
+        # and it queued first
+        h.clock.now += 10.0
+        command = h.acquire('command')
+        await settle()
+        await h.advance(90.0)
+        assert h.granted == ['refill']
+        await h.advance(100.0)
+        assert h.granted == ['refill', 'command']
+        await asyncio.gather(refill, command)
+
+    asyncio.run(scenario())
+
+
+def test_waiter_is_dropped_when_its_deadline_passes(clock):
+    async def scenario():
+        h = await drained(clock=clock)
+        limit = [clock.now + 5.0]
+
+        async def bounded():
+            with upstream_deadline(lambda: limit[0]):
+                await h.bucket.acquire(INTERACTIVE)
+
+        first = h.acquire('first')
+        task = asyncio.create_task(bounded())
+        last = h.acquire('last')
+        await settle()
+        assert h.bucket.queued == 3
+        limit[0] = clock.now - 1.0
+        h.bucket._wake_dispatcher()
+        await settle()
+        with pytest.raises(DeadlineExceeded):
+            await task
+        assert h.bucket.queued == 2
+        await h.advance(1.0)
+        await h.advance(1.0)
+        assert h.granted == ['first', 'last']
+        await asyncio.gather(first, last)
+
+    asyncio.run(scenario())
+
+
+def test_hopeless_caller_does_not_queue(clock):
+    async def scenario():
+        h = await drained(rate=0.1, clock=clock)
+        with upstream_deadline(clock.now + 1.0):
+            with pytest.raises(DeadlineExceeded):
+                await h.bucket.acquire(INTERACTIVE)
+        assert h.bucket.queued == 0
+
+    asyncio.run(scenario())
+
+
+def test_background_queue_does_not_turn_commands_away(clock):
+    async def scenario():
+        h = await drained(burst=2, reserve=1, clock=clock)
+        refills = [h.acquire(f'refill{i}', REFILL) for i in range(15)]
+        await settle()
+        # Fifteen refills queued, but a command goes before all of them: next token
+        assert h.bucket.estimated_wait(INTERACTIVE) == pytest.approx(1.0)
+        assert h.bucket.estimated_wait(REFILL) == pytest.approx(17.0)
+
+        async def command():
+            with upstream_deadline(clock.now + 10.0):
+                await h.bucket.acquire(INTERACTIVE)
+            h.granted.append('command')
+
+        task = asyncio.create_task(command())
+        await settle()
+        await h.advance(1.0)
+        assert h.granted == ['command']
+        await task
+        # A refill with the same deadline is behind the queue and gives up at once
+        with upstream_deadline(clock.now + 10.0):
+            with pytest.raises(DeadlineExceeded):
+                await h.bucket.acquire(REFILL)
+        for refill in refills:
+            refill.cancel()
+        await asyncio.gather(*refills, return_exceptions=True)
+
+    asyncio.run(scenario())
+
+
+def test_deferred_bucket_holds_callers_for_retry_after(clock):
+    async def scenario():
+        h = Harness(TokenBucket(1.0, 2, name='test', reserve=0), clock)
+        # A 429 with Retry-After: 3 while the bucket was full
+        h.bucket.defer(3.0)
+        assert not h.bucket.try_acquire(INTERACTIVE)
+        assert h.bucket.estimated_wait(INTERACTIVE) == pytest.approx(3.0)
+        with upstream_deadline(clock.now + 2.0):
+            with pytest.raises(DeadlineExceeded):
+                await h.bucket.acquire(INTERACTIVE)
+
+        tasks = [h.acquire(name) for name in 'ab']
+        await settle()
+        await h.advance(2.0)
+        assert h.granted == []
+        await h.advance(1.0)
+        assert h.granted == ['a']
+        await h.advance(1.0)
+        assert h.granted == ['a', 'b']
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
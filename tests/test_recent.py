@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Tests for the per-channel record of recently shown images
+
+    python -m pytest tests/test_recent.py
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from recent import RecentlySeen
+
+
+def keys(prefix: str, count: int):
+    return [f'https://cdn.example/{prefix}/{i}.jpg' for i in range(count)]
+
+
+def test_generations_rotate_at_per_channel():
+    recent = RecentlySeen(per_channel=50, max_channels=10)
+    first, second, third = keys('first', 50), keys('second', 50), keys('third', 50)
+    recent.add(1, first)
+    recent.add(1, second)
+    # Two generations: both pages are still remembered
+    assert all(recent.seen(1, key) for key in first + second)
+
+    recent.add(1, third)
+    assert all(recent.seen(1, key) for key in second + third)
+    # The oldest generation is gone; only the odd false positive is left of it
+    assert sum(recent.seen(1, key) for key in first) < 10
+
+
+def test_least_recently_active_channel_is_dropped():
+    recent = RecentlySeen(per_channel=10, max_channels=2)
+    recent.add('a', ['x'])
+    recent.add('b', ['x'])
+    # Touching a channel keeps it
+    recent.add('a', ['y'])
+    recent.add('c', ['x'])
+    assert len(recent) == 2
+    assert recent.seen('a', 'x') and recent.seen('c', 'x')
+    assert not recent.seen('b', 'x')
+
+
+def test_false_positive_rate_is_bounded():
+    recent = RecentlySeen(per_channel=200, max_channels=10, error_rate=0.01)
+    # Both generations full
+    recent.add(1, keys('seen', 400))
+    unseen = keys('new', 20000)
+    rate = sum(recent.seen(1, key) for key in unseen) / len(unseen)
+    # Each generation is sized for error_rate, and a lookup checks two
+    assert rate < 3 * 0.01
+    assert not recent.seen(2, unseen[0])
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Tests for the retry engine, its retry budget and circuit breaker
+
+    python -m pytest tests/test_retry.py
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import retry
+from retry import CircuitBreaker, CircuitOpenError, RetryableError, RetryBudget, RetryEngine
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    async def sleep(self, delay: float):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    # Only the retry module sees the fake time; the event loop keeps the real clock
+    monkeypatch.setattr(retry, 'time', SimpleNamespace(monotonic=clock.monotonic))
+    monkeypatch.setattr(retry.asyncio, 'sleep', clock.sleep)
+    return clock
+
+
+def failing(*errors):
+    """An operation raising `errors` in turn, then returning 'ok'"""
+    calls = []
+
+    async def operation():
+        calls.append(1)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return 'ok'
+
+    operation.calls = calls
+    return operation
+
+
+def test_backoff_is_full_jitter_within_the_cap():
+    engine = RetryEngine('t', base_delay=0.5, max_delay=4.0)
+    for attempt, ceiling in ((1, 1.0), (2, 2.0), (3, 4.0), (6, 4.0)):
+        delays = [engine._backoff(attempt) for _ in range(500)]
+        assert all(0 <= delay <= ceiling for delay in delays)
+        # Spread over the whole window, not bunched at the top
+        assert min(delays) < ceiling * 0.2 and max(delays) > ceiling * 0.8
+
+
+def test_retries_until_success(clock):
+    engine = RetryEngine('t', max_attempts=3, base_delay=0.5)
+    operation = failing(RetryableError('503', status=503), RetryableError('503', status=503))
+    assert asyncio.run(engine.run(operation)) == 'ok'
+    assert len(operation.calls) == 3 and engine.retries == 2
+    assert len(clock.sleeps) == 2 and all(0 <= delay <= 2.0 for delay in clock.sleeps)
+    assert engine.breaker.state == CircuitBreaker.CLOSED and engine.breaker.failures == 0
+
+
+def test_retry_budget_is_exhausted(clock):
+    budget = RetryBudget(ratio=0.5, min_per_second=0.0, max_tokens=2.0)
+    assert budget.try_withdraw() and budget.try_withdraw()
+    assert not budget.try_withdraw()
+    budget.record_request()
+    budget.record_request()
+    assert budget.try_withdraw() and not budget.try_withdraw()
+
+    # An exhausted budget turns retries into immediate failures
+    engine = RetryEngine('t', max_attempts=5, budget=RetryBudget(ratio=0.0, min_per_second=0.0, max_tokens=1.0))
+    operation = failing(*[RetryableError('503', status=503)] * 4)
+    with pytest.raises(RetryableError):
+        asyncio.run(engine.run(operation))
+    assert len(operation.calls) == 2 and engine.retries == 1
+
+    # The time-based allowance refills it
+    quiet = RetryBudget(ratio=0.0, min_per_second=0.5, max_tokens=1.0)
+    assert quiet.try_withdraw() and not quiet.try_withdraw()
+    clock.now += 2.0
+    assert quiet.try_withdraw()
+
+
+def test_retry_after_beyond_the_limit_fails_fast(clock):
+    engine = RetryEngine('t', max_retry_after=5.0)
+    operation = failing(RetryableError('429', status=429, retry_after=60.0))
+    with pytest.raises(RetryableError):
+        asyncio.run(engine.run(operation))
+    assert len(operation.calls) == 1 and clock.sleeps == []
+
+    # A short one is honoured: the retry waits at least that long
+    engine = RetryEngine('t', max_retry_after=5.0)
+    operation = failing(RetryableError('429', status=429, retry_after=3.0))
+    assert asyncio.run(engine.run(operation)) == 'ok'
+    assert clock.sleeps and clock.sleeps[0] >= 3.0
+
+
+def test_half_open_lets_a_single_probe_through(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10.0)
+    breaker.record_failure()
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN and not breaker.allow_request()
+
+    clock.now += 10.0
+    assert breaker.allow_request()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow_request() and not breaker.allow_request()
+    # A failed probe opens the circuit again
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN and not breaker.allow_request()
+
+    clock.now += 10.0
+    assert breaker.allow_request()
+    # A probe that ended without a verdict lets the next one through
+    breaker.release_probe()
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow_request() and breaker.allow_request()
+
+
+def test_open_circuit_fails_fast(clock):
+    engine = RetryEngine('t', breaker=CircuitBreaker(failure_threshold=1, reset_timeout=10.0))
+    # The failure opens the circuit, so the retry itself is cut short
+    operation = failing(*[RetryableError('503', status=503)] * 3)
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(engine.run(operation))
+    assert len(operation.calls) == 1
+
+    operation = failing()
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(engine.run(operation))
+    assert operation.calls == [] and engine.fast_failures == 2
+
+
+class Limiter:
+    """Records how long the engine holds the host's token bucket back"""
+
+    def __init__(self):
+        self.deferred = []
+
+    def defer(self, seconds: float):
+        self.deferred.append(seconds)
+
+
+def test_throttled_requests_queue_on_the_limiter(clock):
+    limiter = Limiter()
+    # No retry budget left: throttled retries are held to the host's rate instead
+    engine = RetryEngine(
+        't', max_attempts=3, breaker=CircuitBreaker(failure_threshold=1),
+        budget=RetryBudget(ratio=0.0, min_per_second=0.0, max_tokens=0.0), limiter=limiter
+    )
+    operation = failing(*[RetryableError('429', status=429, retry_after=1.0)] * 2)
+    assert asyncio.run(engine.run(operation)) == 'ok'
+    assert limiter.deferred == [1.0, 1.0] and clock.sleeps == [0.0, 0.0]
+    # Busy, not broken: the circuit stays closed for everyone else
+    assert engine.breaker.state == CircuitBreaker.CLOSED and engine.breaker.failures == 0
+
+
+def test_long_retry_after_holds_the_limiter_only_briefly(clock):
+    limiter = Limiter()
+    engine = RetryEngine('t', max_retry_after=5.0, breaker=CircuitBreaker(reset_timeout=30.0), limiter=limiter)
+    with pytest.raises(RetryableError):
+        asyncio.run(engine.run(failing(RetryableError('slow down', status=429, retry_after=3600))))
+    assert clock.sleeps == [] and limiter.deferred == [30.0]
+    assert engine.breaker.allow_request()
+
+
+def test_key_scoped_failures_leave_the_circuit_closed(clock):
+    engine = RetryEngine('t', max_retry_after=5.0, breaker=CircuitBreaker(failure_threshold=1))
+    # Every token quarantined for an hour: fail fast, the host stays reachable
+    revoked = RetryableError('all tokens quarantined', status=429, retry_after=3600, key_scoped=True)
+    with pytest.raises(RetryableError):
+        asyncio.run(engine.run(failing(revoked)))
+    assert engine.breaker.state == CircuitBreaker.CLOSED and clock.sleeps == []
+
+    # A throttled token: retry at once with another one
+    throttled = RetryableError('429', status=429, key_scoped=True)
+    # Every token briefly throttled: wait for the first to cool down
+    cooling = RetryableError('all tokens quarantined', status=429, retry_after=2.0, key_scoped=True)
+    assert asyncio.run(engine.run(failing(throttled, cooling))) == 'ok'
+    assert clock.sleeps == [0.0, 2.0]
+    assert engine.breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Tests for the cluster launcher: splitting shards over processes and the
+supervisor's restart policy (no processes are spawned)
+
+    python -m pytest tests/test_run.py
+"""
+
+import importlib.util
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Optional
+from unittest import mock
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import logging_setup
+
+# The launcher sets up logging to bot.log on import; keep the test run's logging as it is
+with mock.patch.object(logging_setup, 'setup_logging'):
+    _spec = importlib.util.spec_from_file_location('launcher', ROOT / 'scripts' / 'run.py')
+    launcher = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(launcher)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(launcher, 'time', SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+@pytest.fixture
+def supervisor():
+    return launcher.ClusterSupervisor(4, launcher.split_shards(4, 2))
+
+
+def crash(supervisor, clock, uptime: float, exitcode: int = launcher.EXIT_CRASH) -> Optional[float]:
+    """Run cluster 0 for `uptime` seconds, exit it and return the restart delay (None: no restart)"""
+    supervisor.processes[0] = object()
+    supervisor._started_at[0] = clock.now
+    clock.now += uptime
+    supervisor._handle_exit(0, exitcode)
+    restart_at = supervisor._restart_at.pop(0, None)
+    return None if restart_at is None else restart_at - clock.now
+
+
+def test_shards_are_split_into_contiguous_near_equal_ranges():
+    assert launcher.split_shards(10, 3) == [[0, 1, 2, 3], [4, 5, 6], [7, 8, 9]]
+    assert launcher.split_shards(4, 1) == [[0, 1, 2, 3]]
+    # Never an empty cluster
+    assert launcher.split_shards(2, 4) == [[0], [1]]
+
+
+def test_restart_backoff_doubles_up_to_the_cap(clock, supervisor):
+    delays = [crash(supervisor, clock, 5.0) for _ in range(8)]
+    assert delays == [1, 2, 4, 8, 16, 32, 60, 60]
+    assert not supervisor._stopping and supervisor.exitcode == launcher.EXIT_OK
+
+
+def test_stable_uptime_resets_the_backoff(clock, supervisor):
+    for _ in range(4):
+        crash(supervisor, clock, 5.0)
+    assert crash(supervisor, clock, launcher.STABLE_UPTIME) == 1
+    assert crash(supervisor, clock, 5.0) == 2
+
+
+def test_fatal_exit_stops_the_supervisor(clock, supervisor):
+    assert crash(supervisor, clock, 5.0, launcher.EXIT_FATAL) is None
+    assert supervisor._stopping and supervisor.exitcode == launcher.EXIT_FATAL
+    # Clusters exiting during the shutdown are not restarted either
+    assert crash(supervisor, clock, 5.0) is None
+
+
+def test_clean_exit_is_not_restarted(clock, supervisor):
+    assert crash(supervisor, clock, 5.0, launcher.EXIT_OK) is None
+    assert not supervisor._stopping and not supervisor.processes
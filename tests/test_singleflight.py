@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Tests for coalescing identical in-flight upstream calls
+
+    python -m pytest tests/test_singleflight.py
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from deadline import DeadlineExceeded, deadline_after, remaining
+from priority import INTERACTIVE, REFILL, current_priority, resolve as resolve_priority, upstream_priority
+from singleflight import SingleFlight
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_identical_calls_share_one_task():
+    async def scenario():
+        flights = SingleFlight()
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {'images': []}
+
+        results = await asyncio.gather(*(flights.do('key', fn) for _ in range(5)), flights.do('other', fn))
+        assert len(calls) == 2
+        assert all(result is results[0] for result in results[:5])
+        assert (flights.started, flights.coalesced, flights.in_flight) == (2, 4, 0)
+
+    run(scenario())
+
+
+def test_exception_reaches_every_waiter():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def fn():
+            await asyncio.sleep(0.01)
+            raise RuntimeError('upstream down')
+
+        results = await asyncio.gather(*(flights.do('key', fn) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        # A failed call is forgotten, so the next one goes upstream again
+        assert flights.in_flight == 0
+
+    run(scenario())
+
+
+def test_cancelled_waiter_leaves_the_call_running():
+    async def scenario():
+        flights = SingleFlight()
+        release = asyncio.Event()
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await release.wait()
+            return 'page'
+
+        first = asyncio.create_task(flights.do('key', fn))
+        second = asyncio.create_task(flights.do('key', fn))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        release.set()
+        assert await second == 'page'
+        assert len(calls) == 1
+
+    run(scenario())
+
+
+def test_shared_call_keeps_the_latest_deadline():
+    async def scenario():
+        flights = SingleFlight()
+        release = asyncio.Event()
+        seen = []
+
+        async def fn():
+            await release.wait()
+            seen.append(remaining())
+            return 'page'
+
+        async def call(seconds):
+            with deadline_after(seconds):
+                return await flights.do('key', fn)
+
+        short = asyncio.create_task(call(0.05))
+        await asyncio.sleep(0)
+        long = asyncio.create_task(call(5))
+        # The caller that started the call gives up at its own deadline...
+        with pytest.raises(DeadlineExceeded):
+            await short
+        release.set()
+        # ...while the call keeps running for the caller still waiting
+        assert await long == 'page'
+        assert seen[0] > 1
+
+    run(scenario())
+
+
+def test_unbounded_waiter_lifts_the_deadline():
+    async def scenario():
+        flights = SingleFlight()
+        release = asyncio.Event()
+        seen = []
+
+        async def fn():
+            await release.wait()
+            seen.append(remaining())
+
+        async def bounded():
+            with deadline_after(5):
+                await flights.do('key', fn)
+
+        first = asyncio.create_task(bounded())
+        await asyncio.sleep(0)
+        second = asyncio.create_task(flights.do('key', fn))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, second)
+        assert seen == [None]
+
+    run(scenario())
+
+
+def test_interactive_waiter_promotes_a_refill():
+    async def scenario():
+        flights = SingleFlight()
+        joined = asyncio.Event()
+        seen = []
+
+        async def fn():
+            seen.append(resolve_priority(current_priority()))
+            await joined.wait()
+            seen.append(resolve_priority(current_priority()))
+
+        async def refill():
+            with upstream_priority(REFILL):
+                await flights.do('key', fn)
+
+        background = asyncio.create_task(refill())
+        await asyncio.sleep(0)
+        command = asyncio.create_task(flights.do('key', fn))
+        await asyncio.sleep(0)
+        joined.set()
+        await asyncio.gather(background, command)
+        assert seen == [REFILL, INTERACTIVE]
+
+    run(scenario())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Tests for the concurrent startup stages and the readiness gate
+
+    python -m pytest tests/test_startup.py
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from startup import DEGRADED, FAILED, OK, PENDING, StartupStages
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_gated_command_waits_for_its_stage():
+    async def scenario():
+        stages = StartupStages()
+        loaded = asyncio.Event()
+
+        async def load_tags():
+            await loaded.wait()
+
+        stages.start('tags', load_tags(), gating=True)
+        stages.start('warmup', asyncio.sleep(3600))
+        command = asyncio.create_task(stages.wait_ready(5.0))
+        await asyncio.sleep(0.01)
+        assert not command.done() and stages.results['tags'] == PENDING
+        loaded.set()
+        # Released by the gating stage, not by the slow stage that doesn't gate
+        assert await asyncio.wait_for(command, 1.0) is True
+        assert stages.results == {'tags': OK, 'warmup': PENDING} and not stages.ready
+        await stages.cancel()
+        assert stages.results['warmup'] == FAILED
+
+    run(scenario())
+
+
+def test_failed_stage_releases_the_gate():
+    async def scenario():
+        stages = StartupStages()
+
+        async def broken():
+            await asyncio.sleep(0.01)
+            raise RuntimeError('upstream down')
+
+        async def fallback():
+            return False
+
+        stages.start('tags', broken(), gating=True)
+        stages.start('catalog', fallback(), gating=True)
+        # Returns as soon as the stages end, telling the command to use fallbacks
+        ready = await asyncio.wait_for(stages.wait_ready(5.0), 1.0)
+        return ready, stages.results, stages.ready
+
+    ready, results, complete = run(scenario())
+    assert ready is False
+    assert results == {'tags': FAILED, 'catalog': DEGRADED} and complete
+
+
+def test_gate_times_out_on_a_hung_stage():
+    async def scenario():
+        stages = StartupStages()
+        stages.start('tags', asyncio.Event().wait(), gating=True)
+        ready = await stages.wait_ready(0.05)
+        await stages.cancel()
+        return ready
+
+    assert run(scenario()) is False
+
+
+def test_nothing_gating_means_ready():
+    async def scenario():
+        stages = StartupStages()
+        stages.start('warmup', asyncio.sleep(3600))
+        ready = await stages.wait_ready(0)
+        # Shut down before the stage even started
+        await stages.cancel()
+        return ready, stages.results
+
+    assert run(scenario()) == (True, {'warmup': FAILED})
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Tests for the waifu.im tag autocomplete index
+
+    python -m pytest tests/test_tag_index.py
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from tag_index import TagSearchIndex
+
+TAGS = [
+    'waifu', 'maid', 'uniform', 'marin-kitagawa', 'mori-calliope', 'raiden-shogun', 'oppai',
+    'selfies', 'ero', 'hentai', 'milf', 'oral', 'paizuri', 'ecchi', 'genshin-impact', 'kamisato-ayaka'
+]
+
+
+@pytest.fixture
+def index():
+    return TagSearchIndex(TAGS, popular=['waifu', 'maid'])
+
+
+def test_prefix_matches_come_before_infix_matches(index):
+    assert index.search('or') == ['oral', 'mori-calliope', 'uniform']
+    assert index.search('ma') == ['maid', 'marin-kitagawa']
+    # Exact match first, even when other tags start with it
+    assert TagSearchIndex(['maid-outfit', 'maid', 'mermaid']).search('maid') == ['maid', 'maid-outfit', 'mermaid']
+
+
+def test_substring_search_through_ngrams(index):
+    assert index.search('ai') == ['hentai', 'maid', 'oppai', 'paizuri', 'raiden-shogun', 'waifu']
+    assert index.search('kitagawa') == ['marin-kitagawa']
+    assert index.search('shogun') == ['raiden-shogun']
+    assert index.search('impact') == ['genshin-impact']
+    assert index.search('xyz') == []
+
+
+def test_query_is_case_folded_and_trimmed(index):
+    assert index.search('  MAID ') == ['maid']
+    # Longer than the prefix table is deep
+    assert index.search('Marin-Kitag') == ['marin-kitagawa']
+
+
+def test_empty_query_lists_popular_tags_first(index):
+    assert index.search('', limit=3) == ['waifu', 'maid', 'ecchi']
+    assert len(index.search('', limit=100)) == len(TAGS)
+    assert len(index.search('a', limit=2)) == 2
+
+
+def test_membership(index):
+    assert 'maid' in index and 'Maid' not in index and len(index) == len(TAGS)
+
+
+def test_suggestions_for_typos(index):
+    assert index.suggest('wiafu')[0] == 'waifu'
+    assert index.suggest('unifrom')[0] == 'uniform'
+    assert index.suggest('miad')[0] == 'maid'
+    assert index.suggest('marin')[0] == 'marin-kitagawa'
+    assert index.suggest('Raiden-Shgun') == ['raiden-shogun']
+    assert len(index.suggest('a', limit=2)) <= 2
+
+
+def test_no_suggestion_for_unrelated_terms(index):
+    assert index.suggest('zzqxv') == []
+    assert index.suggest('spaceship') == []
+    assert index.suggest('  ') == []
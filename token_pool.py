@@ -0,0 +1,110 @@
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Sequence
+from metrics import TOKEN_QUARANTINES, TOKENS_AVAILABLE
+from rate_limiter import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class NoTokenAvailableError(Exception):
+    """Raised when every token in the pool is quarantined"""
+
+    def __init__(self, message: str, retry_in: float):
+        super().__init__(message)
+        self.retry_in = retry_in
+
+
+class TokenState:
+    """One API token with its own rate limit and load"""
+
+    __slots__ = ('index', 'token', 'bucket', 'in_flight', 'quarantined_until', 'requests')
+
+    def __init__(self, index: int, token: str, bucket: TokenBucket):
+        self.index = index
+        self.token = token
+        self.bucket = bucket
+        self.in_flight = 0
+        self.quarantined_until = 0.0
+        self.requests = 0
+
+    @property
+    def label(self) -> str:
+        # Never log or export the token itself
+        return self.bucket.name
+
+
+class TokenPool:
+    """Spreads requests to one upstream over several API tokens.
+
+    Each token has its own token bucket. A request leases the token that
+    can go soonest (shortest bucket wait, then fewest requests in flight),
+    so throughput grows with the number of tokens. Tokens answered with
+    401/429 are quarantined and skipped until they cool down.
+    """
+
+    def __init__(self, tokens: Sequence[str], rate: float, burst: int = 1, name: str = ''):
+        self.name = name
+        unique = list(dict.fromkeys(t for t in tokens if t))
+        self._states: List[TokenState] = [
+            TokenState(i, token, TokenBucket(rate, burst, name=f'{name}#{i}'))
+            for i, token in enumerate(unique)
+        ]
+        TOKENS_AVAILABLE.set_function(lambda: self.available, upstream=name)
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    @property
+    def available(self) -> int:
+        now = time.monotonic()
+        return sum(1 for state in self._states if state.quarantined_until <= now)
+
+    @property
+    def retry_in(self) -> float:
+        """Seconds until the first quarantined token is usable again"""
+        now = time.monotonic()
+        return max(0.0, min((s.quarantined_until for s in self._states), default=now) - now)
+
+    def _pick(self) -> Optional[TokenState]:
+        now = time.monotonic()
+        usable = [state for state in self._states if state.quarantined_until <= now]
+        if not usable:
+            return None
+        return min(usable, key=lambda s: (s.bucket.estimated_wait(), s.in_flight, s.requests))
+
+    @asynccontextmanager
+    async def lease(self) -> AsyncIterator[TokenState]:
+        """Pick a token, wait for its rate limit and hold it for one request"""
+        state = self._pick()
+        if state is None:
+            raise NoTokenAvailableError(f"All {self.name} tokens are quarantined", self.retry_in)
+        # Counted before waiting so concurrent pickers see the load
+        state.in_flight += 1
+        try:
+            wait_time = await state.bucket.acquire()
+            if wait_time >= 1.0:
+                logger.info("Rate limiter wait", extra={'upstream': state.label, 'wait_s': round(wait_time, 3)})
+            state.requests += 1
+            yield state
+        finally:
+            state.in_flight -= 1
+
+    def quarantine(self, state: TokenState, seconds: float, reason: str):
+        state.quarantined_until = max(state.quarantined_until, time.monotonic() + seconds)
+        TOKEN_QUARANTINES.inc(upstream=self.name, reason=reason)
+        logger.warning("API token quarantined", extra={
+            'token': state.label, 'reason': reason, 'seconds': round(seconds, 1), 'available': self.available
+        })
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        now = time.monotonic()
+        return {
+            state.label: {
+                'requests': state.requests,
+                'in_flight': state.in_flight,
+                'quarantined_for': max(0.0, state.quarantined_until - now)
+            }
+            for state in self._states
+        }
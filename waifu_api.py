@@ -1,43 +1,90 @@
 import aiohttp
-import asyncio
-from typing import List, Optional, Dict, Any
-from config import WAIFU_API_BASE_URL, WAIFU_API_TOKEN
+import logging
 import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional, Dict, Any
+from urllib.parse import urlparse
+from config import WAIFU_API_BASE_URL, WAIFU_API_TOKENS, TOKEN_QUARANTINE_UNAUTHORIZED
+from deadline import DeadlineExceeded, run_within_deadline
+from fast_json import decode_json
+from hedging import HedgePolicy, hedged
+from models import ImageRecord, intern_tags
+from http_client import create_session
+from image_store import ImageStore
+from metrics import DEADLINE_EXCEEDED, IMAGE_STORE_FALLBACKS, UPSTREAM_LATENCY
+from rate_limiter import get_limiter
+from retry import CircuitOpenError, RetryableError, UpstreamUnavailableError, get_retry_engine, parse_retry_after
+from singleflight import SingleFlight, make_key
+from token_pool import NoTokenAvailableError, TokenPool, TokenState
+
+logger = logging.getLogger(__name__)
 
 class WaifuAPI:
-    def __init__(self):
-        self.base_url = WAIFU_API_BASE_URL
-        self.token = WAIFU_API_TOKEN
-        self.session = None
-        self.last_request_time = 0
-        self.min_request_interval = 1.0
+    def __init__(
+        self,
+        session: Optional[aiohttp.ClientSession] = None,
+        base_url: Optional[str] = None,
+        tokens: Optional[List[str]] = None,
+        store: Optional[ImageStore] = None
+    ):
+        self.base_url = base_url or WAIFU_API_BASE_URL
+        # An injected session is owned (and closed) by whoever created it
+        self.session = session
+        self._owns_session = session is None
+        # Fetched images are recorded here and served from it when waifu.im fails
+        self.store = store
+        self.host = urlparse(self.base_url).hostname
+        self.limiter = get_limiter(self.host)
+        # Every token gets the host's rate limit; without tokens the host limiter applies
+        self.tokens = TokenPool(
+            WAIFU_API_TOKENS if tokens is None else tokens,
+            self.limiter.rate, self.limiter.burst, name=self.host
+        )
+        self._retry = get_retry_engine(self.host)
+        self._flights = SingleFlight('waifu')
+        self._hedge = HedgePolicy()
     
     async def __aenter__(self):
-        self.session = aiohttp.ClientSession()
+        self._ensure_session()
         return self
     
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self.session:
-            await self.session.close()
+        await self.close()
+    
+    def _ensure_session(self):
+        if not self.session:
+            self.session = create_session()
+            self._owns_session = True
     
-    def _get_headers(self) -> Dict[str, str]:
+    def _get_headers(self, token: Optional[str] = None) -> Dict[str, str]:
         headers = {
             'Content-Type': 'application/json',
             'User-Agent': 'WaifuDiscordBot/2.0 (Python/aiohttp)'
         }
-        if self.token:
-            headers['Authorization'] = f'Bearer {self.token}'
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
         return headers
     
-    async def _wait_for_rate_limit(self):
-        current_time = time.time()
-        time_since_last = current_time - self.last_request_time
-        
-        if time_since_last < self.min_request_interval:
-            wait_time = self.min_request_interval - time_since_last
-            await asyncio.sleep(wait_time)
-        
-        self.last_request_time = time.time()
+    async def _wait_for_rate_limit(self) -> float:
+        wait_time = await self.limiter.acquire()
+        if wait_time >= 1.0:
+            logger.info("Rate limiter wait", extra={'upstream': self.host, 'wait_s': round(wait_time, 3)})
+        return wait_time
+    
+    @asynccontextmanager
+    async def _lease_token(self) -> AsyncIterator[Optional[TokenState]]:
+        """Hold the least-loaded token for one request (None when no tokens are configured)"""
+        if not len(self.tokens):
+            await self._wait_for_rate_limit()
+            yield None
+            return
+        try:
+            async with self.tokens.lease() as state:
+                yield state
+        except NoTokenAvailableError as e:
+            # Every key is throttled or revoked. That says nothing about waifu.im itself, so the
+            # host circuit stays closed; a wait longer than the retry engine allows fails fast
+            raise RetryableError(str(e), status=429, retry_after=e.retry_in, key_scoped=True) from e
     
     async def search_images(
         self,
@@ -49,15 +96,14 @@ class WaifuAPI:
         page_size: int = 1,
         order_by: Optional[str] = None
     ) -> Optional[Dict[str, Any]]:
-        if not self.session:
-            self.session = aiohttp.ClientSession()
+        self._ensure_session()
         
         params = {}
         
         if included_tags:
-            params['tags'] = ','.join(included_tags)
+            params['tags'] = ','.join(sorted(included_tags))
         if excluded_tags:
-            params['excludedTags'] = ','.join(excluded_tags)
+            params['excludedTags'] = ','.join(sorted(excluded_tags))
         if is_nsfw is not None:
             params['isNsfw'] = 'true' if is_nsfw else 'false'
         if is_animated is not None:
@@ -69,84 +115,123 @@ class WaifuAPI:
         
         params['pageSize'] = min(page_size, 30)
         
-        await self._wait_for_rate_limit()
-        
+        # Identical concurrent searches share one upstream request
+        return await self._flights.do(
+            make_key('/images', params),
+            lambda: self._fetch_images(params)
+        )
+    
+    async def _fetch_images(self, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        logger.debug("API request", extra={'url': f'{self.base_url}/images', 'params': params})
         try:
-            print(f"API Request: {self.base_url}/images with params: {params}")
-            async with self.session.get(
-                f'{self.base_url}/images',
-                params=params,
-                headers=self._get_headers()
-            ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    items = result.get('items', [])
-                    print(f"API Success: Got {len(items)} images")
-                    
-                    converted_result = {'images': []}
-                    
-                    for item in items:
-                        converted_image = {
-                            'url': item.get('url'),
-                            'width': item.get('width'),
-                            'height': item.get('height'),
-                            'is_nsfw': item.get('isNsfw'),
-                            'dominant_color': item.get('dominantColor'),
-                            'tags': [{'name': tag.get('slug')} for tag in item.get('tags', [])],
-                            'artist': item.get('artists', [{}])[0] if item.get('artists') else None
-                        }
-                        converted_result['images'].append(converted_image)
-                    
-                    return converted_result
-                elif response.status == 429:
+            result = await self._get_json('/images', params, raise_unavailable=self.store is not None)
+        except UpstreamUnavailableError:
+            return await self._search_store(params)
+        if result is None:
+            return None
+        
+        items = result.get('items', [])
+        logger.debug("API success", extra={'url': f'{self.base_url}/images', 'images': len(items)})
+        images = [self._convert_image(item) for item in items if item.get('url')]
+        if self.store is not None:
+            self.store.record('waifu', images, self._param_tags(params, 'tags'))
+        return {'images': images}
+    
+    @staticmethod
+    def _param_tags(params: Dict[str, Any], name: str) -> List[str]:
+        return [tag for tag in params.get(name, '').split(',') if tag]
+    
+    async def _search_store(self, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        # Orientation, animation and ordering are not stored; tags and NSFW are what matter
+        images = await self.store.random_images(
+            'waifu', self._param_tags(params, 'tags'), self._param_tags(params, 'excludedTags'),
+            nsfw=params.get('isNsfw') == 'true', count=params['pageSize']
+        )
+        IMAGE_STORE_FALLBACKS.inc(source='waifu', result='hit' if images else 'empty')
+        logger.info("Serving images from the local store", extra={'params': params, 'images': len(images)})
+        return {'images': images} if images else None
+    
+    @staticmethod
+    def _convert_image(item: Dict[str, Any]) -> ImageRecord:
+        artists = item.get('artists') or []
+        return ImageRecord(
+            url=item['url'],
+            width=item.get('width'),
+            height=item.get('height'),
+            is_nsfw=bool(item.get('isNsfw')),
+            tags=intern_tags(tag.get('slug') for tag in item.get('tags', [])),
+            dominant_color=item.get('dominantColor'),
+            artist=artists[0].get('name') if artists and isinstance(artists[0], dict) else None
+        )
+    
+    async def _get_json(
+        self,
+        path: str,
+        params: Optional[Dict[str, Any]] = None,
+        raise_unavailable: bool = False
+    ) -> Optional[Any]:
+        """GET a waifu.im endpoint through the rate limiter and retry engine.
+        
+        Failed requests return None, or raise UpstreamUnavailableError with `raise_unavailable`.
+        """
+        url = f'{self.base_url}{path}'
+        
+        async def attempt():
+            async with self._lease_token() as token:
+                # A hedge only goes out if the same limiter has a spare token
+                bucket = token.bucket if token is not None else self.limiter
+                return await run_within_deadline(hedged(
+                    lambda: request(token), self._hedge.delay(path), bucket.try_acquire, name=self.host
+                ))
+        
+        async def request(token: Optional[TokenState]):
+            started = time.perf_counter()
+            status = 'error'
+            try:
+                async with self.session.get(url, params=params, headers=self._get_headers(token and token.token)) as response:
+                    status = str(response.status)
+                    if response.status == 200:
+                        return await decode_json(await response.read())
                     error_text = await response.text()
-                    print(f"API Rate Limited: {error_text}")
-                    
-                    retry_after = response.headers.get('Retry-After', '5')
-                    try:
-                        wait_time = int(retry_after)
-                    except:
-                        wait_time = 5
-                    
-                    print(f"Waiting {wait_time} seconds before retry...")
-                    await asyncio.sleep(wait_time)
-                    
-                    async with self.session.get(
-                        f'{self.base_url}/images',
-                        params=params,
-                        headers=self._get_headers()
-                    ) as retry_response:
-                        if retry_response.status == 200:
-                            result = await retry_response.json()
-                            items = result.get('items', [])
-                            print(f"API Success (retry): Got {len(items)} images")
-                            
-                            converted_result = {'images': []}
-                            
-                            for item in items:
-                                converted_image = {
-                                    'url': item.get('url'),
-                                    'width': item.get('width'),
-                                    'height': item.get('height'),
-                                    'is_nsfw': item.get('isNsfw'),
-                                    'dominant_color': item.get('dominantColor'),
-                                    'tags': [{'name': tag.get('slug')} for tag in item.get('tags', [])],
-                                    'artist': item.get('artists', [{}])[0] if item.get('artists') else None
-                                }
-                                converted_result['images'].append(converted_image)
-                            
-                            return converted_result
+                    if token is not None and response.status in (401, 429):
+                        # The key is revoked or throttled, not the API: park it and retry with another one
+                        if response.status == 401:
+                            self.tokens.quarantine(token, TOKEN_QUARANTINE_UNAUTHORIZED, 'unauthorized')
                         else:
-                            error_text = await retry_response.text()
-                            print(f"API Error (retry): {retry_response.status} - {error_text}")
-                            return None
-                else:
-                    error_text = await response.text()
-                    print(f"API Error: {response.status} - {error_text}")
+                            self.tokens.quarantine(token, parse_retry_after(response.headers.get('Retry-After')), 'throttled')
+                        raise RetryableError(f"{response.status} - {error_text}", status=response.status, key_scoped=True)
+                    if response.status == 429 or response.status >= 500:
+                        retry_after = None
+                        if response.status == 429:
+                            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                        raise RetryableError(
+                            f"{response.status} - {error_text}",
+                            status=response.status,
+                            retry_after=retry_after
+                        )
+                    logger.warning("API error", extra={'url': url, 'status': response.status, 'body': error_text[:500]})
                     return None
+            finally:
+                elapsed = time.perf_counter() - started
+                UPSTREAM_LATENCY.observe(elapsed, upstream=self.host, endpoint=path, status=status)
+                if status == '200':
+                    self._hedge.observe(path, elapsed)
+        
+        try:
+            return await self._retry.run(attempt)
+        except CircuitOpenError as e:
+            logger.warning("API request skipped", extra={'url': url, 'error': str(e)})
+            error = e
+        except DeadlineExceeded as e:
+            DEADLINE_EXCEEDED.inc(upstream=self.host)
+            logger.info("API request dropped past its deadline", extra={'url': url, 'error': str(e)})
+            error = e
         except Exception as e:
-            print(f"Request failed: {e}")
-            return None
+            logger.error("API request failed", extra={'url': url, 'error': repr(e)})
+            error = e
+        if raise_unavailable:
+            raise UpstreamUnavailableError(str(error)) from error
+        return None
     
     async def get_random_waifu(self, nsfw: bool = False) -> Optional[Dict[str, Any]]:
         return await self.search_images(is_nsfw=nsfw)
@@ -162,98 +247,44 @@ class WaifuAPI:
         )
     
     async def get_available_tags(self) -> Optional[Dict[str, Any]]:
-        if not self.session:
-            self.session = aiohttp.ClientSession()
+        self._ensure_session()
+        
+        return await self._flights.do(make_key('/tags', {}), self._fetch_tags)
+    
+    async def _fetch_tags(self) -> Optional[Dict[str, Any]]:
+        result = await self._get_json('/tags')
+        if result is None:
+            return None
+        return self._categorize_tags(result.get('items', []))
+    
+    @staticmethod
+    def _categorize_tags(items: List[Dict[str, Any]]) -> Dict[str, List[str]]:
+        known_nsfw = ['hentai', 'ecchi', 'ero', 'oral', 'paizuri', 'ass', 'milf']
+        known_sfw = ['waifu', 'maid', 'uniform', 'selfies', 'oppai']
         
-        await self._wait_for_rate_limit()
+        versatile = []
+        nsfw = []
         
-        try:
-            async with self.session.get(
-                f'{self.base_url}/tags',
-                headers=self._get_headers()
-            ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    items = result.get('items', [])
-                    
-                    known_nsfw = ['hentai', 'ecchi', 'ero', 'oral', 'paizuri', 'ass', 'milf']
-                    known_sfw = ['waifu', 'maid', 'uniform', 'selfies', 'oppai']
-                    
-                    versatile = []
-                    nsfw = []
-                    
-                    for tag in items:
-                        tag_slug = tag.get('slug', tag.get('name', '').lower())
-                        
-                        if tag_slug in known_nsfw:
-                            nsfw.append(tag_slug)
-                        elif tag_slug in known_sfw:
-                            versatile.append(tag_slug)
-                        else:
-                            description = tag.get('description', '').lower()
-                            if any(word in description for word in ['nsfw', 'explicit', 'sexual', 'erotic', 'nude']):
-                                nsfw.append(tag_slug)
-                            else:
-                                versatile.append(tag_slug)
-                    
-                    return {
-                        'versatile': versatile,
-                        'nsfw': nsfw
-                    }
-                elif response.status == 429:
-                    retry_after = response.headers.get('Retry-After', '5')
-                    try:
-                        wait_time = int(retry_after)
-                    except:
-                        wait_time = 5
-                    
-                    print(f"Tags API Rate Limited, waiting {wait_time} seconds...")
-                    await asyncio.sleep(wait_time)
-                    
-                    async with self.session.get(
-                        f'{self.base_url}/tags',
-                        headers=self._get_headers()
-                    ) as retry_response:
-                        if retry_response.status == 200:
-                            result = await retry_response.json()
-                            items = result.get('items', [])
-                            
-                            known_nsfw = ['hentai', 'ecchi', 'ero', 'oral', 'paizuri', 'ass', 'milf']
-                            known_sfw = ['waifu', 'maid', 'uniform', 'selfies', 'oppai']
-                            
-                            versatile = []
-                            nsfw = []
-                            
-                            for tag in items:
-                                tag_slug = tag.get('slug', tag.get('name', '').lower())
-                                
-                                if tag_slug in known_nsfw:
-                                    nsfw.append(tag_slug)
-                                elif tag_slug in known_sfw:
-                                    versatile.append(tag_slug)
-                                else:
-                                    description = tag.get('description', '').lower()
-                                    if any(word in description for word in ['nsfw', 'explicit', 'sexual', 'erotic', 'nude']):
-                                        nsfw.append(tag_slug)
-                                    else:
-                                        versatile.append(tag_slug)
-                            
-                            return {
-                                'versatile': versatile,
-                                'nsfw': nsfw
-                            }
-                        else:
-                            error_text = await retry_response.text()
-                            print(f"Tags API Error (retry): {retry_response.status} - {error_text}")
-                            return None
+        for tag in items:
+            tag_slug = tag.get('slug', tag.get('name', '').lower())
+            
+            if tag_slug in known_nsfw:
+                nsfw.append(tag_slug)
+            elif tag_slug in known_sfw:
+                versatile.append(tag_slug)
+            else:
+                description = tag.get('description', '').lower()
+                if any(word in description for word in ['nsfw', 'explicit', 'sexual', 'erotic', 'nude']):
+                    nsfw.append(tag_slug)
                 else:
-                    error_text = await response.text()
-                    print(f"Tags API Error: {response.status} - {error_text}")
-                    return None
-        except Exception as e:
-            print(f"Tags request failed: {e}")
-            return None
+                    versatile.append(tag_slug)
+        
+        return {
+            'versatile': versatile,
+            'nsfw': nsfw
+        }
     
     async def close(self):
-        if self.session:
+        if self.session and self._owns_session:
             await self.session.close()
+            self.session = None